@@ -0,0 +1,104 @@
+#!~/.pyenv/boostzapper/bin/python3
+import gzip
+import logging
+import os
+import random
+import sys
+import time
+import botfiles as files
+import botutils as utils
+
+# Compares the JSON backends and compression available to botfiles using
+# either the real data files of the bot, or generated data of the same shape.
+#
+#   benchjson.py [--size <records for generated data>] [--iterations <n>] [--generated]
+
+def randomHex(length=64):
+    return os.urandom(length // 2).hex()
+
+def makeLightningIdCache(size):
+    t, _ = utils.getTimes()
+    return {randomHex(): {"lightningId": f"user{i}@walletofsatoshi.com", "name": f"name {i}", "created_at": t - random.randint(0, 86400)} for i in range(size)}
+
+def makePaymentDestinations(size):
+    data = {}
+    for d in range(min(size // 50, 365) + 1):
+        day = f"2024-{(d // 28) % 12 + 1:02d}-{d % 28 + 1:02d}"
+        data[day] = {randomHex(66): {"qty": random.randint(1, 40), "amount": random.randint(10, 5000)} for _ in range(50)}
+    return data
+
+def makePaidNpubs(size):
+    t, tiso = utils.getTimes()
+    return {randomHex(): {"lightning_id": f"user{i}@getalby.com", "amount_sat": 21, "payment_time": t, "payment_time_iso": tiso, "randomWinner": 0,
+        "payment_status": "SUCCEEDED", "fee_msat": 1000, "payment_hash": randomHex(), "payment_index": i, "payment_server": "mainnet"} for i in range(size)}
+
+def makeResponses(size):
+    return [randomHex() for _ in range(size)]
+
+def makeLedger(size):
+    t, tiso = utils.getTimes()
+    return [{"created_at": t, "created_at_iso": tiso, "type": "ZAPS", "credits": -21, "mcredits": 0, "balance": 100000 - (i * 21),
+        "description": f"Zap user{i}@getalby.com for reply to note1{randomHex(58)}"} for i in range(size)]
+
+def getRealData():
+    shapes = {}
+    for name in ("lightningIdcache.json", "paymentdestination.json"):
+        data = files.loadJsonFile(f"{files.dataFolder}{name}")
+        if data is not None: shapes[name] = data
+    # the largest paidnpubs and responses among monitored events
+    largest = {}
+    for root, _, filenames in os.walk(files.userEventsFolder):
+        for name in ("paidnpubs.json", "responses.json"):
+            if name not in filenames: continue
+            filename = os.path.join(root, name)
+            if name not in largest or os.path.getsize(filename) > os.path.getsize(largest[name]): largest[name] = filename
+    for name, filename in largest.items():
+        shapes[name] = files.loadJsonFile(filename)
+    return shapes
+
+def getGeneratedData(size):
+    return {
+        "lightningIdcache.json": makeLightningIdCache(size),
+        "paymentdestination.json": makePaymentDestinations(size),
+        "paidnpubs.json": makePaidNpubs(size),
+        "responses.json": makeResponses(size),
+        "ledger.json": makeLedger(min(size, 500)),
+    }
+
+def timeIt(iterations, f):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        result = f()
+    elapsed = (time.perf_counter() - start) / iterations
+    return elapsed, result
+
+if __name__ == '__main__':
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG)
+    stdoutLoggingHandler = logging.StreamHandler(stream=sys.stdout)
+    logger.addHandler(stdoutLoggingHandler)
+    files.logger = logger
+
+    size = int(utils.getCommandArg("size") or 10000)
+    iterations = int(utils.getCommandArg("iterations") or 20)
+    shapes = {} if "--generated" in sys.argv else getRealData()
+    if len(shapes) == 0:
+        logger.info(f"Using generated data with {size} records")
+        shapes = getGeneratedData(size)
+    else:
+        logger.info(f"Using data files from {files.dataFolder}")
+
+    logger.info(f"Backends available: {', '.join(files.jsonBackends)}")
+    logger.info(f"zstandard available: {files.zstandard is not None}")
+    logger.info("")
+    logger.info(f"{'file':<26}{'backend':<8}{'format':<8}{'bytes':>12}{'encode ms':>12}{'decode ms':>12}{'gzip':>10}{'zstd':>10}")
+    for name, obj in shapes.items():
+        for backend in files.jsonBackends:
+            for pretty in (True, False):
+                encodeTime, data = timeIt(iterations, lambda: files.encodeJson(obj, pretty, backend))
+                decodeTime, _ = timeIt(iterations, lambda: files.decodeJson(data, backend))
+                gzipSize = len(gzip.compress(data))
+                zstdSize = len(files.zstandard.ZstdCompressor().compress(data)) if files.zstandard is not None else "-"
+                format = "pretty" if pretty else "compact"
+                logger.info(f"{name:<26}{backend:<8}{format:<8}{len(data):>12}{encodeTime*1000:>12.2f}{decodeTime*1000:>12.2f}{gzipSize:>10}{zstdSize:>10}")
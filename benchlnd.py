@@ -0,0 +1,98 @@
+#!~/.pyenv/boostzapper/bin/python3
+import base64
+import logging
+import sys
+import time
+import botbolt11 as bolt11
+import botfiles as files
+import botlnd as lnd
+import botpayments as payments
+import botutils as utils
+import mocklnd
+
+# Runs the LND paths used by the bot at scale against the mock LND server,
+# started in process, or against the server given.
+#
+#   benchlnd.py [--count <n>] [--concurrency <n>] [--latency <ms>] [--inflightSeconds <s>]
+#               [--failRate <0-1>] [--address <host> --port <port> --macaroon <hex>]
+
+def percentile(values, p):
+    if len(values) == 0: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def timeEach(items, f):
+    durations = []
+    results = []
+    start = time.perf_counter()
+    for item in items:
+        itemStart = time.perf_counter()
+        results.append(f(item))
+        durations.append(time.perf_counter() - itemStart)
+    return time.perf_counter() - start, durations, results
+
+def report(name, total, durations):
+    count = len(durations)
+    mean = (sum(durations) / count) if count > 0 else 0
+    rate = (count / total) if total > 0 else 0
+    logger.info(f"{name:<28}{count:>8}{total:>10.2f}{mean*1000:>12.2f}{percentile(durations, 0.95)*1000:>12.2f}{rate:>10.1f}")
+
+def payConcurrently(paymentRequests):
+    start = time.perf_counter()
+    submitted = {}
+    for paymentRequest in paymentRequests:
+        decoded = bolt11.decodeInvoice(paymentRequest)
+        payment = {"payment_hash": decoded["payment_hash"], "amount": int(decoded["num_satoshis"])}
+        submitted[decoded["payment_hash"]] = time.perf_counter()
+        payments.submitPayment(paymentRequest, payment)
+    durations = []
+    statuses = {}
+    while len(durations) < len(submitted):
+        for payment, paymentResult in payments.getCompletedPayments(block=True):
+            durations.append(time.perf_counter() - submitted[payment["payment_hash"]])
+            statuses[paymentResult[0]] = statuses.get(paymentResult[0], 0) + 1
+            payments.completePayment(payment)
+    return time.perf_counter() - start, durations, statuses
+
+if __name__ == '__main__':
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    stdoutLoggingHandler = logging.StreamHandler(stream=sys.stdout)
+    logger.addHandler(stdoutLoggingHandler)
+    for module in (bolt11, files, lnd, payments, mocklnd):
+        module.logger = logger
+
+    count = int(utils.getCommandArg("count") or 40)
+    concurrency = int(utils.getCommandArg("concurrency") or 8)
+    address = utils.getCommandArg("address")
+    if address is None:
+        mocklnd.config["latency"] = int(utils.getCommandArg("latency") or 20)
+        mocklnd.config["inflightSeconds"] = float(utils.getCommandArg("inflightSeconds") or 0.5)
+        mocklnd.config["failRate"] = float(utils.getCommandArg("failRate") or 0)
+        port = 18080
+        mocklnd.startServer(port)
+        lnd.config = {"address": "127.0.0.1", "port": str(port), "macaroon": "00"}
+    else:
+        lnd.config = {"address": address, "port": utils.getCommandArg("port"), "macaroon": utils.getCommandArg("macaroon")}
+    lnd.config.update({"feeLimit": 2, "paymentTimeout": 30, "maxConcurrentPayments": concurrency})
+
+    logger.info(f"{'operation':<28}{'count':>8}{'total s':>10}{'mean ms':>12}{'p95 ms':>12}{'per s':>10}")
+    total, durations, invoices = timeEach(range(count), lambda i: lnd.createInvoice(21, f"bench {i}", 3600))
+    report("createInvoice", total, durations)
+    hashes = [base64.b64decode(invoice["r_hash"]).hex() for invoice in invoices]
+    total, durations, _ = timeEach(hashes, lnd.lookupInvoice)
+    report("lookupInvoice", total, durations)
+    paymentRequests = [invoice["payment_request"] for invoice in invoices]
+    total, durations, _ = timeEach(paymentRequests, lambda pr: lnd.restLndGET(f"/v1/payreq/{pr}"))
+    report("decodeInvoice (LND)", total, durations)
+    total, durations, _ = timeEach(paymentRequests, bolt11.decodeInvoice)
+    report("decodeInvoice (local)", total, durations)
+    half = count // 2
+    total, durations, results = timeEach(paymentRequests[:half], lnd.payInvoice)
+    report("payInvoice (sequential)", total, durations)
+    total, durations, statuses = payConcurrently(paymentRequests[half:])
+    report(f"payInvoice ({concurrency} concurrent)", total, durations)
+    logger.info(f"  concurrent outcomes: {statuses}")
+    total, durations, _ = timeEach(hashes, lnd.trackPayment)
+    report("trackPayment", total, durations)
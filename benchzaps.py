@@ -0,0 +1,124 @@
+#!~/.pyenv/boostzapper/bin/python3
+from concurrent.futures import ThreadPoolExecutor
+from nostr.event import Event
+from nostr.key import PrivateKey
+import logging
+import sys
+import time
+import botbolt11 as bolt11
+import botfiles as files
+import botlnd as lnd
+import botlnurl as lnurl
+import botnostr as nostr
+import botpayments as payments
+import botpolicy as policy
+import botutils as utils
+import mocklnd
+import mocklnurl
+
+# Runs the zap path of the bot, from getting the LNURL pay info of a lightning
+# address to the payment settling, for many addresses at once against the mock
+# LN URL Provider and mock LND, both started in process.
+#
+#   benchzaps.py [--count <n>] [--concurrency <n>] [--amount <sats>] [--latency <ms>]
+#                [--lndLatency <ms>] [--errorRate <0-1>] [--statusErrorRate <0-1>]
+#                [--wrongAmountRate <0-1>] [--wrongHashRate <0-1>] [--failRate <0-1>]
+
+def percentile(values, p):
+    if len(values) == 0: return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def report(name, durations):
+    count = len(durations)
+    mean = (sum(durations) / count) if count > 0 else 0
+    logger.info(f"{name:<24}{count:>8}{mean*1000:>12.2f}{percentile(durations, 0.5)*1000:>12.2f}{percentile(durations, 0.95)*1000:>12.2f}")
+
+def makeZapRequest(pk, amount, recipientPubkey, bech32lnurl):
+    zapTags = [["relays"], ["amount", str(amount * 1000)], ["lnurl", bech32lnurl], ["p", recipientPubkey]]
+    zapEvent = Event(content="bench", kind=9734, tags=zapTags)
+    pk.sign_event(zapEvent)
+    return zapEvent
+
+def prepareZap(pk, lightningId, amount):
+    # the steps taken by processEvents before submitting a payment, returning
+    # the outcome, the payment request and the time taken by each step
+    timings = {}
+    start = time.perf_counter()
+    lnurlPayInfo, lnurlp = lnurl.getLNURLPayInfo(lightningId)
+    timings["getLNURLPayInfo"] = time.perf_counter() - start
+    callback, bech32lnurl, userMessage = nostr.validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, lightningId, amount, "")
+    if callback is None or bech32lnurl is None or userMessage is not None: return "invalidPayInfo", None, timings
+    zapRequest = makeZapRequest(pk, amount, pk.public_key.hex(), bech32lnurl)
+    start = time.perf_counter()
+    invoice = lnurl.getInvoiceFromZapRequest(callback, amount, zapRequest, bech32lnurl)
+    timings["getInvoice"] = time.perf_counter() - start
+    if not lnurl.isValidInvoiceResponse(invoice): return "invalidInvoice", None, timings
+    start = time.perf_counter()
+    decodedInvoice = lnd.decodeInvoice(invoice["pr"])
+    timings["decodeInvoice"] = time.perf_counter() - start
+    if not nostr.isValidInvoiceAmount(decodedInvoice, amount): return "wrongAmount", None, timings
+    if not bolt11.isValidDescriptionHash(decodedInvoice, lnurl.getZapRequestJson(zapRequest)): return "wrongHash", None, timings
+    return "ok", invoice["pr"], timings
+
+if __name__ == '__main__':
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.INFO)
+    stdoutLoggingHandler = logging.StreamHandler(stream=sys.stdout)
+    logger.addHandler(stdoutLoggingHandler)
+    for module in (bolt11, files, lnd, lnurl, nostr, payments, policy, mocklnd, mocklnurl):
+        module.logger = logger
+
+    count = int(utils.getCommandArg("count") or 100)
+    concurrency = int(utils.getCommandArg("concurrency") or 8)
+    amount = int(utils.getCommandArg("amount") or 21)
+    mocklnurl.config.update({"latency": int(utils.getCommandArg("latency") or 50),
+                             "errorRate": float(utils.getCommandArg("errorRate") or 0),
+                             "statusErrorRate": float(utils.getCommandArg("statusErrorRate") or 0),
+                             "wrongAmountRate": float(utils.getCommandArg("wrongAmountRate") or 0),
+                             "wrongHashRate": float(utils.getCommandArg("wrongHashRate") or 0)})
+    mocklnd.config.update({"latency": int(utils.getCommandArg("lndLatency") or 20),
+                           "failRate": float(utils.getCommandArg("failRate") or 0)})
+    lndPort = 18080
+    mocklnd.startServer(lndPort)
+    mocklnurl.startServer(18081)
+    lnd.config = {"address": "127.0.0.1", "port": str(lndPort), "macaroon": "00", "feeLimit": 2,
+                  "paymentTimeout": 30, "maxConcurrentPayments": concurrency}
+    lnurl.config = {"httpDomains": [mocklnurl.getDomain()], "payInfoCacheSeconds": 0,
+                    "maxConnectionsPerDomain": concurrency, "prefetchThreads": concurrency}
+    # caches are kept in a separate folder so the data of the bot is untouched
+    files.dataFolder = "data/benchzaps/"
+    utils.makeFolderIfNotExists(files.dataFolder)
+
+    pk = PrivateKey()
+    lightningIds = [f"user{i}@{mocklnurl.getDomain()}" for i in range(count)]
+    start = time.perf_counter()
+    lnurl.prefetchLNURLPayInfo(lightningIds)
+    timings = {}
+    outcomes = {}
+    submitted = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for outcome, paymentRequest, zapTimings in executor.map(lambda i: prepareZap(pk, i, amount), lightningIds):
+            for k, v in zapTimings.items(): timings.setdefault(k, []).append(v)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+            if paymentRequest is None: continue
+            decoded = bolt11.decodeInvoice(paymentRequest)
+            submitted[decoded["payment_hash"]] = time.perf_counter()
+            payments.submitPayment(paymentRequest, {"payment_hash": decoded["payment_hash"], "amount": amount})
+    paymentDurations = []
+    statuses = {}
+    while len(paymentDurations) < len(submitted):
+        for payment, paymentResult in payments.getCompletedPayments(block=True):
+            paymentDurations.append(time.perf_counter() - submitted[payment["payment_hash"]])
+            statuses[paymentResult[0]] = statuses.get(paymentResult[0], 0) + 1
+            payments.completePayment(payment)
+    total = time.perf_counter() - start
+
+    logger.info(f"{'step':<24}{'count':>8}{'mean ms':>12}{'p50 ms':>12}{'p95 ms':>12}")
+    for k, v in timings.items(): report(k, v)
+    report("payment", paymentDurations)
+    logger.info(f"{count} zaps in {total:.2f} s ({count / total:.1f} per s)")
+    logger.info(f"  zap outcomes: {outcomes}")
+    logger.info(f"  payment outcomes: {statuses}")
+    logger.info(f"  provider outcomes: {mocklnurl.getCounts()}")
@@ -1,17 +1,25 @@
 #!/usr/bin/env python3
 from collections import OrderedDict
 from logging.handlers import RotatingFileHandler
+import atexit
 import logging
 import random
 import shutil
+import signal
 import sys
 import threading
 import time
+import botarchive as archive
+import botbolt11 as bolt11
 import botfiles as files
+import botjournal as journal
 import botledger as ledger
 import botlnd as lnd
 import botlnurl as lnurl
 import botnostr as nostr
+import botpayments as payments
+import botpolicy as policy
+import botreconcile as reconcile
 import botreports as reports
 import botutils as utils
 
@@ -23,10 +31,10 @@ def processBots():
         npub, eventHex = enabledBots.popitem(last=False)
         botConfig = nostr.getNpubConfigFile(npub)
 
-        # check outstanding payments status
+        # check outstanding payments status if not reconciled by the tracking stream
         d100 = random.randint(1,100)
         percentCheckOutstandingPayments = 25
-        if d100 <= percentCheckOutstandingPayments:
+        if d100 <= percentCheckOutstandingPayments and not reconcile.isTrackingActive():
             nostr.processOutstandingPayments(npub, botConfig)
 
         # get any new replies seen on relays
@@ -46,6 +54,12 @@ def processBots():
         # Repopulate the list of enabled bots
         enabledBots = nostr.getEnabledBots()
 
+def saveCaches(force=False):
+    lnd.flushPaymentDestinations(force)
+    lnd.flushRouteCache()
+    lnurl.flushPayInfoCache()
+    nostr.flushLightningIdCache()
+
 def billForTime():
     global startTime
     global unitsBilled
@@ -82,10 +96,16 @@ if __name__ == '__main__':
                                  backupCount=21, encoding=None, delay=0)
     fileLoggingHandler.setFormatter(formatter)
     logger.addHandler(fileLoggingHandler)
+    archive.logger = logger
+    bolt11.logger = logger
     files.logger = logger
+    journal.logger = logger
     lnd.logger = logger
     lnurl.logger = logger
     nostr.logger = logger
+    payments.logger = logger
+    policy.logger = logger
+    reconcile.logger = logger
     reports.logger = logger
 
     # Load server config
@@ -95,10 +115,23 @@ if __name__ == '__main__':
         logger.info(f"Copied sample-server.config.json to {files.dataFolder}serverconfig.json")
         logger.info("You will need to modify this file to setup Bot private key and LND connection settings")
         quit()
+    if "files" in serverConfig: files.config = serverConfig["files"]
     nostr.config = serverConfig["nostr"]
     lnd.config = serverConfig["lnd"]
     lnurl.config = serverConfig["lnurl"]
     reports.config = serverConfig["reports"]
+    if "archive" in serverConfig: archive.config = serverConfig["archive"]
+
+    # Apply any payment journals left from a prior run
+    journal.recoverJournals(nostr.setEventBalance)
+
+    # Recover payments that were in progress when the prior run stopped
+    payments.loadPaymentQueue()
+
+    # Follow invoice and payment updates from LND in the background
+    lnd.startInvoiceSubscription()
+    reconcile.loadUnresolvedPayments()
+    reconcile.startPaymentTracking()
 
     # Connect to relays
     nostr.connectToRelays()
@@ -106,7 +139,8 @@ if __name__ == '__main__':
     # Load Lightning ID cache
     nostr.loadLightningIdCache()
 
-    # Build and upload reports
+    # Archive events no longer monitored, then build and upload reports
+    archive.compactEvents()
     reports.makeAllReports()
     lastReportTime = startTime
     makeReportsInterval = (1 * 60 * 60)
@@ -136,14 +170,33 @@ if __name__ == '__main__':
     relayReconnectInterval = (30 * 60)
     botProcessTime = startTime
     botProcessInterval = (2 * 60)
+    lastLNDHealthCheckTime = startTime
+    lndHealthCheckInterval = (5 * 60)
+    lastCacheSaveTime = startTime
+    cacheSaveInterval = (1 * 60)
+
+    # save cached data when stopped
+    atexit.register(saveCaches, True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     # Bot loop
     while True:
         loopStartTime, _ = utils.getTimes()
 
+        # check the LND connection periodically, resetting pooled connections if unhealthy
+        if lastLNDHealthCheckTime + lndHealthCheckInterval < loopStartTime:
+            lnd.checkLNDHealth()
+            lastLNDHealthCheckTime, _ = utils.getTimes()
+
         # process outstanding invoices
         lnd.checkInvoices()
 
+        # apply final status of payments that were unresolved
+        reconcile.applyPaymentUpdates(nostr.applyPaymentStatus)
+
+        # settle payments that completed since their event was processed
+        nostr.settlePayments()
+
         # process the next enabled bot
         if botProcessTime + botProcessInterval < loopStartTime:
             processBots()
@@ -165,9 +218,15 @@ if __name__ == '__main__':
 
         # make reports periodically
         if lastReportTime + makeReportsInterval < loopEndTime:
+            archive.compactEvents()
             reports.makeAllReports()
             lastReportTime, _ = utils.getTimes()
 
+        # save cached data periodically
+        if lastCacheSaveTime + cacheSaveInterval < loopEndTime:
+            saveCaches()
+            lastCacheSaveTime, _ = utils.getTimes()
+
         # reconnect relays if periodically
         if lastRelayReconnectTime + relayReconnectInterval < loopEndTime:
             nostr.reconnectRelays()
@@ -182,4 +241,5 @@ if __name__ == '__main__':
                 time2sleep = 2 # force it to avoid relay throttle
             if time2sleep > 0:
                 logger.debug(f"Sleeping {time2sleep} seconds")
-                time.sleep(time2sleep)
+                # wake early to apply credits when an invoice is paid
+                lnd.waitForInvoiceUpdates(time2sleep)
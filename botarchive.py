@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tarfile
+import time
+import botfiles as files
+import botreports as reports
+import botutils as utils
+
+logger = None
+config = {}         # optional archive section of server config
+
+# Events that are no longer monitored and have no payments outstanding are
+# packed into a single compressed file per event, with the final totals
+# recorded in the npub's index.json. Archived events are no longer included
+# in hourly report regeneration or directory scans, and are restored to a
+# folder if they are monitored again. Lookups that only read an event, such
+# as its spend so far, read the files from the archive instead.
+
+unresolvedPaymentStatuses = ("IN_FLIGHT","TIMEOUT","UNKNOWNPAYING","UNKNOWNTRACKING","NOTFOUND")
+
+def getArchiveAfterDays():
+    return config["archiveAfterDays"] if "archiveAfterDays" in config else 7
+
+def getEventTotals(npub, eventId):
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    paidnpubs = files.loadJsonFile(f"{basePath}paidnpubs.json", {})
+    replies = files.loadJsonFile(f"{basePath}replies.json", [])
+    participants = files.loadJsonFile(f"{basePath}participants.json", [])
+    responses = files.loadJsonFile(f"{basePath}responses.json", [])
+    totals = {"zaps": 0, "amount_sat": 0, "fee_msat": 0, "replies": len(replies), "participants": len(participants), "responses": len(responses)}
+    for v in paidnpubs.values():
+        totals["zaps"] += 1
+        totals["amount_sat"] += v["amount_sat"] if "amount_sat" in v else 0
+        totals["fee_msat"] += v["fee_msat"] if "fee_msat" in v else 0
+    return totals
+
+def isEventCold(npub, eventId, activeEventHex):
+    if utils.normalizeToHex(eventId) == activeEventHex: return False
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    eventFiles = os.listdir(basePath)
+    # unapplied payment journal
+    if "journal.jsonl" in eventFiles: return False
+    # payments not yet resolved
+    paidnpubs = files.loadJsonFile(f"{basePath}paidnpubs.json", {})
+    for v in paidnpubs.values():
+        if v.get("payment_status") in unresolvedPaymentStatuses: return False
+    # recently changed
+    lastModified = max([os.path.getmtime(f"{basePath}{f}") for f in eventFiles], default=0)
+    if lastModified > time.time() - (getArchiveAfterDays() * 86400): return False
+    return True
+
+def setIndexArchived(npub, eventId, totals):
+    filename = f"{files.userEventsFolder}{npub}/index.json"
+    npubIndex = files.loadJsonFile(filename, [])
+    found = False
+    for entry in npubIndex:
+        if type(entry) is not dict or entry.get("eventId") != eventId: continue
+        found = True
+        if totals is None:
+            if "archived" in entry: del entry["archived"]
+        else:
+            entry["archived"] = totals
+    if not found and totals is not None:
+        _, diso = utils.getTimes()
+        npubIndex.append({"date_iso": diso, "eventId": eventId, "archived": totals})
+    files.saveJsonFile(filename, npubIndex)
+
+def archiveEvent(npub, eventId):
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    logger.info(f"Archiving event {eventId} for {npub}")
+    # final report before the state files are packed
+    reports.makeEventReport(npub, eventId)
+    totals = getEventTotals(npub, eventId)
+    _, totals["archived_at_iso"] = utils.getTimes()
+    utils.makeFolderIfNotExists(files.getArchivedEventsFolder(npub))
+    archiveFilename = files.getArchivedEventFilename(npub, eventId)
+    tempfile = f"{archiveFilename}.tmp"
+    with tarfile.open(tempfile, "w:gz") as tar:
+        for name in sorted(os.listdir(basePath)):
+            tar.add(f"{basePath}{name}", arcname=name)
+    shutil.move(tempfile, archiveFilename)
+    setIndexArchived(npub, eventId, totals)
+    shutil.rmtree(basePath)
+
+def readArchivedEventFile(npub, eventId, name, default=None):
+    archiveFilename = files.getArchivedEventFilename(npub, eventId)
+    if not os.path.exists(archiveFilename): return default
+    with tarfile.open(archiveFilename, "r:gz") as tar:
+        try:
+            f = tar.extractfile(name)
+        except KeyError:
+            return default
+        if f is None: return default
+        return files.decodeJson(f.read())
+
+def loadEventFile(npub, eventId, name, default=None):
+    # for lookups only, reading archived events without restoring them
+    if files.isEventArchived(npub, eventId): return readArchivedEventFile(npub, eventId, name, default)
+    return files.loadJsonFile(f"{files.userEventsFolder}{npub}/{eventId}/{name}", default)
+
+def restoreEvent(npub, eventId):
+    archiveFilename = files.getArchivedEventFilename(npub, eventId)
+    if not os.path.exists(archiveFilename): return False
+    logger.info(f"Restoring archived event {eventId} for {npub}")
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    utils.makeFolderIfNotExists(basePath)
+    with tarfile.open(archiveFilename, "r:gz") as tar:
+        for member in tar.getmembers():
+            if not member.isfile() or os.path.basename(member.name) != member.name: continue
+            with open(f"{basePath}{member.name}", "wb") as f:
+                f.write(tar.extractfile(member).read())
+    setIndexArchived(npub, eventId, None)
+    os.remove(archiveFilename)
+    return True
+
+def ensureEventAvailable(npub, eventId):
+    # events being monitored again or otherwise needed must be unpacked
+    if files.isEventArchived(npub, eventId): restoreEvent(npub, eventId)
+
+def compactEvents():
+    logger.debug("Checking for events to archive")
+    for npub in os.listdir(files.userEventsFolder):
+        if not npub.startswith("npub"): continue
+        npubConfig = files.loadJsonFile(f"{files.userConfigFolder}{npub}.json", {})
+        activeEventHex = None
+        if "eventId" in npubConfig and npubConfig["eventId"] is not None:
+            activeEventHex = utils.normalizeToHex(npubConfig["eventId"])
+        for eventId in files.getEventFolders(npub):
+            try:
+                if isEventCold(npub, eventId, activeEventHex): archiveEvent(npub, eventId)
+            except Exception as e:
+                logger.warning(f"Error archiving event {eventId} for {npub}: {str(e)}")
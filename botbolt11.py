@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import time
+
+logger = None
+
+# Decodes BOLT11 payment requests locally, verifying the signature, so that
+# invoices returned by LN URL Providers need not be sent to LND to decode.
+# The result uses the same field names as LND's /v1/payreq response.
+# Encoding and signing is provided for the mock servers used in testing.
+
+_bech32Charset = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+# secp256k1 curve parameters
+_P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+_N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+_G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+      0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+
+_multipliers = {"m": 100000000, "u": 100000, "n": 100, "p": None}
+
+def bech32Polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+def bech32HrpExpand(hrp):
+    return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
+
+def bech32Decode(bech):
+    # like bech32.bech32_decode, but without the 90 character limit which
+    # payment requests routinely exceed
+    if bech.lower() != bech and bech.upper() != bech: return None, None
+    bech = bech.lower()
+    pos = bech.rfind("1")
+    if pos < 1 or pos + 7 > len(bech): return None, None
+    if not all(x in _bech32Charset for x in bech[pos+1:]): return None, None
+    hrp = bech[:pos]
+    data = [_bech32Charset.find(x) for x in bech[pos+1:]]
+    if bech32Polymod(bech32HrpExpand(hrp) + data) != 1: return None, None
+    return hrp, data[:-6]
+
+def bech32Encode(hrp, data):
+    values = bech32HrpExpand(hrp) + data
+    polymod = bech32Polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + "1" + "".join([_bech32Charset[d] for d in data + checksum])
+
+def convertBits(data, frombits, tobits, pad=True):
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+    if pad and bits:
+        ret.append((acc << (tobits - bits)) & maxv)
+    return ret
+
+def wordsToInt(words):
+    value = 0
+    for word in words:
+        value = (value << 5) | word
+    return value
+
+def wordsToBytes(words):
+    # tagged field data is padded to whole bytes, the padding discarded
+    return bytes(convertBits(words, 5, 8, False))
+
+# Elliptic curve math using jacobian coordinates
+def _toJacobian(p):
+    return (p[0], p[1], 1)
+
+def _fromJacobian(p):
+    if p[2] == 0: return None
+    z = pow(p[2], -1, _P)
+    return ((p[0] * z * z) % _P, (p[1] * z * z * z) % _P)
+
+def _jacobianDouble(p):
+    if p[1] == 0: return (0, 0, 0)
+    ysq = (p[1] ** 2) % _P
+    s = (4 * p[0] * ysq) % _P
+    m = (3 * p[0] ** 2) % _P
+    nx = (m ** 2 - 2 * s) % _P
+    ny = (m * (s - nx) - 8 * ysq ** 2) % _P
+    nz = (2 * p[1] * p[2]) % _P
+    return (nx, ny, nz)
+
+def _jacobianAdd(p, q):
+    if p[2] == 0: return q
+    if q[2] == 0: return p
+    u1 = (p[0] * q[2] ** 2) % _P
+    u2 = (q[0] * p[2] ** 2) % _P
+    s1 = (p[1] * q[2] ** 3) % _P
+    s2 = (q[1] * p[2] ** 3) % _P
+    if u1 == u2:
+        if s1 != s2: return (0, 0, 0)
+        return _jacobianDouble(p)
+    h = u2 - u1
+    r = s2 - s1
+    h2 = (h * h) % _P
+    h3 = (h * h2) % _P
+    u1h2 = (u1 * h2) % _P
+    nx = (r ** 2 - h3 - 2 * u1h2) % _P
+    ny = (r * (u1h2 - nx) - s1 * h3) % _P
+    nz = (h * p[2] * q[2]) % _P
+    return (nx, ny, nz)
+
+def _jacobianMultiply(p, n):
+    result = (0, 0, 0)
+    addend = p
+    while n > 0:
+        if n & 1: result = _jacobianAdd(result, addend)
+        addend = _jacobianDouble(addend)
+        n >>= 1
+    return result
+
+def pointMultiply(p, n):
+    return _fromJacobian(_jacobianMultiply(_toJacobian(p), n % _N))
+
+def serializePubkey(point):
+    prefix = b"\x02" if point[1] % 2 == 0 else b"\x03"
+    return prefix + point[0].to_bytes(32, "big")
+
+def recoverPubkey(msgHash, signature, recoveryId):
+    r = int.from_bytes(signature[0:32], "big")
+    s = int.from_bytes(signature[32:64], "big")
+    if not (0 < r < _N and 0 < s < _N): return None
+    x = r + (recoveryId >> 1) * _N
+    if x >= _P: return None
+    alpha = (pow(x, 3, _P) + 7) % _P
+    beta = pow(alpha, (_P + 1) // 4, _P)
+    if (beta * beta) % _P != alpha: return None
+    y = beta if (beta % 2) == (recoveryId & 1) else _P - beta
+    z = int.from_bytes(msgHash, "big")
+    rInverse = pow(r, -1, _N)
+    sR = _jacobianMultiply((x, y, 1), (s * rInverse) % _N)
+    zG = _jacobianMultiply(_toJacobian(_G), ((_N - z) * rInverse) % _N)
+    q = _fromJacobian(_jacobianAdd(sR, zG))
+    if q is None: return None
+    return serializePubkey(q)
+
+def signRecoverable(msgHash, privateKey):
+    # returns 64 byte compact signature and recovery id, with low s
+    d = int.from_bytes(privateKey, "big")
+    z = int.from_bytes(msgHash, "big")
+    while True:
+        k = int.from_bytes(os.urandom(32), "big") % _N
+        if k == 0: continue
+        point = pointMultiply(_G, k)
+        r = point[0] % _N
+        if r == 0: continue
+        s = (pow(k, -1, _N) * (z + r * d)) % _N
+        if s == 0: continue
+        recoveryId = (point[1] & 1) | (2 if point[0] >= _N else 0)
+        if s > _N // 2:
+            s = _N - s
+            recoveryId ^= 1
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big"), recoveryId
+
+def getPubkey(privateKey):
+    return serializePubkey(pointMultiply(_G, int.from_bytes(privateKey, "big")))
+
+def encodeAmount(amountMsat):
+    if amountMsat % 100 == 0: return f"{amountMsat // 100}n"
+    return f"{amountMsat * 10}p"
+
+def encodeTaggedField(tag, data):
+    words = convertBits(data, 8, 5, True) if type(data) is bytes else data
+    return [_bech32Charset.find(tag), len(words) >> 5, len(words) & 31] + words
+
+def encodeInt(value):
+    words = []
+    while value > 0:
+        words.insert(0, value & 31)
+        value >>= 5
+    return words if len(words) > 0 else [0]
+
+def encodeInvoice(privateKey, paymentHash, amountMsat=None, description=None, descriptionHash=None,
+                  expiry=3600, timestamp=None, paymentSecret=None, prefix="lnbcrt"):
+    # paymentHash, descriptionHash and paymentSecret are bytes
+    hrp = prefix + (encodeAmount(amountMsat) if amountMsat is not None else "")
+    if timestamp is None: timestamp = int(time.time())
+    data = [(timestamp >> (5 * (6 - i))) & 31 for i in range(7)]
+    data += encodeTaggedField("p", paymentHash)
+    if paymentSecret is not None: data += encodeTaggedField("s", paymentSecret)
+    if descriptionHash is not None:
+        data += encodeTaggedField("h", descriptionHash)
+    else:
+        data += encodeTaggedField("d", (description or "").encode("utf-8"))
+    data += encodeTaggedField("x", encodeInt(expiry))
+    data += encodeTaggedField("c", encodeInt(18))
+    msgHash = hashlib.sha256(hrp.encode() + bytes(convertBits(data, 5, 8, True))).digest()
+    signature, recoveryId = signRecoverable(msgHash, privateKey)
+    data += convertBits(signature + bytes([recoveryId]), 8, 5, True)
+    return bech32Encode(hrp, data)
+
+def parseAmountMsat(hrp):
+    # hrp is ln + currency prefix + optional amount and multiplier
+    amountPart = hrp[2:].lstrip("abcdefghijklmnopqrstuvwxyz")
+    if len(amountPart) == 0: return None
+    multiplier = amountPart[-1]
+    if multiplier in _multipliers:
+        amountPart = amountPart[:-1]
+    else:
+        multiplier = None
+    if not amountPart.isdigit(): raise ValueError(f"Invalid amount in {hrp}")
+    amount = int(amountPart)
+    if multiplier is None: return amount * 100000000000
+    if multiplier == "p":
+        if amount % 10 != 0: raise ValueError(f"Invalid pico amount in {hrp}")
+        return amount // 10
+    return amount * _multipliers[multiplier]
+
+def decodeInvoice(paymentRequest):
+    try:
+        return _decodeInvoice(paymentRequest)
+    except Exception as e:
+        logger.warning(f"Unable to decode invoice: {str(e)}")
+        return None
+
+def _decodeInvoice(paymentRequest):
+    paymentRequest = str(paymentRequest).strip()
+    if paymentRequest.lower().startswith("lightning:"): paymentRequest = paymentRequest[10:]
+    hrp, data = bech32Decode(paymentRequest)
+    if hrp is None: raise ValueError("Invalid bech32 encoding or checksum")
+    if not hrp.startswith("ln"): raise ValueError(f"Unexpected prefix {hrp}")
+    if len(data) < 7 + 104: raise ValueError("Payment request is too short")
+    sigWords = data[-104:]
+    data = data[:-104]
+    signature = wordsToBytes(sigWords)
+    msgHash = hashlib.sha256(hrp.encode() + bytes(convertBits(data, 5, 8, True))).digest()
+    amountMsat = parseAmountMsat(hrp)
+    decoded = {
+        "timestamp": str(wordsToInt(data[0:7])),
+        "expiry": "3600",
+        "cltv_expiry": "18",
+        "description": "",
+        "description_hash": "",
+        }
+    pos = 7
+    while pos + 3 <= len(data):
+        tag = _bech32Charset[data[pos]]
+        length = (data[pos+1] << 5) | data[pos+2]
+        fieldWords = data[pos+3:pos+3+length]
+        pos += 3 + length
+        if tag == "p" and length == 52:
+            decoded["payment_hash"] = wordsToBytes(fieldWords).hex()
+        elif tag == "s" and length == 52:
+            decoded["payment_addr"] = wordsToBytes(fieldWords).hex()
+        elif tag == "d":
+            decoded["description"] = wordsToBytes(fieldWords).decode("utf-8")
+        elif tag == "h" and length == 52:
+            decoded["description_hash"] = wordsToBytes(fieldWords).hex()
+        elif tag == "x":
+            decoded["expiry"] = str(wordsToInt(fieldWords))
+        elif tag == "c":
+            decoded["cltv_expiry"] = str(wordsToInt(fieldWords))
+        elif tag == "n" and length == 53:
+            decoded["destination"] = wordsToBytes(fieldWords).hex()
+    if "payment_hash" not in decoded: raise ValueError("Payment hash not present")
+    # verify signature, recovering the payee if not explicitly provided
+    recovered = recoverPubkey(msgHash, signature[0:64], signature[64])
+    if recovered is None: raise ValueError("Invalid signature")
+    if "destination" in decoded:
+        if recovered.hex() != decoded["destination"]: raise ValueError("Signature does not match payee")
+    else:
+        decoded["destination"] = recovered.hex()
+    if amountMsat is not None:
+        decoded["num_msat"] = str(amountMsat)
+        decoded["num_satoshis"] = str(amountMsat // 1000)
+    return decoded
+
+def isValidDescriptionHash(decodedInvoice, description):
+    # For zaps, the description hash must be the sha256 of the zap request
+    # json as given to the LN URL Provider
+    if decodedInvoice is None or "description_hash" not in decodedInvoice: return False
+    expectedHash = hashlib.sha256(description.encode("utf-8")).hexdigest()
+    return decodedInvoice["description_hash"] == expectedHash
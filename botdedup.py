@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+import base64
+import hashlib
+import math
+
+# A store of keys seen within a window of time, using constant memory however
+# long the bot runs. Keys are kept in two bloom filters, each covering
+# windowSeconds of the times given with the keys, with the older dropped as
+# a newer one is started. The most recent keys are also kept exactly in a
+# ring, so that keys newer than any dropped from the ring are never mistaken
+# for ones seen. Only keys older than that rely on the bloom filters, which
+# may report a key as seen that was not, at falsePositiveRate. Keys older
+# than the oldest generation kept may have been forgotten, so callers must
+# check isExpired and treat such keys as seen.
+
+def makeDedupStore(windowSeconds, expectedKeys=10000, falsePositiveRate=0.0001, ringSize=1000):
+    # expectedKeys is the most keys expected within windowSeconds
+    bits = int(math.ceil(-expectedKeys * math.log(falsePositiveRate) / (math.log(2) ** 2)))
+    bits += -bits % 8
+    hashes = max(1, int(round(bits / expectedKeys * math.log(2))))
+    return {"windowSeconds": windowSeconds, "bits": bits, "hashes": hashes, "ringSize": ringSize,
+            "generations": [], "ring": OrderedDict(), "ringFloor": 0, "expiredBefore": 0}
+
+def getBitPositions(store, key):
+    digest = hashlib.sha256(str(key).encode()).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:16], "big") | 1
+    return [(h1 + i * h2) % store["bits"] for i in range(store["hashes"])]
+
+def isExpired(store, createdAt):
+    # whether keys from the time may have been dropped with an older generation
+    return createdAt < store["expiredBefore"]
+
+def hasKey(store, key, createdAt):
+    if key in store["ring"]: return True
+    # the ring holds every key newer than the newest it has dropped
+    if createdAt > store["ringFloor"]: return False
+    positions = getBitPositions(store, key)
+    for generation in store["generations"]:
+        bloom = generation["bloom"]
+        if all(bloom[p >> 3] & (1 << (p & 7)) for p in positions): return True
+    return False
+
+def addKey(store, key, createdAt):
+    generations = store["generations"]
+    if len(generations) == 0 or createdAt >= generations[-1]["start"] + store["windowSeconds"]:
+        generations.append({"start": createdAt, "bloom": bytearray(store["bits"] // 8)})
+        if len(generations) > 2:
+            generations.pop(0)
+            store["expiredBefore"] = generations[0]["start"]
+    bloom = generations[-1]["bloom"]
+    for p in getBitPositions(store, key):
+        bloom[p >> 3] |= 1 << (p & 7)
+    ring = store["ring"]
+    ring[key] = createdAt
+    ring.move_to_end(key)
+    while len(ring) > store["ringSize"]:
+        _, droppedAt = ring.popitem(last=False)
+        store["ringFloor"] = max(store["ringFloor"], droppedAt)
+
+def dedupStoreToJson(store):
+    return {"windowSeconds": store["windowSeconds"], "bits": store["bits"], "hashes": store["hashes"],
+            "ringSize": store["ringSize"], "ringFloor": store["ringFloor"], "ring": list(store["ring"].items()),
+            "expiredBefore": store["expiredBefore"],
+            "generations": [{"start": g["start"], "bloom": base64.b64encode(g["bloom"]).decode()} for g in store["generations"]]}
+
+def dedupStoreFromJson(obj):
+    store = {"windowSeconds": obj["windowSeconds"], "bits": obj["bits"], "hashes": obj["hashes"],
+             "ringSize": obj["ringSize"], "ringFloor": obj["ringFloor"], "ring": OrderedDict(obj["ring"]),
+             "expiredBefore": obj.get("expiredBefore", 0),
+             "generations": [{"start": g["start"], "bloom": bytearray(base64.b64decode(g["bloom"]))} for g in obj["generations"]]}
+    return store
@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
+from collections import OrderedDict
+import gzip
 import json
 import os
+import pickle
 import shutil
+import threading
 import botutils as utils
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = None       # set by calling setLogger
+config = {}         # optional files section of server config
 
 # Make common folders if not already present
 dataFolder = "data/"
@@ -20,18 +33,128 @@ utils.makeFolderIfNotExists(userLedgerFolder)
 utils.makeFolderIfNotExists(userReportsFolder)
 utils.makeFolderIfNotExists(logFolder)
 
+jsonBackends = ["orjson", "json"] if orjson is not None else ["json"]
+
+def getJsonBackend():
+    backend = config["jsonBackend"] if "jsonBackend" in config else None
+    if backend not in jsonBackends: backend = jsonBackends[0]
+    return backend
+
+def isPrettyJson():
+    return bool(config["prettyJson"]) if "prettyJson" in config else False
+
+def encodeJson(obj, pretty=None, backend=None):
+    if pretty is None: pretty = isPrettyJson()
+    if backend is None: backend = getJsonBackend()
+    if backend == "orjson":
+        try:
+            return orjson.dumps(obj, option=(orjson.OPT_INDENT_2 if pretty else 0))
+        except TypeError:
+            # non string keys, integers beyond 64 bit and the like
+            pass
+    if pretty:
+        return json.dumps(obj=obj,indent=2).encode()
+    return json.dumps(obj=obj,separators=(",",":")).encode()
+
+def decodeJson(data, backend=None):
+    if backend is None: backend = getJsonBackend()
+    if backend == "orjson":
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # integers beyond 64 bit, as json may have written before orjson
+            # was used, and the like
+            pass
+    return json.loads(data)
+
+# Compression is determined by the filename suffix so that compressed and
+# plain files can coexist
+def compressData(filename, data):
+    if filename.endswith(".gz"):
+        return gzip.compress(data)
+    if filename.endswith(".zst"):
+        if zstandard is None: raise Exception(f"zstandard package required to write {filename}")
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+def decompressData(filename, data):
+    if filename.endswith(".gz"):
+        return gzip.decompress(data)
+    if filename.endswith(".zst"):
+        if zstandard is None: raise Exception(f"zstandard package required to read {filename}")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+def getColdDataFilename(filename):
+    # Data that is rarely read again (e.g. rotated ledgers, archived events)
+    # may optionally be compressed by setting coldCompression to gzip or zstd
+    coldCompression = config["coldCompression"] if "coldCompression" in config else None
+    if coldCompression == "gzip": return f"{filename}.gz"
+    if coldCompression == "zstd" and zstandard is not None: return f"{filename}.zst"
+    return filename
+
+# Parsed files are cached, keyed by filename and validated against the
+# modification time, size and inode of the file. Entries are held pickled so
+# that each caller gets its own copy to modify, which is cheaper than parsing
+_parseCache = OrderedDict()     # filename -> (mtime_ns, size, inode, pickled)
+_parseCacheBytes = 0
+_parseCacheLock = threading.Lock()
+
+def getParseCacheBudget():
+    # bytes of pickled data to retain, least recently used evicted first
+    return int(config["parseCacheBytes"]) if "parseCacheBytes" in config else 32 * 1024 * 1024
+
+def forgetParsedFile(filename):
+    global _parseCacheBytes
+    with _parseCacheLock:
+        if filename in _parseCache:
+            _parseCacheBytes -= len(_parseCache[filename][3])
+            del _parseCache[filename]
+
+def rememberParsedFile(filename, fileStat, obj):
+    global _parseCacheBytes
+    budget = getParseCacheBudget()
+    if budget <= 0: return
+    pickled = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(pickled) > budget / 4: return
+    forgetParsedFile(filename)
+    with _parseCacheLock:
+        _parseCache[filename] = (fileStat.st_mtime_ns, fileStat.st_size, fileStat.st_ino, pickled)
+        _parseCacheBytes += len(pickled)
+        while _parseCacheBytes > budget and len(_parseCache) > 0:
+            _, evicted = _parseCache.popitem(last=False)
+            _parseCacheBytes -= len(evicted[3])
+
+def getParsedFile(filename, fileStat):
+    with _parseCacheLock:
+        if filename not in _parseCache: return None
+        mtime_ns, size, inode, pickled = _parseCache[filename]
+        if (mtime_ns, size, inode) != (fileStat.st_mtime_ns, fileStat.st_size, fileStat.st_ino): return None
+        _parseCache.move_to_end(filename)
+    return pickle.loads(pickled)
+
 def loadJsonFile(filename, default=None):
     if filename is None: return default
-    if not os.path.exists(filename): return default
-    with open(filename) as f:
-        return(json.load(f))
+    try:
+        fileStat = os.stat(filename)
+    except FileNotFoundError:
+        return default
+    obj = getParsedFile(filename, fileStat)
+    if obj is not None: return obj
+    with open(filename, "rb") as f:
+        data = f.read()
+    obj = decodeJson(decompressData(filename, data))
+    rememberParsedFile(filename, fileStat, obj)
+    return obj
 
-def saveJsonFile(filename, obj):
+def saveJsonFile(filename, obj, pretty=None):
+    data = compressData(filename, encodeJson(obj, pretty))
     # first as temp file
     tempfile = f"{filename}.tmp"
-    with open(tempfile, "w") as f:
-        f.write(json.dumps(obj=obj,indent=2))
+    with open(tempfile, "wb") as f:
+        f.write(data)
     # then move over top
+    forgetParsedFile(filename)
     shutil.move(tempfile, filename)
 
 def getConfig(filename):
@@ -52,4 +175,21 @@ def saveInvoices(outstandingInvoices):
     saveJsonFile(filename, outstandingInvoices)
 
 def listUserConfigs():
-    return os.listdir(userConfigFolder)
\ No newline at end of file
+    return os.listdir(userConfigFolder)
+
+# Events that are archived are packed into a file each in the archived folder
+# of the npub, alongside the folders of the events that are not
+def getArchivedEventsFolder(npub):
+    return f"{userEventsFolder}{npub}/archived/"
+
+def getArchivedEventFilename(npub, eventId):
+    return f"{getArchivedEventsFolder(npub)}{eventId}.tar.gz"
+
+def isEventArchived(npub, eventId):
+    return os.path.exists(getArchivedEventFilename(npub, eventId))
+
+def getEventFolders(npub):
+    # event folders for the npub, excluding the archive
+    path = f"{userEventsFolder}{npub}"
+    if not os.path.isdir(path): return []
+    return [e for e in os.listdir(path) if e != "archived" and os.path.isdir(os.path.join(path, e))]
\ No newline at end of file
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import json
+import os
+import botfiles as files
+import botledger as ledger
+
+logger = None
+
+# Payment outcomes for an event are appended to a journal as a single record
+# instead of rewriting the responses, paidnpubs, paidluds, ledger and config
+# files after every zap. The journal is checkpointed into those files at the
+# end of a batch, and replayed on startup if the bot stopped before then.
+# The event balance is kept in the npub's config, so is set by the
+# setEventBalance(npub, eventBalance) callback given by the caller.
+#
+# record fields
+#   id              unique identifier for the record, used as the ledger ref
+#   responses       response event ids handled since the prior record
+#   pubkey          the pubkey paid, if a payment was made
+#   lightningId     the lightning address paid, if a payment was made
+#   paidnpub        the entry to set in paidnpubs.json for pubkey
+#   paidlud         the entry to set in paidluds.json for lightningId
+#   ledger          list of ledger entries (type, credits, mcredits, description)
+#   eventBalance    the event balance after this record
+
+_pendingJournals = {}       # journal filename -> (npub, eventId)
+
+def getJournalFilename(npub, eventId):
+    return f"{files.userEventsFolder}{npub}/{eventId}/journal.jsonl"
+
+def appendRecord(npub, eventId, record):
+    filename = getJournalFilename(npub, eventId)
+    record["id"] = os.urandom(8).hex()
+    with open(filename, "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    _pendingJournals[filename] = (npub, eventId)
+
+def readRecords(filename):
+    records = []
+    appliedLedger = []
+    if not os.path.exists(filename): return records, appliedLedger
+    with open(filename) as f:
+        for line in f:
+            if len(line.strip()) == 0: continue
+            try:
+                record = json.loads(line)
+            except Exception as e:
+                # a partial line from an interrupted append
+                logger.warning(f"Ignoring incomplete journal record in {filename}")
+                continue
+            if record.get("type") == "LEDGER APPLIED":
+                appliedLedger.extend(record["ids"])
+            else:
+                records.append(record)
+    return records, appliedLedger
+
+def checkpoint(npub, eventId, setEventBalance):
+    filename = getJournalFilename(npub, eventId)
+    if filename in _pendingJournals: del _pendingJournals[filename]
+    records, appliedLedger = readRecords(filename)
+    if len(records) == 0:
+        if os.path.exists(filename): os.remove(filename)
+        return
+    logger.debug(f"Checkpointing {len(records)} journal records for {npub} event {eventId}")
+    # ledger entries first, in one write, each carrying its record id as a ref
+    # so that a replay after an interrupted checkpoint does not double charge.
+    # The ledger is only rotated once they are marked applied, as rotating
+    # moves the refs out of the ledger a replay checks
+    ledgerEntries = []
+    for record in records:
+        if record["id"] in appliedLedger: continue
+        for i, entry in enumerate(record.get("ledger", [])):
+            ledgerEntry = dict(entry)
+            ledgerEntry["ref"] = f"{eventId}:{record['id']}:{i}"
+            ledgerEntries.append(ledgerEntry)
+    if len(ledgerEntries) > 0:
+        ledger.recordEntries(npub, ledgerEntries, rotate=False)
+        with open(filename, "a") as f:
+            # leading newline in case the journal ends with a partial record
+            f.write("\n" + json.dumps({"type": "LEDGER APPLIED", "ids": [r["id"] for r in records]}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        ledger.rotateLedgerIfNeeded(npub)
+    # state files are idempotent to apply
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    fileResponses = f"{basePath}responses.json"
+    filePaidNpubs = f"{basePath}paidnpubs.json"
+    filePaidLuds = f"{basePath}paidluds.json"
+    responses = files.loadJsonFile(fileResponses, [])
+    paidnpubs = files.loadJsonFile(filePaidNpubs, {})
+    paidluds = files.loadJsonFile(filePaidLuds, {})
+    eventBalance = None
+    for record in records:
+        for responseId in record.get("responses", []):
+            if responseId not in responses: responses.append(responseId)
+        if "paidnpub" in record: paidnpubs[record["pubkey"]] = record["paidnpub"]
+        if "paidlud" in record: paidluds[record["lightningId"]] = record["paidlud"]
+        if "eventBalance" in record: eventBalance = record["eventBalance"]
+    files.saveJsonFile(fileResponses, responses)
+    files.saveJsonFile(filePaidNpubs, paidnpubs)
+    files.saveJsonFile(filePaidLuds, paidluds)
+    if eventBalance is not None:
+        setEventBalance(npub, eventBalance)
+    os.remove(filename)
+
+def checkpointAll(setEventBalance):
+    for npub, eventId in list(_pendingJournals.values()):
+        checkpoint(npub, eventId, setEventBalance)
+
+def recoverJournals(setEventBalance):
+    # replay any journals left behind by a prior run
+    if not os.path.exists(files.userEventsFolder): return
+    for npub in os.listdir(files.userEventsFolder):
+        npubFolder = f"{files.userEventsFolder}{npub}"
+        if not os.path.isdir(npubFolder): continue
+        for eventId in os.listdir(npubFolder):
+            if not os.path.exists(getJournalFilename(npub, eventId)): continue
+            logger.info(f"Recovering payment journal for {npub} event {eventId}")
+            checkpoint(npub, eventId, setEventBalance)
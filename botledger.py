@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
+import datetime
+import glob
+import os
 import botfiles as files
 import botutils as utils
 
+carryOverDescription = "Carry over from ledger rotation"
+maxLedgerEntries = 500
+
 def getUserLedgerFilename(npub):
     filename = f"{files.userLedgerFolder}{npub}.ledger.json"
     return filename
 
+def getArchivedLedgerFolder():
+    archivedLedgerFolder = f"{files.userLedgerFolder}archived/"
+    utils.makeFolderIfNotExists(archivedLedgerFolder)
+    return archivedLedgerFolder
+
+def getLedgerManifestFilename(npub):
+    filename = f"{files.userLedgerFolder}{npub}.manifest.json"
+    return filename
+
 def getCreditBalance(npub):
     filename = getUserLedgerFilename(npub)
     ledger = files.loadJsonFile(filename)
@@ -14,6 +29,13 @@ def getCreditBalance(npub):
     return balance
 
 def recordEntry(npub, type, credits, mcredits, description):
+    return recordEntries(npub, [{"type": type, "credits": credits, "mcredits": mcredits, "description": description}])
+
+# Records several entries with a single write of the ledger. Entries having
+# a ref that is already present in the ledger are skipped, allowing a batch
+# to be safely replayed. Rotation moves refs out of the ledger, so callers
+# replaying by ref pass rotate=False and rotate once the batch is marked done
+def recordEntries(npub, entries, rotate=True):
     filename = getUserLedgerFilename(npub)
     ledger = files.loadJsonFile(filename)
     if ledger is None: 
@@ -34,36 +56,47 @@ def recordEntry(npub, type, credits, mcredits, description):
     else:
         # get current balance from existing, last record
         balance = ledger[-1]["balance"]
-    # Determine new balance based on amounts passed in
-    balance += credits
-    balance += (mcredits/1000)
-    # Add the new entry
-    created_at, created_at_iso = utils.getTimes()
-    newEntry = {
-        "created_at": created_at,
-        "created_at_iso": created_at_iso,
-        "type": type,
-        "credits": credits,
-        "mcredits": mcredits,
-        "balance": balance,
-        "description": description,
-        }
-    ledger.append(newEntry)
+    refs = [e["ref"] for e in ledger if "ref" in e]
+    for entry in entries:
+        if "ref" in entry and entry["ref"] in refs: continue
+        # Determine new balance based on amounts passed in
+        balance += entry["credits"]
+        balance += (entry["mcredits"]/1000)
+        # Add the new entry
+        created_at, created_at_iso = utils.getTimes()
+        newEntry = {
+            "created_at": created_at,
+            "created_at_iso": created_at_iso,
+            "type": entry["type"],
+            "credits": entry["credits"],
+            "mcredits": entry["mcredits"],
+            "balance": balance,
+            "description": entry["description"],
+            }
+        if "ref" in entry: newEntry["ref"] = entry["ref"]
+        ledger.append(newEntry)
     # Save to disk
     files.saveJsonFile(filename, ledger)
     # Rotate if needed
-    if len(ledger) > 500:
-        rotateLedger(npub, ledger)
+    if rotate: rotateLedgerIfNeeded(npub, ledger)
     # return new balance
     return balance
 
+def rotateLedgerIfNeeded(npub, ledger=None):
+    if ledger is None: ledger = files.loadJsonFile(getUserLedgerFilename(npub), [])
+    if len(ledger) > maxLedgerEntries:
+        rotateLedger(npub, ledger)
+
 def rotateLedger(npub, ledger):
     # first save current contents to the archive
-    archivedLedgerFolder = f"{files.userLedgerFolder}archived/"
-    utils.makeFolderIfNotExists(archivedLedgerFolder)
+    archivedLedgerFolder = getArchivedLedgerFolder()
     t, tISO = utils.getTimes()
-    archivedFilename = f"{archivedLedgerFolder}{npub}.{t}.ledger.json"
+    archivedFilename = files.getColdDataFilename(f"{archivedLedgerFolder}{npub}.{t}.ledger.json")
     files.saveJsonFile(archivedFilename, ledger)
+    # record the segment in the manifest so it need not be read again
+    ledgerManifest = getLedgerManifest(npub)
+    addLedgerSegment(ledgerManifest, archivedFilename, ledger)
+    files.saveJsonFile(getLedgerManifestFilename(npub), ledgerManifest)
     # now get balance
     ledgerSummary = {
         "CREDITS APPLIED": {"credits": 0, "mcredits": 0},
@@ -91,9 +124,112 @@ def rotateLedger(npub, ledger):
             "credits": ledgerSummaryItem["credits"],
             "mcredits": ledgerSummaryItem["mcredits"],
             "balance": balance,
-            "description": "Carry over from ledger rotation",
+            "description": carryOverDescription,
             })
     filename = getUserLedgerFilename(npub)
     files.saveJsonFile(filename, newLedger)
-    
-    
+
+def getEventIdFromDescription(description):
+    if "for reply to" not in description: return None
+    return str(description.split("for reply to")[1]).strip()
+
+def summarizeLedgerEntries(ledger, since=None, until=None):
+    # Aggregates entries by day, and by type within the day. Carry over entries
+    # are skipped as they only repeat totals from the prior segment
+    days = {}
+    for ledgerEntry in ledger:
+        if type(ledgerEntry) is not dict: continue
+        if not all(k in ledgerEntry for k in ("created_at","created_at_iso","type","credits","mcredits")): continue
+        if ledgerEntry.get("description") == carryOverDescription: continue
+        created_at = ledgerEntry["created_at"]
+        if since is not None and created_at < since: continue
+        if until is not None and created_at > until: continue
+        diso = ledgerEntry["created_at_iso"][0:10]
+        day = days[diso] if diso in days else {"totals": {}, "events": []}
+        entryType = ledgerEntry["type"]
+        totals = day["totals"][entryType] if entryType in day["totals"] else {"qty": 0, "credits": 0, "mcredits": 0}
+        totals["qty"] = totals["qty"] + 1
+        totals["credits"] = totals["credits"] + ledgerEntry["credits"]
+        totals["mcredits"] = totals["mcredits"] + ledgerEntry["mcredits"]
+        day["totals"][entryType] = totals
+        eventId = getEventIdFromDescription(str(ledgerEntry.get("description", "")))
+        if eventId is not None and eventId not in day["events"]: day["events"].append(eventId)
+        days[diso] = day
+    return days
+
+def addLedgerSegment(ledgerManifest, segmentFilename, ledger):
+    segmentName = os.path.basename(segmentFilename)
+    for segment in ledgerManifest["segments"]:
+        if segment["filename"] == segmentName: return
+    entries = [e for e in ledger if type(e) is dict and e.get("description") != carryOverDescription and "created_at" in e]
+    segment = {
+        "filename": segmentName,
+        "entries": len(entries),
+        "start": entries[0]["created_at"] if len(entries) > 0 else None,
+        "start_iso": entries[0]["created_at_iso"] if len(entries) > 0 else None,
+        "end": entries[-1]["created_at"] if len(entries) > 0 else None,
+        "end_iso": entries[-1]["created_at_iso"] if len(entries) > 0 else None,
+        "balance": ledger[-1]["balance"] if len(ledger) > 0 else 0,
+        "days": summarizeLedgerEntries(entries),
+    }
+    segment["totals"] = {}
+    for day in segment["days"].values():
+        mergeLedgerTotals(segment["totals"], day["totals"])
+    ledgerManifest["segments"].append(segment)
+    ledgerManifest["segments"].sort(key=lambda x: x["filename"])
+
+def mergeLedgerTotals(target, source):
+    for entryType, totals in source.items():
+        current = target[entryType] if entryType in target else {"qty": 0, "credits": 0, "mcredits": 0}
+        for k in ("qty","credits","mcredits"):
+            current[k] = current[k] + totals[k]
+        target[entryType] = current
+
+def getLedgerManifest(npub):
+    filename = getLedgerManifestFilename(npub)
+    ledgerManifest = files.loadJsonFile(filename, {"segments": []})
+    # index any archived segments not yet in the manifest (e.g. from before the
+    # manifest existed). each is only read once
+    known = [segment["filename"] for segment in ledgerManifest["segments"]]
+    archiveFiles = []
+    for suffix in ("", ".gz", ".zst"):
+        archiveFiles.extend(glob.glob(f"{getArchivedLedgerFolder()}{npub}.*.ledger.json{suffix}"))
+    changed = False
+    for archiveFilename in sorted(archiveFiles):
+        if os.path.basename(archiveFilename) in known: continue
+        addLedgerSegment(ledgerManifest, archiveFilename, files.loadJsonFile(archiveFilename, []))
+        changed = True
+    if changed: files.saveJsonFile(filename, ledgerManifest)
+    return ledgerManifest
+
+def getLedgerSegmentFilenames(npub):
+    archivedLedgerFolder = getArchivedLedgerFolder()
+    ledgerManifest = getLedgerManifest(npub)
+    return [f"{archivedLedgerFolder}{segment['filename']}" for segment in ledgerManifest["segments"]]
+
+def getLedgerSummary(npub, since=None, until=None, includeArchived=True):
+    # Totals by type for a time range, answered from the manifest for archived
+    # segments and from the current ledger for entries since the last rotation
+    sinceDay = None if since is None else datetime.datetime.utcfromtimestamp(since).isoformat()[0:10]
+    untilDay = None if until is None else datetime.datetime.utcfromtimestamp(until).isoformat()[0:10]
+    summary = {"totals": {}, "events": [], "first_iso": None}
+    days = []
+    if includeArchived:
+        for segment in getLedgerManifest(npub)["segments"]:
+            if since is not None and segment["end"] is not None and segment["end"] < since: continue
+            if until is not None and segment["start"] is not None and segment["start"] > until: continue
+            days.extend(sorted(segment["days"].items()))
+    ledger = files.loadJsonFile(getUserLedgerFilename(npub), [])
+    days.extend(sorted(summarizeLedgerEntries(ledger, since, until).items()))
+    for diso, day in days:
+        # archived days are whole days, so range limits are applied by day
+        if sinceDay is not None and diso < sinceDay: continue
+        if untilDay is not None and diso > untilDay: continue
+        if summary["first_iso"] is None: summary["first_iso"] = diso
+        mergeLedgerTotals(summary["totals"], day["totals"])
+        for eventId in day["events"]:
+            if eventId not in summary["events"]: summary["events"].append(eventId)
+    if not includeArchived and len(ledger) > 0:
+        # report from the time of the rotation rather than first activity
+        summary["first_iso"] = ledger[0]["created_at_iso"]
+    return summary
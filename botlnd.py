@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
 from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
 import base64
+import datetime
 import json
 import os
+import queue
 import requests
+import threading
+import time
 import urllib
+import botbolt11 as bolt11
 import botfiles as files
 import botnostr as nostr
 import botutils as utils
@@ -15,19 +23,68 @@ requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
 logger = None
 config = None
-activeConfig = None
+
+# Node pool
+#
+# Payments are spread across the LND servers named in poolServers, by
+# default only the activeServer. Each thread calls the server selected with
+# usingLNDServer, or the activeServer if none was selected. Lookups of an
+# invoice or payment use the server recorded when it was created.
+
+_serverConfigs = {}             # effective configuration by server id
+_selected = threading.local()   # server selected for calls on this thread
+_nodeStats = {}                 # server id -> health, latency and liquidity
+_nodeStatsLock = threading.Lock()
+
+def getDefaultServerId():
+    if "activeServer" not in config or config["activeServer"] is None: return None
+    if "servers" not in config or config["activeServer"] not in config["servers"]: return None
+    return config["activeServer"]
+
+def getPoolServerIds():
+    servers = config["servers"] if "servers" in config and config["servers"] is not None else {}
+    poolServers = config["poolServers"] if "poolServers" in config and config["poolServers"] is not None else []
+    serverIds = [serverId for serverId in poolServers if serverId in servers]
+    if len(serverIds) == 0: serverIds = [getDefaultServerId()]
+    return serverIds
+
+def getFollowedServerIds():
+    # servers whose invoice and payment streams are followed
+    serverIds = getPoolServerIds()
+    if getDefaultServerId() not in serverIds: serverIds.append(getDefaultServerId())
+    return serverIds
+
+def getRecordedServerId(entry, fieldName):
+    # entries made before a server was recorded belong to the active server
+    if fieldName in entry and entry[fieldName] is not None: return entry[fieldName]
+    return getDefaultServerId()
+
+def getLNDServerId():
+    return getattr(_selected, "serverId", getDefaultServerId())
+
+def selectLNDServer(serverId):
+    # for threads dedicated to a single server
+    _selected.serverId = serverId
+
+@contextmanager
+def usingLNDServer(serverId):
+    previous = getattr(_selected, "serverId", getDefaultServerId())
+    _selected.serverId = serverId
+    try:
+        yield
+    finally:
+        _selected.serverId = previous
 
 def getLNDServerConfig():
-    global activeConfig
-    if activeConfig is not None: return activeConfig
-    if not all(k in config for k in ("activeServer","servers")): activeConfig = dict(config); return activeConfig
-    activeServerId = config["activeServer"]
-    if activeServerId is None: activeConfig = dict(config); return activeConfig
-    servers = config["servers"]
-    if activeServerId not in servers: activeConfig = dict(config); return activeConfig
-    activeServer = servers[activeServerId]
-    if all(k in activeServer for k in ("address","port","macaroon")): activeConfig = dict(activeServer); return activeConfig
-    return config
+    # values for a server in the servers object override those at the top level
+    serverId = getLNDServerId()
+    if serverId in _serverConfigs: return _serverConfigs[serverId]
+    serverConfig = {k: v for k, v in config.items() if k not in ("activeServer","servers","poolServers")}
+    servers = config["servers"] if "servers" in config and config["servers"] is not None else {}
+    if serverId in servers and all(k in servers[serverId] for k in ("address","port","macaroon")):
+        serverConfig.update(servers[serverId])
+    _serverConfigs[serverId] = serverConfig
+    return serverConfig
 
 def getLNDUrl(suffix):
     lndServerConfig = getLNDServerConfig()
@@ -41,7 +98,6 @@ def getLNDHeaders():
     serverMacaroon = lndServerConfig["macaroon"]
     headers = {
         "Grpc-Metadata-macaroon": serverMacaroon,
-        "Connection": "close"
         }
     return headers
 
@@ -53,6 +109,14 @@ def getLNDTimeouts():
     if "readTimeout" in lndServerConfig: readTimeout = lndServerConfig["readTimeout"]
     return (connectTimeout, readTimeout)
 
+def getFeeLimit():
+    lndServerConfig = getLNDServerConfig()
+    return lndServerConfig["feeLimit"] if "feeLimit" in lndServerConfig else 2
+
+def getMaxConcurrentPayments():
+    lndServerConfig = getLNDServerConfig()
+    return lndServerConfig["maxConcurrentPayments"] if "maxConcurrentPayments" in lndServerConfig else 4
+
 def getLNDProxies():
     lndServerConfig = getLNDServerConfig()
     if str(lndServerConfig["address"]).endswith(".onion"):
@@ -60,14 +124,147 @@ def getLNDProxies():
     else:
         return {}
 
+_sessions = {}          # keep-alive sessions by LND server address
+_sessionsLock = threading.Lock()
+
+def getLNDSessionKey():
+    lndServerConfig = getLNDServerConfig()
+    return f"{lndServerConfig['address']}:{lndServerConfig['port']}"
+
+def getLNDSession():
+    # A pooled session per LND server so that connections (and TLS and Tor
+    # circuits) are reused across calls. Only GET requests are retried, as
+    # creating invoices and sending payments are not safe to repeat blindly
+    lndServerConfig = getLNDServerConfig()
+    sessionKey = getLNDSessionKey()
+    with _sessionsLock:
+        if sessionKey in _sessions: return _sessions[sessionKey]
+        poolSize = lndServerConfig["poolSize"] if "poolSize" in lndServerConfig else 4
+        # enough connections for every concurrent payment stream, the invoice
+        # and payment tracking streams, plus lookups
+        poolSize = max(poolSize, getMaxConcurrentPayments() + 3)
+        retries = lndServerConfig["retries"] if "retries" in lndServerConfig else 2
+        retryBackoff = lndServerConfig["retryBackoff"] if "retryBackoff" in lndServerConfig else 0.5
+        retry = Retry(total=retries, backoff_factor=retryBackoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(["GET"]), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.verify = False
+        # otherwise REQUESTS_CA_BUNDLE in the environment overrides verify
+        session.trust_env = False
+        session.proxies.update(getLNDProxies())
+        _sessions[sessionKey] = session
+        return session
+
+def resetLNDSession():
+    sessionKey = getLNDSessionKey()
+    with _sessionsLock:
+        if sessionKey not in _sessions: return
+        session = _sessions.pop(sessionKey)
+    try:
+        session.close()
+    except Exception as e:
+        logger.warning(f"Error closing LND session: {str(e)}")
+
+def getNodeStats(serverId):
+    with _nodeStatsLock:
+        if serverId not in _nodeStats:
+            _nodeStats[serverId] = {"healthy": True, "latency": None, "outbound_sat": None, "reserved_sat": 0}
+        return _nodeStats[serverId]
+
+def setNodeHealthy(serverId, healthy):
+    stats = getNodeStats(serverId)
+    with _nodeStatsLock:
+        stats["healthy"] = healthy
+
+def checkNodeHealth():
+    # the state endpoint does not require a macaroon and is cheap to call
+    stats = getNodeStats(getLNDServerId())
+    try:
+        url = getLNDUrl("/v1/state")
+        startTime = time.perf_counter()
+        response = getLNDSession().get(url=url,timeout=getLNDTimeouts())
+        latency = time.perf_counter() - startTime
+        state = response.json().get("state")
+        if state == "SERVER_ACTIVE":
+            # outbound liquidity is optional, needing lnrpc.Lightning/ChannelBalance
+            channelBalance = restLndGET("/v1/balance/channels")
+            outbound = None
+            if channelBalance is not None and "local_balance" in channelBalance:
+                outbound = int(channelBalance["local_balance"].get("sat", 0))
+            with _nodeStatsLock:
+                stats.update({"healthy": True, "latency": latency, "outbound_sat": outbound})
+            return True
+        logger.warning(f"LND server {getLNDServerId()} reports state {state}")
+    except Exception as e:
+        logger.warning(f"LND health check failed for {getLNDServerId()}: {str(e)}")
+    setNodeHealthy(getLNDServerId(), False)
+    # start with fresh connections next time
+    resetLNDSession()
+    return False
+
+def checkLNDHealth():
+    # returns whether any server in use is healthy
+    anyHealthy = False
+    for serverId in getFollowedServerIds():
+        with usingLNDServer(serverId):
+            if checkNodeHealth(): anyHealthy = True
+    return anyHealthy
+
+def choosePaymentServer(amountSat, excludeServerIds=()):
+    # the healthy server with the most outbound liquidity not already reserved
+    # by payments in flight, failing over to the active server if none are
+    candidates = []
+    for serverId in getPoolServerIds():
+        if serverId in excludeServerIds: continue
+        stats = getNodeStats(serverId)
+        if not stats["healthy"]: continue
+        available = None
+        if stats["outbound_sat"] is not None:
+            available = stats["outbound_sat"] - stats["reserved_sat"]
+            if available < amountSat: continue
+        candidates.append((available if available is not None else 0, -stats["reserved_sat"], serverId))
+    if len(candidates) == 0:
+        if getDefaultServerId() in excludeServerIds: return None
+        return getDefaultServerId()
+    candidates.sort(key=lambda c: (c[0], c[1]), reverse=True)
+    return candidates[0][2]
+
+def chooseInvoiceServers():
+    # servers to try creating an invoice on, healthy ones first, active server preferred
+    serverIds = getPoolServerIds()
+    if getDefaultServerId() in serverIds:
+        serverIds.remove(getDefaultServerId())
+        serverIds.insert(0, getDefaultServerId())
+    return sorted(serverIds, key=lambda serverId: not getNodeStats(serverId)["healthy"])
+
+def reserveOutbound(serverId, amountSat):
+    stats = getNodeStats(serverId)
+    with _nodeStatsLock:
+        stats["reserved_sat"] += amountSat
+
+def releaseOutbound(serverId, amountSat, spentSat=0):
+    stats = getNodeStats(serverId)
+    with _nodeStatsLock:
+        stats["reserved_sat"] -= amountSat
+        if stats["outbound_sat"] is not None: stats["outbound_sat"] -= spentSat
+
+def isPaymentNotSent(e):
+    # failures to connect mean LND never received the payment
+    if isinstance(e, requests.exceptions.ConnectTimeout): return True
+    if isinstance(e, requests.exceptions.ConnectionError) and len(e.args) > 0:
+        reason = getattr(e.args[0], "reason", None)
+        if reason is not None and type(reason).__name__ == "NewConnectionError": return True
+    return False
+
 def restLndGET(suffix):
     try:
         url = getLNDUrl(suffix)
         timeout = getLNDTimeouts()
-        proxies = getLNDProxies()
         headers = getLNDHeaders()
         # Call it, non streaming
-        response = requests.get(url=url,timeout=timeout,proxies=proxies,headers=headers,verify=False)
+        response = getLNDSession().get(url=url,timeout=timeout,headers=headers)
         response.status_code 
         output = response.text
         return json.loads(output)
@@ -79,10 +276,9 @@ def restLndPOST(suffix, lndPostData):
     try:
         url = getLNDUrl(suffix)
         timeout = getLNDTimeouts()
-        proxies = getLNDProxies()
         headers = getLNDHeaders()
         # Call it, non streaming
-        response = requests.post(url=url,data=json.dumps(lndPostData),timeout=timeout,proxies=proxies,headers=headers,verify=False)
+        response = getLNDSession().post(url=url,data=json.dumps(lndPostData),timeout=timeout,headers=headers)
         response.status_code 
         output = response.text
         return json.loads(output)
@@ -104,14 +300,20 @@ def createInvoice(amount=21000, memo=None, expiry=86400):
         "expiry": expiry
     }
     suffix = f"/v1/invoices"
-    result = restLndPOST(suffix, data)
-    if result is not None:
-        if "message" in result:
-            message = result["message"]
-            if message == "permission denied":
-                logger.warning("LND reports Permission Denied to create invoice. Check macaroon permissions")
-                return None
-    return result
+    # fail over to other servers in the pool, recording which created it
+    for serverId in chooseInvoiceServers():
+        with usingLNDServer(serverId):
+            result = restLndPOST(suffix, data)
+        if result is not None:
+            if "message" in result:
+                message = result["message"]
+                if message == "permission denied":
+                    logger.warning(f"LND server {serverId} reports Permission Denied to create invoice. Check macaroon permissions")
+                    continue
+            result["invoice_server"] = serverId
+            return result
+        setNodeHealthy(serverId, False)
+    return None
 
 # Returns invoice
 def lookupInvoice(paymentHash):
@@ -125,10 +327,21 @@ def lookupInvoice(paymentHash):
     suffix = f"/v2/invoices/lookup?payment_hash={base64paymentHash}"
     return restLndGET(suffix)
 
+def isDecodeLocal():
+    lndServerConfig = getLNDServerConfig()
+    return lndServerConfig["decodeLocally"] if "decodeLocally" in lndServerConfig else True
+
 def decodeInvoice(paymentRequest):
+    # decoding and signature verification is done in process unless disabled,
+    # saving a round trip to LND for every invoice
+    if isDecodeLocal(): return bolt11.decodeInvoice(paymentRequest)
     suffix = f"/v1/payreq/{paymentRequest}"
     return restLndGET(suffix)
 
+def listPayments(indexOffset=0, maxPayments=1000):
+    suffix = f"/v1/payments?include_incomplete=true&index_offset={indexOffset}&max_payments={maxPayments}"
+    return restLndGET(suffix)
+
 # Returns payment status and fee_msat paid
 def trackPayment(paymentHash):
     # Setup
@@ -137,14 +350,13 @@ def trackPayment(paymentHash):
     suffix = f"/v2/router/track/{base64paymentHash}?no_inflight_updates=True"
     url = getLNDUrl(suffix)
     timeout = getLNDTimeouts()
-    proxies = getLNDProxies()
     headers = getLNDHeaders()
     status = None
     fee_msat = None
     json_response = None
     response = None
     try:
-        response = requests.get(url=url,stream=True,timeout=timeout,proxies=proxies,headers=headers,verify=False)
+        response = getLNDSession().get(url=url,stream=True,timeout=timeout,headers=headers)
         for raw_response in response.iter_lines():
             json_response = json.loads(raw_response)
             if "result" in json_response: json_response = json_response["result"]
@@ -159,6 +371,7 @@ def trackPayment(paymentHash):
                 if "failure_reason" in json_response:
                     failureReason = json_response["failure_reason"]
                 logger.warning(f"{status}:{failureReason}")
+                setPaymentFailureReason(paymentHash, failureReason)
             if "fee_msat" not in json_response:
                 return status, fee_msat
             fee_msat = int(json_response["fee_msat"])
@@ -177,9 +390,8 @@ def trackPayment(paymentHash):
 def payInvoice(paymentRequest):
     lndServerConfig = getLNDServerConfig()
     logger.debug(f"Paying invoice")
-    feeLimit = 2
+    feeLimit = getFeeLimit()
     paymentTimeout = 30
-    if "feeLimit" in lndServerConfig: lndServerConfig["feeLimit"]
     if "paymentTimeout" in lndServerConfig: paymentTimeout = lndServerConfig["paymentTimeout"]
     suffix = "/v2/router/send"
     lndPostData = {
@@ -189,15 +401,13 @@ def payInvoice(paymentRequest):
     }
     url = getLNDUrl(suffix)
     timeout = getLNDTimeouts()
-    proxies = getLNDProxies()
     headers = getLNDHeaders()
-    requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
     resultStatus = "UNKNOWNPAYING"
     resultFeeMSat = 0
     json_response = None
     payment_hash = None
     payment_index = None
-    r = requests.post(url=url,stream=True,data=json.dumps(lndPostData),timeout=timeout,proxies=proxies,headers=headers,verify=False)
+    r = getLNDSession().post(url=url,stream=True,data=json.dumps(lndPostData),timeout=timeout,headers=headers)
     try:
         for raw_response in r.iter_lines():
             json_response = json.loads(raw_response)
@@ -224,6 +434,7 @@ def payInvoice(paymentRequest):
                 if "failure_reason" in json_response:
                     failureReason = json_response["failure_reason"]
                 logger.warning(f" - {resultStatus} : {failureReason}")
+                if payment_hash is not None: setPaymentFailureReason(payment_hash, failureReason)
             elif resultStatus == "IN_FLIGHT":
                 logger.debug(f" - {resultStatus}")
             else:
@@ -247,8 +458,8 @@ def monitorInvoice(theInvoice):
     _invoices.append(theInvoice)
     files.saveInvoices(_invoices)
 
-def checkInvoices():
-    global _invoices
+def pollInvoices(invoices):
+    # looks up each invoice, returning those still open
     # currentInvoice["npub"] = npub
     # currentInvoice["created_at"] = created_at
     # currentInvoice["created_at_iso"] = created_at_iso
@@ -260,16 +471,16 @@ def checkInvoices():
     # currentInvoice["r_hash"] = newInvoice["r_hash"]
     # currentInvoice["payment_request"] = payment_request
     # currentInvoice["add_index"] = newInvoice["add_index"]
-    if _invoices is None: _invoices = files.loadInvoices()
-    if len(_invoices) == 0: return
+    if len(invoices) == 0: return invoices
     logger.debug("Checking outstanding invoices")
     openInvoices = []
-    for invoice in _invoices:
+    for invoice in invoices:
         payment_hash = None
         if "r_hash" in invoice: payment_hash = invoice["r_hash"]
         if "payment_hash" in invoice: payment_hash = invoice["payment_hash"]
         npub = invoice["npub"]
-        status = lookupInvoice(payment_hash)
+        with usingLNDServer(getRecordedServerId(invoice, "invoice_server")):
+            status = lookupInvoice(payment_hash)
         if status is None: 
             openInvoices.append(invoice) # consider still open, temp glitch?
             logger.warning(f"invoice for {npub} has no status. payment_hash for lookup is {payment_hash}")
@@ -282,7 +493,12 @@ def checkInvoices():
             continue
         state = 0
         if "state" in status: state = status["state"]
-        if state == "OPEN":
+        if state == "OPEN" and isInvoiceExpired(invoice, status):
+            # LND cancels expired invoices in time, and no longer accepts
+            # payment of them meanwhile
+            logger.debug(f"invoice for npub {npub} has expired")
+            handleCanceledInvoice(invoice)
+        elif state == "OPEN":
             # keep considering as outstanding
             logger.debug(f"invoice for npub {npub} still open")
             openInvoices.append(invoice)
@@ -300,10 +516,167 @@ def checkInvoices():
             logger.warning(f"invoice for {npub} has unrecognized state ({state}). payment_hash for lookup is {payment_hash}")
             logger.warning(f"response of lookupInvoice: ")
             logger.warning(json.dumps(obj=status,indent=2))
+    return openInvoices
+
+def getInvoiceExpiryTime(invoice, status=None):
+    # when the invoice expires, by LND's creation_date and expiry if known
+    if status is not None and "creation_date" in status and "expiry" in status:
+        return int(status["creation_date"]) + int(status["expiry"])
+    return invoice.get("expiry_time")
+
+def isInvoiceExpired(invoice, status=None, currentTime=None):
+    if currentTime is None: currentTime, _ = utils.getTimes()
+    expiryTime = getInvoiceExpiryTime(invoice, status)
+    return expiryTime is not None and expiryTime < currentTime
+
+def getInvoicePollInterval():
+    lndServerConfig = getLNDServerConfig()
+    return lndServerConfig["invoicePollInterval"] if "invoicePollInterval" in lndServerConfig else 600
+
+def getInvoiceHashHex(paymentHash):
+    # LND REST gives hashes as base64, though older invoices may be saved as hex
+    if paymentHash is None: return None
+    if len(paymentHash) == 64 and utils.isHex(paymentHash): return paymentHash.lower()
+    return base64.b64decode(paymentHash).hex()
+
+def checkInvoices():
+    global _invoices, _lastInvoicePollTime
+    if _invoices is None: _invoices = files.loadInvoices()
+    openInvoices = applyInvoiceUpdates(_invoices)
+    currentTime, _ = utils.getTimes()
+    if _lastInvoicePollTime + getInvoicePollInterval() < currentTime:
+        # periodically to catch anything missed
+        openInvoices = pollInvoices(openInvoices)
+        _lastInvoicePollTime = currentTime
+    else:
+        # fallback for servers whose subscription is down, and expired invoices
+        # as the subscription does not report invoices canceled on expiry.
+        # Invoices still outstanding a poll interval after expiry, as when
+        # their lookups fail, are left to the periodic poll
+        pollableInvoices = [i for i in openInvoices if not isInvoiceExpired(i, currentTime=currentTime - getInvoicePollInterval())
+                            and (not isInvoiceSubscriptionActive(getRecordedServerId(i, "invoice_server")) or isInvoiceExpired(i, currentTime=currentTime))]
+        if len(pollableInvoices) > 0:
+            stillOpen = pollInvoices(pollableInvoices)
+            openInvoices = [i for i in openInvoices if i not in pollableInvoices or i in stillOpen]
     if len(_invoices) != len(openInvoices):
         _invoices = openInvoices
         files.saveInvoices(openInvoices)
 
+# Invoice subscription
+#
+# A background thread per server consumes LND's invoice subscription stream,
+# queueing updates for the main loop and waking it so credits are applied as
+# soon as an invoice is paid. The last add_index and settle_index handled for
+# each server are saved so the stream resumes where it left off after a
+# reconnect or restart.
+
+_invoiceUpdates = queue.Queue()
+_invoiceUpdated = threading.Event()
+_invoiceSubscriptionThreads = {}
+_invoiceSubscriptionsActive = {}
+_invoiceIndexes = None
+_lastInvoicePollTime = 0
+
+def getInvoiceIndexesFilename():
+    return f"{files.dataFolder}invoiceSubscription.json"
+
+def getInvoiceIndexes(serverId):
+    global _invoiceIndexes
+    if _invoiceIndexes is None:
+        _invoiceIndexes = files.loadJsonFile(getInvoiceIndexesFilename(), {})
+        # indexes saved before servers were tracked separately
+        if "add_index" in _invoiceIndexes:
+            _invoiceIndexes = {str(getDefaultServerId()): _invoiceIndexes}
+    serverKey = str(serverId)
+    if serverKey not in _invoiceIndexes: _invoiceIndexes[serverKey] = {"add_index": 0, "settle_index": 0}
+    return _invoiceIndexes[serverKey]
+
+def isInvoiceSubscriptionActive(serverId):
+    return _invoiceSubscriptionsActive.get(serverId, False)
+
+def subscribeInvoices(serverId):
+    selectLNDServer(serverId)
+    retryDelay = 1
+    while True:
+        response = None
+        try:
+            indexes = getInvoiceIndexes(serverId)
+            suffix = f"/v1/invoices/subscribe?add_index={indexes['add_index']}&settle_index={indexes['settle_index']}"
+            url = getLNDUrl(suffix)
+            connectTimeout, _ = getLNDTimeouts()
+            # the stream is idle between invoices, so allow a long read before reconnecting
+            timeout = (connectTimeout, getInvoicePollInterval())
+            response = getLNDSession().get(url=url,stream=True,timeout=timeout,headers=getLNDHeaders())
+            if response.status_code != 200:
+                raise Exception(f"status code {response.status_code}: {response.text}")
+            _invoiceSubscriptionsActive[serverId] = True
+            retryDelay = 1
+            for raw_response in response.iter_lines():
+                if len(raw_response) == 0: continue
+                json_response = json.loads(raw_response)
+                if "error" in json_response: raise Exception(json_response["error"])
+                if "result" in json_response: json_response = json_response["result"]
+                _invoiceUpdates.put((serverId, json_response))
+                _invoiceUpdated.set()
+            logger.debug("Invoice subscription stream ended")
+        except requests.exceptions.ConnectionError as e:
+            # includes read timeouts of an idle stream
+            logger.debug(f"Invoice subscription disconnected for {serverId}: {str(e)}")
+        except Exception as e:
+            logger.warning(f"Error in invoice subscription for {serverId}: {str(e)}")
+        finally:
+            _invoiceSubscriptionsActive[serverId] = False
+            if response is not None: response.close()
+        time.sleep(retryDelay)
+        retryDelay = min(retryDelay * 2, 60)
+
+def startInvoiceSubscription():
+    for serverId in getFollowedServerIds():
+        if serverId in _invoiceSubscriptionThreads: continue
+        thread = threading.Thread(target=subscribeInvoices, args=(serverId,), name=f"invoices-{serverId}", daemon=True)
+        _invoiceSubscriptionThreads[serverId] = thread
+        thread.start()
+
+def wakeMainLoop():
+    _invoiceUpdated.set()
+
+def waitForInvoiceUpdates(seconds):
+    # sleeps up to seconds, returning early if an invoice update arrives or
+    # a payment completes
+    updated = _invoiceUpdated.wait(seconds)
+    _invoiceUpdated.clear()
+    return updated
+
+def applyInvoiceUpdates(invoices):
+    # handles queued subscription updates for the outstanding invoices,
+    # returning those still open
+    if _invoiceUpdates.empty(): return invoices
+    openInvoices = list(invoices)
+    while not _invoiceUpdates.empty():
+        serverId, update = _invoiceUpdates.get()
+        indexes = getInvoiceIndexes(serverId)
+        state = update.get("state")
+        if state in ("SETTLED","CANCELED"):
+            updateHash = getInvoiceHashHex(update.get("r_hash"))
+            for invoice in openInvoices:
+                paymentHash = invoice["payment_hash"] if "payment_hash" in invoice else invoice.get("r_hash")
+                if getInvoiceHashHex(paymentHash) != updateHash: continue
+                openInvoices.remove(invoice)
+                npub = invoice["npub"]
+                if state == "SETTLED":
+                    logger.debug(f"invoice for npub {npub} reported as settled")
+                    handlePaidInvoice(invoice)
+                else:
+                    logger.debug(f"invoice for npub {npub} has been canceled")
+                    handleCanceledInvoice(invoice)
+                break
+        # only advance once handled, so a restart resumes with anything unhandled
+        for indexName in ("add_index", "settle_index"):
+            if indexName in update and int(update[indexName]) > int(indexes[indexName]):
+                indexes[indexName] = int(update[indexName])
+    files.saveJsonFile(getInvoiceIndexesFilename(), _invoiceIndexes)
+    return openInvoices
+
 def handlePaidInvoice(invoice):
     npub = invoice["npub"]
     amount = invoice["amount"]
@@ -329,25 +702,214 @@ def handleCanceledInvoice(invoice):
     # Clear current invoice from nostr config for pub
     nostr.setNostrFieldForNpub(npub, "currentInvoice", {})
 
+# Payment destinations
+#
+# Counts of payments and sats by destination node are kept in memory by day,
+# and written to paymentdestination.json every paymentDestinationFlushInterval
+# seconds. Days older than paymentDestinationDays are rolled up by month into
+# paymentdestinationmonthly.json, keeping the daily file bounded.
+
+_paymentDestinations = None         # day -> destination -> {qty, amount}
+_paymentDestinationsChanged = False
+_paymentDestinationsLock = threading.Lock()
+_lastPaymentDestinationFlushTime = 0
+
 def getPaymentDestinationFilename():
     filename = f"{files.dataFolder}paymentdestination.json"
     return filename
 
+def getPaymentDestinationMonthlyFilename():
+    filename = f"{files.dataFolder}paymentdestinationmonthly.json"
+    return filename
+
+def getPaymentDestinationFlushInterval():
+    return config["paymentDestinationFlushInterval"] if "paymentDestinationFlushInterval" in config else 300
+
+def getPaymentDestinationDays():
+    return config["paymentDestinationDays"] if "paymentDestinationDays" in config else 31
+
+def loadPaymentDestinations():
+    global _paymentDestinations
+    if _paymentDestinations is None:
+        _paymentDestinations = files.loadJsonFile(getPaymentDestinationFilename(), {})
+    return _paymentDestinations
+
+def addPaymentDestinationCounts(periods, period, destination_pubkey, qty, amount):
+    d = periods.setdefault(period, {})
+    dpk = d.setdefault(destination_pubkey, {"qty":0, "amount": 0})
+    dpk["qty"] = dpk["qty"] + qty
+    dpk["amount"] = dpk["amount"] + amount
+
 def recordPaymentDestination(decodedInvoice):
+    global _paymentDestinationsChanged
     if not all(k in decodedInvoice for k in ("destination","num_satoshis","num_msat")): 
         return
     destination_pubkey = decodedInvoice["destination"]
     num_satoshis = int(decodedInvoice["num_satoshis"])
     _, diso = utils.getTimes()
     diso = diso[0:10]
-    filename = getPaymentDestinationFilename()
-    pddata = files.loadJsonFile(filename, {})
-    d = {}
-    if diso in pddata.keys(): d = pddata[diso]
-    dpk = {"qty":0, "amount": 0}
-    if destination_pubkey in d.keys(): dpk = d[destination_pubkey]
-    dpk["qty"] = dpk["qty"] + 1
-    dpk["amount"] = dpk["amount"] + num_satoshis
-    d[destination_pubkey] = dpk
-    pddata[diso] = d
-    files.saveJsonFile(filename, pddata)
+    with _paymentDestinationsLock:
+        addPaymentDestinationCounts(loadPaymentDestinations(), diso, destination_pubkey, 1, num_satoshis)
+        _paymentDestinationsChanged = True
+
+def flushPaymentDestinations(force=False):
+    # saves the daily counts if changed and the flush interval has passed,
+    # first rolling up days that are no longer kept into monthly counts
+    global _paymentDestinationsChanged, _lastPaymentDestinationFlushTime
+    currentTime, _ = utils.getTimes()
+    if not force and _lastPaymentDestinationFlushTime + getPaymentDestinationFlushInterval() > currentTime: return
+    _lastPaymentDestinationFlushTime = currentTime
+    with _paymentDestinationsLock:
+        pddata = loadPaymentDestinations()
+        oldestDay = utils.getTimes(datetime.datetime.now() - datetime.timedelta(days=getPaymentDestinationDays()))[1][0:10]
+        rollupDays = [diso for diso in pddata.keys() if diso < oldestDay]
+        if len(rollupDays) > 0:
+            monthlyFilename = getPaymentDestinationMonthlyFilename()
+            monthly = files.loadJsonFile(monthlyFilename, {})
+            for diso in rollupDays:
+                for destination_pubkey, dpk in pddata.pop(diso).items():
+                    addPaymentDestinationCounts(monthly, diso[0:7], destination_pubkey, dpk["qty"], dpk["amount"])
+            files.saveJsonFile(monthlyFilename, monthly)
+            _paymentDestinationsChanged = True
+        if not _paymentDestinationsChanged: return
+        files.saveJsonFile(getPaymentDestinationFilename(), pddata)
+        _paymentDestinationsChanged = False
+
+def getTopPaymentDestinations(startDate, endDate, limit=10):
+    # returns a list of (destination, qty, amount) with the most sats paid
+    # between the iso dates given, inclusive. Months that have been rolled up
+    # are counted in whole if any part of them is in the range
+    totals = {}
+    with _paymentDestinationsLock:
+        periods = [(diso, d) for diso, d in loadPaymentDestinations().items() if startDate[0:10] <= diso <= endDate[0:10]]
+    monthly = files.loadJsonFile(getPaymentDestinationMonthlyFilename(), {})
+    periods.extend([(miso, d) for miso, d in monthly.items() if startDate[0:7] <= miso <= endDate[0:7]])
+    for _, d in periods:
+        for destination_pubkey, dpk in d.items():
+            addPaymentDestinationCounts(totals, "total", destination_pubkey, dpk["qty"], dpk["amount"])
+    ranked = sorted(totals.get("total", {}).items(), key=lambda item: item[1]["amount"], reverse=True)
+    return [(destination_pubkey, dpk["qty"], dpk["amount"]) for destination_pubkey, dpk in ranked[0:limit]]
+
+# Route feasibility
+#
+# Destinations that payments keep failing to, or that LND finds no route to
+# within the fee limit, are skipped before an invoice is paid rather than
+# waiting for the payment to time out. Outcomes of past payments are counted
+# by destination node, and when probeRoutes is enabled LND is asked for a
+# route to destinations not probed in the past routeCacheSeconds. Only
+# failures LND gives as no route or a timeout count against a destination.
+# The destination last paid for each lightning address is remembered so that
+# zaps can be ordered with the likely successes first.
+
+_routeCache = None              # {"destinations": {destination -> stats}, "lightningIds": {lightningId -> destination}}
+_routeCacheChanged = False
+_routeCacheLock = threading.Lock()
+_paymentFailureReasons = {}     # payment hash -> failure reason LND gave
+_paymentFailureReasonsLock = threading.Lock()
+maxPaymentFailureReasons = 10000
+routingFailureReasons = ("FAILURE_REASON_NO_ROUTE", "FAILURE_REASON_TIMEOUT")
+
+def getRouteCacheFilename():
+    filename = f"{files.dataFolder}routecache.json"
+    return filename
+
+def getRouteCacheSeconds():
+    return config["routeCacheSeconds"] if "routeCacheSeconds" in config else 3600
+
+def getRouteFailureLimit():
+    return config["routeFailureLimit"] if "routeFailureLimit" in config else 3
+
+def isRouteProbeEnabled():
+    return config["probeRoutes"] if "probeRoutes" in config else False
+
+def loadRouteCache():
+    global _routeCache
+    if _routeCache is None:
+        _routeCache = files.loadJsonFile(getRouteCacheFilename(), {})
+        _routeCache.setdefault("destinations", {})
+        _routeCache.setdefault("lightningIds", {})
+    return _routeCache
+
+def getRouteStats(destination):
+    return loadRouteCache()["destinations"].setdefault(destination, {"successes": 0, "failures": 0, "consecutive_failures": 0})
+
+def queryRoutes(destination, amountSat):
+    # returns True if LND finds a route within the fee limit, False if it
+    # finds none, or None if it could not be asked
+    result = restLndGET(f"/v1/graph/routes/{destination}/{amountSat}?fee_limit.fixed={getFeeLimit()}&use_mission_control=true")
+    if result is None: return None
+    if "routes" in result: return len(result["routes"]) > 0
+    message = str(result.get("message", ""))
+    if "unable to find a path" in message or "insufficient" in message: return False
+    logger.debug(f"Unable to query routes to {destination}: {message}")
+    return None
+
+def isDestinationRoutable(destination, amountSat):
+    global _routeCacheChanged
+    if destination is None: return True
+    currentTime, _ = utils.getTimes()
+    cacheSeconds = getRouteCacheSeconds()
+    with _routeCacheLock:
+        stats = dict(getRouteStats(destination))
+    if stats["consecutive_failures"] >= getRouteFailureLimit() and stats.get("failure_time", 0) + cacheSeconds > currentTime:
+        logger.debug(f"Last {stats['consecutive_failures']} payments to {destination} failed")
+        return False
+    if not isRouteProbeEnabled(): return True
+    # a route for a larger amount, or none for a smaller one, still holds
+    if stats.get("probe_time", 0) + cacheSeconds > currentTime:
+        if stats["probe_routable"] and amountSat <= stats["probe_amount"]: return True
+        if not stats["probe_routable"] and amountSat >= stats["probe_amount"]: return False
+    routable = queryRoutes(destination, amountSat)
+    if routable is None: return True
+    with _routeCacheLock:
+        getRouteStats(destination).update({"probe_time": currentTime, "probe_amount": amountSat, "probe_routable": routable})
+        _routeCacheChanged = True
+    if not routable: logger.debug(f"No route to {destination} for {amountSat} sats")
+    return routable
+
+def setPaymentFailureReason(paymentHash, failureReason):
+    with _paymentFailureReasonsLock:
+        _paymentFailureReasons[paymentHash] = failureReason
+        while len(_paymentFailureReasons) > maxPaymentFailureReasons:
+            _paymentFailureReasons.pop(next(iter(_paymentFailureReasons)))
+
+def popPaymentFailureReason(paymentHash):
+    # the reason LND gave for the payment failing, if it was seen
+    with _paymentFailureReasonsLock:
+        return _paymentFailureReasons.pop(paymentHash, None)
+
+def recordPaymentOutcome(destination, status, lightningId=None, failureReason=None):
+    # only failures to find or complete a route count against the
+    # destination, not those of the invoice or of reaching our own nodes
+    global _routeCacheChanged
+    if destination is None or status not in ("SUCCEEDED","FAILED"): return
+    if status == "FAILED" and failureReason not in routingFailureReasons: return
+    currentTime, _ = utils.getTimes()
+    with _routeCacheLock:
+        stats = getRouteStats(destination)
+        if status == "SUCCEEDED":
+            stats["successes"] += 1
+            stats["consecutive_failures"] = 0
+        else:
+            stats["failures"] += 1
+            stats["consecutive_failures"] += 1
+            stats["failure_time"] = currentTime
+        if lightningId is not None: loadRouteCache()["lightningIds"][lightningId] = destination
+        _routeCacheChanged = True
+
+def getPaymentSuccessRate(lightningId):
+    # estimated chance a payment to the lightning address succeeds, from past
+    # payments to the destination it was last paid at
+    with _routeCacheLock:
+        routeCache = loadRouteCache()
+        destination = routeCache["lightningIds"].get(lightningId)
+        if destination not in routeCache["destinations"]: return 0.5
+        stats = routeCache["destinations"][destination]
+        return (stats["successes"] + 1) / (stats["successes"] + stats["failures"] + 2)
+
+def flushRouteCache():
+    global _routeCacheChanged
+    with _routeCacheLock:
+        if not _routeCacheChanged: return
+        files.saveJsonFile(getRouteCacheFilename(), loadRouteCache())
+        _routeCacheChanged = False
@@ -1,11 +1,62 @@
 #!/usr/bin/env python3
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 import json
+import re
 import requests
+import socket
+import threading
+import time
 import urllib.parse
+import urllib3
+import urllib3.connection
+import botfiles as files
+import botpolicy as policy
+import botutils as utils
 
 logger = None
 config = None
 
+# LNURL pay info is cached by lightning address, since most zaps go to a few
+# providers. Responses are kept for payInfoCacheSeconds, or less if the
+# provider's Cache-Control header says so, and failures for
+# payInfoFailureCacheSeconds so that a provider that is down is not asked
+# again for every zap. The cache is saved to lnurlcache.json by the main loop.
+
+_payInfoCache = None            # identity -> {"info", "failed", "expires"}
+_payInfoCacheChanged = False
+_payInfoCacheLock = threading.Lock()
+payInfoFields = ("callback","minSendable","maxSendable","allowsNostr","nostrPubkey","status","reason")
+_prefetches = {}                # identity -> future getting its pay info ahead of a zap
+_prefetchesLock = threading.Lock()
+_prefetchExecutor = None
+
+# Requests to each provider host share a session, so connections are kept
+# alive and reused between zaps, up to maxConnectionsPerDomain at a time.
+# Sessions of the maxProviderSessions hosts most recently used are kept, and
+# the rest closed. Addresses of the hosts are cached for dnsCacheSeconds by
+# the adapter mounted on their sessions, leaving other connections, such as
+# to LND, as they are. Onion hosts each use their own Tor circuit, which is
+# reused for as long as Tor keeps it.
+
+_sessions = OrderedDict()       # host -> requests session, least recently used first
+_sessionsLock = threading.Lock()
+_dnsCache = {}                  # (host, port) -> (addresses, expires)
+_dnsCacheLock = threading.Lock()
+
+# Health of each provider host is tracked from its recent requests. After
+# circuitFailureThreshold failures in a row the circuit for the host opens,
+# and requests to it are skipped for circuitOpenSeconds. A single request is
+# then let through, closing the circuit if it succeeds or opening it again
+# if it fails. Only connection errors, timeouts and 5xx responses are
+# failures of the host. A 4xx or LNURL ERROR reply, as for an unknown user,
+# fails only the zap it was for.
+
+_providerHealth = {}            # host -> {"state", "opened", "failures", "trial", "latencies", "outcomes"}
+_providerHealthLock = threading.Lock()
+providerHealthWindow = 100
+
 def gettimeouts():
     connectTimeout = 5
     readTimeout = 30
@@ -13,25 +64,273 @@ def gettimeouts():
     if "readTimeout" in config: readTimeout = config["readTimeout"]
     return (connectTimeout, readTimeout)
 
-def gettorproxies():
+def gettorproxies(host=None):
     # with tor service installed, default port is 9050
     # to find the port to use, can run the following
     #     cat /etc/tor/torrc | grep SOCKSPort | grep -v "#" | awk '{print $2}'
-    return {'http': 'socks5h://127.0.0.1:9050','https': 'socks5h://127.0.0.1:9050'}
+    # Tor isolates streams by socks credentials, so naming the host gives
+    # each its own circuit that is reused between requests
+    auth = "" if host is None else f"{urllib.parse.quote(host, safe='')}:boostzapper@"
+    return {'http': f'socks5h://{auth}127.0.0.1:9050','https': f'socks5h://{auth}127.0.0.1:9050'}
 
-def geturl(useTor=True, url=None, defaultResponse="{}", headers={}, description=None):
+def getMaxConnectionsPerDomain():
+    return config["maxConnectionsPerDomain"] if "maxConnectionsPerDomain" in config else 4
+
+def getMaxProviderSessions():
+    return config["maxProviderSessions"] if "maxProviderSessions" in config else 100
+
+def getDNSCacheSeconds():
+    return config["dnsCacheSeconds"] if "dnsCacheSeconds" in config else 300
+
+def resolveHost(host, port):
+    currentTime, _ = utils.getTimes()
+    with _dnsCacheLock:
+        if (host, port) in _dnsCache:
+            addresses, expires = _dnsCache[(host, port)]
+            if expires > currentTime: return addresses
+    addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    with _dnsCacheLock:
+        _dnsCache[(host, port)] = (addresses, currentTime + getDNSCacheSeconds())
+    return addresses
+
+class CachedDNSConnectionMixin:
+    # connects to the cached addresses of the host, in turn until one answers
+    def _new_conn(self):
+        host = self._dns_host
+        err = None
+        for family, _, _, _, sockaddr in resolveHost(host, self.port):
+            # the host name is kept for the TLS handshake and Host header
+            self._dns_host = sockaddr[0]
+            try:
+                return super()._new_conn()
+            except (OSError, urllib3.exceptions.HTTPError) as e:
+                err = e
+            finally:
+                self._dns_host = host
+        # the host may have moved, so look it up again next time
+        with _dnsCacheLock:
+            _dnsCache.pop((host, self.port), None)
+        if err is not None: raise err
+        raise OSError(f"no addresses found for {host}")
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class CachedDNSHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+class CachedDNSHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+class CachedDNSAdapter(HTTPAdapter):
+    # requests through a proxy, such as Tor for onion hosts, are resolved by
+    # the proxy and so use its own pool manager
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CachedDNSHTTPConnectionPool, "https": CachedDNSHTTPSConnectionPool}
+
+def getSession(host):
+    closed = []
+    with _sessionsLock:
+        if host not in _sessions:
+            session = requests.Session()
+            maxConnections = getMaxConnectionsPerDomain()
+            adapter = CachedDNSAdapter(pool_connections=1, pool_maxsize=maxConnections, pool_block=True)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+            while len(_sessions) > max(1, getMaxProviderSessions()):
+                closed.append(_sessions.popitem(last=False))
+        _sessions.move_to_end(host)
+        session = _sessions[host]
+    # requests still using a closed session complete, but their connections
+    # are not kept
+    for closedHost, closedSession in closed:
+        closedSession.close()
+        hostname = urllib.parse.urlsplit(f"//{closedHost}").hostname
+        with _dnsCacheLock:
+            for key in [k for k in _dnsCache if k[0] == hostname]: del _dnsCache[key]
+    return session
+
+def getCircuitFailureThreshold():
+    return config["circuitFailureThreshold"] if "circuitFailureThreshold" in config else 5
+
+def getCircuitOpenSeconds():
+    return config["circuitOpenSeconds"] if "circuitOpenSeconds" in config else 300
+
+def getIdentityHost(identity):
+    identityParts = identity.split("@")
+    if len(identityParts) != 2: return None
+    return getUrlHost(f"//{identityParts[1]}")
+
+def getUrlHost(url):
+    return urllib.parse.urlparse(url).hostname
+
+def getProviderHealthEntry(host):
+    if host not in _providerHealth:
+        _providerHealth[host] = {"state": "CLOSED", "opened": 0, "failures": 0, "trial": False,
+            "latencies": deque(maxlen=providerHealthWindow), "outcomes": deque(maxlen=providerHealthWindow)}
+    return _providerHealth[host]
+
+def isProviderTripped(host):
+    # whether requests to the host would be skipped at this time
+    currentTime, _ = utils.getTimes()
+    with _providerHealthLock:
+        if host not in _providerHealth: return False
+        health = _providerHealth[host]
+        if health["state"] == "OPEN": return health["opened"] + getCircuitOpenSeconds() > currentTime
+        return health["state"] == "HALF_OPEN" and health["trial"]
+
+def acquireProvider(host):
+    # returns whether a request may be made to the host, letting a single
+    # trial request through once the circuit has been open long enough
+    currentTime, _ = utils.getTimes()
+    with _providerHealthLock:
+        health = getProviderHealthEntry(host)
+        if health["state"] == "CLOSED": return True
+        if health["state"] == "OPEN":
+            if health["opened"] + getCircuitOpenSeconds() > currentTime: return False
+            health["state"] = "HALF_OPEN"
+            health["trial"] = False
+        if health["trial"]: return False
+        health["trial"] = True
+        return True
+
+def recordProviderResult(host, success, latency):
+    currentTime, _ = utils.getTimes()
+    with _providerHealthLock:
+        health = getProviderHealthEntry(host)
+        health["outcomes"].append(success)
+        health["trial"] = False
+        if success:
+            health["latencies"].append(latency)
+            health["failures"] = 0
+            if health["state"] != "CLOSED": logger.info(f"LN URL Provider {host} is responding again")
+            health["state"] = "CLOSED"
+            return
+        health["failures"] += 1
+        if health["state"] == "HALF_OPEN" or health["failures"] >= getCircuitFailureThreshold():
+            if health["state"] == "CLOSED": logger.warning(f"LN URL Provider {host} failed {health['failures']} requests in a row. Skipping it for {getCircuitOpenSeconds()} seconds")
+            health["state"] = "OPEN"
+            health["opened"] = currentTime
+
+def getProviderHealth():
+    # returns a list of health summaries for each provider host
+    summaries = []
+    with _providerHealthLock:
+        for host, health in _providerHealth.items():
+            outcomes = list(health["outcomes"])
+            latencies = sorted(health["latencies"])
+            summaries.append({
+                "host": host,
+                "state": health["state"],
+                "requests": len(outcomes),
+                "error_rate": (outcomes.count(False) / len(outcomes)) if len(outcomes) > 0 else 0,
+                "p50_ms": int(latencies[len(latencies) // 2] * 1000) if len(latencies) > 0 else None,
+                "p95_ms": int(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000) if len(latencies) > 0 else None,
+            })
+    return summaries
+
+def geturlresponse(useTor=True, url=None, defaultResponse="{}", headers={}, description=None):
+    # returns the parsed json and the response, which is None on error
+    host = getUrlHost(url)
+    if not acquireProvider(host):
+        logger.debug(f"Skipping request to LN URL Provider {host} while it is failing")
+        return json.loads(defaultResponse), None
+    startTime = time.perf_counter()
     try:
-        proxies = gettorproxies() if useTor else {}
+        proxies = gettorproxies(host) if useTor else {}
         timeout = gettimeouts()
-        resp = requests.get(url,timeout=timeout,allow_redirects=True,proxies=proxies,headers=headers,verify=True)
-        cmdoutput = resp.text
-        return json.loads(cmdoutput)
+        resp = getSession(host).get(url,timeout=timeout,allow_redirects=True,proxies=proxies,headers=headers,verify=True)
     except Exception as e:
+        recordProviderResult(host, False, time.perf_counter() - startTime)
         if description is not None: logger.info(description)
         logger.warning(f"Error getting data from LN URL Provider from url ({url}): {str(e)}")
-        return json.loads(defaultResponse)
-    
+        return json.loads(defaultResponse), None
+    recordProviderResult(host, resp.status_code < 500, time.perf_counter() - startTime)
+    try:
+        j = json.loads(resp.text)
+        return j, resp
+    except Exception as e:
+        if description is not None: logger.info(description)
+        logger.warning(f"Error parsing data from LN URL Provider from url ({url}) with status code {resp.status_code}: {str(e)}")
+        return json.loads(defaultResponse), None
+
+def geturl(useTor=True, url=None, defaultResponse="{}", headers={}, description=None):
+    j, _ = geturlresponse(useTor, url, defaultResponse, headers, description)
+    return j
+
+def getPayInfoCacheFilename():
+    return f"{files.dataFolder}lnurlcache.json"
+
+def getPayInfoCacheSeconds():
+    return config["payInfoCacheSeconds"] if "payInfoCacheSeconds" in config else 3600
+
+def getPayInfoFailureCacheSeconds():
+    return config["payInfoFailureCacheSeconds"] if "payInfoFailureCacheSeconds" in config else 300
+
+def loadPayInfoCache():
+    global _payInfoCache
+    if _payInfoCache is None:
+        _payInfoCache = files.loadJsonFile(getPayInfoCacheFilename(), {})
+    return _payInfoCache
+
+def getCacheControlSeconds(resp):
+    # seconds the provider permits the response to be cached, or None if it
+    # does not say
+    cacheControl = resp.headers.get("Cache-Control", "").lower()
+    if "no-store" in cacheControl or "no-cache" in cacheControl: return 0
+    maxAge = re.search(r"max-age=(\d+)", cacheControl)
+    if maxAge is not None: return int(maxAge.group(1))
+    return None
+
+def isPayInfoFailure(j, resp):
+    if resp is None or resp.status_code >= 400: return True
+    if j.get("status") == "ERROR": return True
+    return "callback" not in j
+
+def getPrefetchThreads():
+    return config["prefetchThreads"] if "prefetchThreads" in config else 8
+
+def prefetchLNURLPayInfo(identities):
+    # starts getting the pay info of lightning addresses not cached, to be
+    # picked up by getLNURLPayInfo when they are zapped
+    global _prefetchExecutor
+    currentTime, _ = utils.getTimes()
+    with _prefetchesLock:
+        if _prefetchExecutor is None:
+            _prefetchExecutor = ThreadPoolExecutor(max_workers=getPrefetchThreads(), thread_name_prefix="lnurl-prefetch")
+        for cacheKey in [k for k, f in _prefetches.items() if f.done()]:
+            del _prefetches[cacheKey]
+        for identity in set(identities):
+            cacheKey = identity.lower()
+            if cacheKey in _prefetches: continue
+            with _payInfoCacheLock:
+                cached = loadPayInfoCache().get(cacheKey)
+            if cached is not None and cached["expires"] > currentTime: continue
+            if not isLNURLProviderAllowed(identity) or isProviderTripped(getIdentityHost(identity)): continue
+            _prefetches[cacheKey] = _prefetchExecutor.submit(fetchLNURLPayInfo, identity)
+
+def getHttpDomains():
+    # domains served without TLS, such as a local provider simulator
+    return config["httpDomains"] if "httpDomains" in config else []
+
 def getLNURLPayInfo(identity):
+    # waits on a prefetch of the identity if one is in progress
+    with _prefetchesLock:
+        prefetch = _prefetches.pop(identity.lower(), None)
+    if prefetch is not None:
+        try:
+            return prefetch.result()
+        except Exception as e:
+            logger.warning(f"Error prefetching LNURL Pay Info for {identity}: {str(e)}")
+    return fetchLNURLPayInfo(identity)
+
+def fetchLNURLPayInfo(identity):
+    global _payInfoCacheChanged
     identityParts = identity.split("@")
     if len(identityParts) != 2: 
         return None, None
@@ -42,26 +341,59 @@ def getLNURLPayInfo(identity):
     if domainname.endswith(".onion"): 
         protocol = "http"
         useTor = True
+    elif domainname.lower() in getHttpDomains():
+        protocol = "http"
     url = f"{protocol}://{domainname}/.well-known/lnurlp/{username}"
-    j = geturl(useTor, url, "{}", {}, "Get LNURL Pay Info")
+    currentTime, _ = utils.getTimes()
+    cacheKey = identity.lower()
+    with _payInfoCacheLock:
+        cached = loadPayInfoCache().get(cacheKey)
+    if cached is not None and cached["expires"] > currentTime:
+        return dict(cached["info"]), url
+    j, resp = geturlresponse(useTor, url, "{}", {}, "Get LNURL Pay Info")
+    if type(j) is not dict: return j, url
+    failed = isPayInfoFailure(j, resp)
+    cacheSeconds = getPayInfoFailureCacheSeconds() if failed else getPayInfoCacheSeconds()
+    if resp is not None:
+        providerSeconds = getCacheControlSeconds(resp)
+        if providerSeconds is not None: cacheSeconds = min(cacheSeconds, providerSeconds)
+    with _payInfoCacheLock:
+        if cacheSeconds > 0:
+            loadPayInfoCache()[cacheKey] = {"info": {k: j[k] for k in payInfoFields if k in j}, "failed": failed, "expires": currentTime + cacheSeconds}
+            _payInfoCacheChanged = True
+        elif cacheKey in loadPayInfoCache():
+            del loadPayInfoCache()[cacheKey]
+            _payInfoCacheChanged = True
     return j, url
 
-def isLNURLProviderAllowed(identity):
-    identityParts = identity.split("@")
-    if len(identityParts) != 2: return False
-    domainname = identityParts[1]
-    if "denyProviders" in config:
-        if domainname in config["denyProviders"]:
-            return False
-    return True
+def flushPayInfoCache():
+    # saves the cache if changed, dropping expired entries
+    global _payInfoCacheChanged
+    with _payInfoCacheLock:
+        if not _payInfoCacheChanged: return
+        currentTime, _ = utils.getTimes()
+        payInfoCache = loadPayInfoCache()
+        for cacheKey in [k for k, v in payInfoCache.items() if v["expires"] <= currentTime]:
+            del payInfoCache[cacheKey]
+        files.saveJsonFile(getPayInfoCacheFilename(), payInfoCache)
+        _payInfoCacheChanged = False
 
-def isLNURLCallbackAllowed(callback):
-    if "denyProviders" not in config: return True
-    parseresult = urllib.parse.urlparse(callback)
-    if parseresult.netloc in config["denyProviders"]:
+def isProviderHostAllowed(host, botConfig=None):
+    # checks the host against the provider policy of the server, and then
+    # that of the bot, which may deny further providers
+    if not policy.isHostAllowed(host, config.get("denyProviders", []), config.get("allowProviders", [])):
         return False
+    if botConfig is not None:
+        if not policy.isHostAllowed(host, botConfig.get("denyProviders", []), botConfig.get("allowProviders", [])):
+            return False
     return True
 
+def isLNURLProviderAllowed(identity, botConfig=None):
+    return isProviderHostAllowed(getIdentityHost(identity), botConfig)
+
+def isLNURLCallbackAllowed(callback, botConfig=None):
+    return isProviderHostAllowed(getUrlHost(callback), botConfig)
+
 def getInvoiceFromZapRequest(callback, satsToZap, zapRequest, bech32lnurl):
     logger.debug(f"Requesting invoice from LNURL service using zap request")
     encoded = getEncodedZapRequest(zapRequest)
@@ -76,7 +408,8 @@ def getInvoiceFromZapRequest(callback, satsToZap, zapRequest, bech32lnurl):
     j = geturl(useTor, url, "{}", {}, "Get Invoice from LN Url Provider")
     return j
 
-def getEncodedZapRequest(zapRequest):
+def getZapRequestJson(zapRequest):
+    # the exact json sent to the provider, which the invoice description hash commits to
     o = {
             "id": zapRequest.id,
             "pubkey": zapRequest.public_key,
@@ -86,10 +419,16 @@ def getEncodedZapRequest(zapRequest):
             "content": zapRequest.content,
             "sig": zapRequest.signature,
         }
-    jd = json.dumps(o)
+    return json.dumps(o)
+
+def getEncodedZapRequest(zapRequest):
+    jd = getZapRequestJson(zapRequest)
     encoded = urllib.parse.quote(jd)
     return encoded
 
+def isDescriptionHashRequired():
+    return config["requireDescriptionHash"] if "requireDescriptionHash" in config else False
+
 def isValidInvoiceResponse(invoiceResponse):
     if "status" in invoiceResponse:
         if invoiceResponse["status"] == "ERROR":
@@ -12,16 +12,23 @@ import random
 import re
 import ssl
 import time
+import botarchive as archive
+import botbolt11 as bolt11
+import botdedup as dedup
 import botfiles as files
 import botutils as utils
+import botjournal as journal
 import botledger as ledger
 import botlnd as lnd
 import botlnurl as lnurl
+import botpayments as payments
+import botreconcile as reconcile
 import botreports as reports
+import botrouter as router
 
 logger = None
 config = None
-handledMessages = {}
+handledMessages = None             # dedup store of DMs handled, loaded with the DM cursor
 botRelayManager = None
 handledEvents = {}
 _relayPublishTime = 2.50
@@ -38,6 +45,7 @@ def connectToRelays():
     logger.debug("Connecting to relays")
     global botRelayManager
     global _nostrRelayConnectsMade
+    global _directMessagesSubscribed
     botRelayManager = RelayManager()
     relays = getNostrRelaysFromConfig(config).copy()
     random.shuffle(relays)
@@ -49,9 +57,12 @@ def connectToRelays():
             botRelayManager.add_relay(url=nostrRelay["url"],read=nostrRelay["read"],write=nostrRelay["write"])
         if type(nostrRelay) is str:
             botRelayManager.add_relay(url=nostrRelay)
+    wakeOnDirectMessages(botRelayManager.message_pool)
     botRelayManager.open_connections({"cert_reqs": ssl.CERT_NONE})
     time.sleep(_relayConnectTime)
     _nostrRelayConnectsMade += 1
+    # the DM subscription is asked for again on the new connections
+    _directMessagesSubscribed = False
 
 def disconnectRelays():
     logger.debug("Disconnecting from relays")
@@ -59,11 +70,13 @@ def disconnectRelays():
     botRelayManager.close_connections()
 
 def reconnectRelays():
+    global _directMessagesSubscribed
     if _relayReconnectExisting:
         for r in botRelayManager.relays.values():
             logger.debug(f"Reconnecting relay {r.url}")
             r.check_reconnect()     # seems to cause a lockup
             logger.debug(f"- relay reconnection complete")
+        _directMessagesSubscribed = False
     else:
         disconnectRelays()
         connectToRelays()
@@ -151,11 +164,21 @@ def checkDirectMessages():
     logger.debug("Checking messages")
     newMessages = []
     events = getDirectMessages()
+    # DMs from before the window the store remembers may have been handled
+    # already, as when a relay ignores since or sends its history again, so
+    # are skipped rather than risk acting on a command twice
+    oldestHandled = _directMessageSince - _directMessageOverlap
     for event in events:
-        # only add those not already in the handledMessages list
-        if event.id not in handledMessages:
+        if event.created_at < oldestHandled or dedup.isExpired(handledMessages, event.created_at):
+            logger.debug(f"Skipping direct message {event.id} from before the handled window")
+            continue
+        # only add those not already in the handledMessages store
+        if not dedup.hasKey(handledMessages, event.id, event.created_at):
             newMessages.append(event)
-            handledMessages[event.id] = event.created_at
+            dedup.addKey(handledMessages, event.id, event.created_at)
+    # advance the cursor before the commands are acted on, so that none is
+    # acted on twice if the bot stops part way
+    if len(newMessages) > 0: saveDirectMessageCursor(max(event.created_at for event in newMessages))
     return newMessages
 
 def isValidSignature(event):
@@ -232,6 +255,8 @@ def processDirectMessages(messages):
             handleEnable(npub, False)
         elif firstWord == "SUPPORT":
             handleSupport(npub, content)
+        elif firstWord == "PROVIDERS" and npub == getOperatorNpub():
+            handleProviders(npub, content)
         else:
             handleHelp(npub, content)
 
@@ -308,6 +333,8 @@ def handleHelp(npub, content):
             handled = True
         elif secondWord == "STATS":
             message = "Reports stats of number of zaps, replies and costs since last ledger rotation"
+            message = f"{message}\nSTATS ALL"
+            message = f"{message}\nSTATS <number of days>"
             handled = True
         elif secondWord == "SUPPORT":
             message = "Attempts to forward a message to the operator of the service."
@@ -340,6 +367,9 @@ def getNostrFieldForNpub(npub, fieldname):
     if fieldname in npubConfig: return npubConfig[fieldname]
     return ""
 
+def setEventBalance(npub, eventBalance):
+    setNostrFieldForNpub(npub, "eventBalance", eventBalance)
+
 def setNostrFieldForNpub(npub, fieldname, fieldvalue):
     npubConfig = getNpubConfigFile(npub)
     changed = False
@@ -378,7 +408,6 @@ def incrementNostrFieldForNpub(npub, fieldname, amount):
 
 # pubkey is a user
 def getRelayListMetadataForPubkey(pubkey):
-    global _monitoredRelayListMetadata
     logger.debug(f"Getting relay list metadata for {pubkey}")
     filters = Filters([Filter(kinds=[10002],authors=[pubkey])])
     botPrivateKey = getBotPrivateKey()
@@ -401,18 +430,13 @@ def getRelayListMetadataForPubkey(pubkey):
     # Find the relay list metadata
     rlmToUse = None
     created_at = 0
-    _tmp = []
-    for rlm in _monitoredRelayListMetadata:
-        if rlm.public_key != pubkey:
-            _tmp.append(rlm)
-            continue
+    for rlm in router.takeFromBuffer(_monitoredRelayListMetadata, pubkey):
         if rlm.created_at < created_at: continue
         if not isValidSignature(rlm): continue
         if rlm.created_at > created_at:
             created_at = rlm.created_at
             rlmToUse = rlm
-    if rlmToUse is not None: _tmp.append(rlmToUse)
-    _monitoredRelayListMetadata = _tmp
+    if rlmToUse is not None: router.addToBuffer(_monitoredRelayListMetadata, rlmToUse)
     return rlmToUse
 
 # pubkey is a recipient (not one of our buts) that may be talking via DM, or we are replying to as kind 1
@@ -856,17 +880,16 @@ def makeRelayManager(npub):
     return newRelayManager
 
 def getProfile(pubkeyHex):
-    global _monitoredProfiles
     logger.debug(f"Getting profile information for {pubkeyHex}")
     profileToUse = None
     profileToReturn = None
     t, _ = utils.getTimes()
     created_at = 0
+    fetchedAt = _profileFetchTimes.get(pubkeyHex, 0)
     # Check current monitored profiles
-    for profile in _monitoredProfiles:
-        if profile.public_key != pubkeyHex: continue
+    for profile in router.peekBuffer(_monitoredProfiles, pubkeyHex):
         if profile.created_at <= created_at: continue
-        if profile.created_at < t - 43200: continue	# 12 hour cache
+        if profile.created_at < t - 43200 and fetchedAt < t - 43200: continue	# 12 hour cache
         if not isValidSignature(profile): continue
         try:
             ec = json.loads(profile.content)
@@ -878,7 +901,10 @@ def getProfile(pubkeyHex):
             logger.warning(f"Error while reading profile from cache for {pubkeyHex}")
             logger.exception(err)
             continue
+    # No profile was found when prefetched moments ago
+    if fetchedAt >= t - 300: return profileToReturn, created_at
     # Check on relays
+    _profileFetchTimes[pubkeyHex] = t
     filters = Filters([Filter(kinds=[EventKind.SET_METADATA],authors=[pubkeyHex])])
     botPrivateKey = getBotPrivateKey()
     t, _ = utils.getTimes()
@@ -898,11 +924,7 @@ def getProfile(pubkeyHex):
     # Remove this subscription
     removeSubscription(botRelayManager, subscription_id)
     # Find the profile
-    _monitoredProfilesTmp = []
-    for profile in _monitoredProfiles:
-        if profile.public_key != pubkeyHex:
-            _monitoredProfilesTmp.append(profile)
-            continue
+    for profile in router.takeFromBuffer(_monitoredProfiles, pubkeyHex):
         if profile.created_at < created_at: continue
         if not isValidSignature(profile): continue
         try:
@@ -914,10 +936,58 @@ def getProfile(pubkeyHex):
             logger.warning(f"Error while getting profile for {pubkeyHex}")
             logger.warning(err)
             continue
-    if profileToUse is not None: _monitoredProfilesTmp.append(profileToUse)
-    _monitoredProfiles = _monitoredProfilesTmp
+    if profileToUse is not None: router.addToBuffer(_monitoredProfiles, profileToUse)
     return profileToReturn, created_at
 
+def prefetchProfiles(pubkeys):
+    # requests the profiles of pubkeys not requested recently from relays in
+    # one subscription per batch, rather than one subscription for each
+    t, _ = utils.getTimes()
+    pubkeys = [p for p in set(pubkeys) if _profileFetchTimes.get(p, 0) < t - 43200]
+    if len(pubkeys) == 0: return
+    logger.debug(f"Prefetching {len(pubkeys)} profiles")
+    botPrivateKey = getBotPrivateKey()
+    batchSize = 100
+    for i in range(0, len(pubkeys), batchSize):
+        batch = pubkeys[i:i + batchSize]
+        filters = Filters([Filter(kinds=[EventKind.SET_METADATA],authors=batch)])
+        subscription_id = f"my_profiles_{t}_{i}"
+        request = [ClientMessageType.REQUEST, subscription_id]
+        request.extend(filters.to_json_array())
+        message = json.dumps(request)
+        botRelayManager.add_subscription(subscription_id, filters)
+        botRelayManager.publish_message(message)
+        time.sleep(_relayPublishTime)
+        # Check if needed to authenticate and publish again if need be
+        if authenticateRelays(botRelayManager, botPrivateKey):
+            botRelayManager.publish_message(message)
+            time.sleep(_relayPublishTime)
+        siftMessagePool()
+        removeSubscription(botRelayManager, subscription_id)
+        for pubkey in batch: _profileFetchTimes[pubkey] = t
+    # Keep only the newest valid profile for each pubkey fetched
+    for pubkey in pubkeys:
+        newest = None
+        for profile in router.takeFromBuffer(_monitoredProfiles, pubkey):
+            if newest is not None and newest.created_at >= profile.created_at: continue
+            if not isValidSignature(profile): continue
+            newest = profile
+        if newest is not None: router.addToBuffer(_monitoredProfiles, newest)
+
+def prefetchRecipients(responseEvents):
+    # fetches the profiles of those replying, and starts getting the LNURL pay
+    # info for their lightning addresses while replies are checked against
+    # conditions, so that both are ready when zapped
+    pubkeys = set(evt.public_key for evt in responseEvents)
+    if len(pubkeys) == 0: return
+    prefetchProfiles(pubkeys)
+    lightningIds = []
+    for pubkey in pubkeys:
+        lightningId, _ = getLightningIdForPubkey(pubkey)
+        valid, _ = isValidLightningId(lightningId)
+        if valid: lightningIds.append(lightningId)
+    lnurl.prefetchLNURLPayInfo(lightningIds)
+
 def checkMainBotProfile():
     botPubkey = getBotPubkey()
     profileOnRelays, _ = getProfile(botPubkey) # getProfileForNpubFromRelays(None, botPubkey)
@@ -1073,18 +1143,14 @@ def getEventSpentSoFar(npub, eventId):
     if fees is not None:
         if "replyMessage" in fees: feesReplyMessage = fees["replyMessage"]
         if "zapEvent" in fees: feesZapEvent = fees["zapEvent"]
-    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
-    utils.makeFolderIfNotExists(basePath)
-    filePaidNpubs = f"{basePath}paidnpubs.json"
-    paidnpubs = files.loadJsonFile(filePaidNpubs, {})
+    paidnpubs = archive.loadEventFile(npub, eventId, "paidnpubs.json", {})
     for v in paidnpubs.values():
         amount = v["amount_sat"] if "amount_sat" in v else 0
         routingfee = v["fee_msat"] if "fee_msat" in v else 0
         eventSpent += float(amount)
         eventSpent += float(float(routingfee)/float(1000))
         eventSpent += float(float(feesZapEvent)/float(1000))
-    fileReplies = f"{basePath}replies.json"
-    replies = files.loadJsonFile(fileReplies, [])
+    replies = archive.loadEventFile(npub, eventId, "replies.json", [])
     eventSpent += (len(replies) * (float(feesReplyMessage)/float(1000)))
     return eventSpent
 
@@ -1146,9 +1212,8 @@ def handleCredits(npub, content):
     currentInvoice["r_hash"] = newInvoice["r_hash"]
     currentInvoice["payment_request"] = payment_request
     currentInvoice["add_index"] = newInvoice["add_index"]
-    if "activeServer" in lnd.config:
-        if lnd.config["activeServer"] is not None:
-            currentInvoice["invoice_server"] = lnd.config["activeServer"]
+    if newInvoice["invoice_server"] is not None:
+        currentInvoice["invoice_server"] = newInvoice["invoice_server"]
     setNostrFieldForNpub(npub, "currentInvoice", currentInvoice)
     # save to outstanding invoices
     lnd.monitorInvoice(currentInvoice)
@@ -1158,27 +1223,12 @@ def handleCredits(npub, content):
     sendDirectMessage(npub, message)
 
 def getCreditsSummary(npub):
-    filename = ledger.getUserLedgerFilename(npub)
-    ledgerLines = files.loadJsonFile(filename)
-    if ledgerLines is None: ledgerLines = []
-    ledgerSummary = {
-        "CREDITS APPLIED": 0,
-        "ZAPS": 0,
-        "REPLY MESSAGE": 0,
-        "ROUTING FEES": 0,
-        "SERVICE FEES": 0
-    }
-    for ledgerEntry in ledgerLines:
-        type = ledgerEntry["type"]
-        credits = ledgerEntry["credits"]
-        mcredits = ledgerEntry["mcredits"]
-        if type in ledgerSummary:
-            value = float(ledgerSummary[type])
-            value += float(credits)
-            value += float((mcredits/1000))
-            ledgerSummary[type] = value
+    ledgerSummary = ledger.getLedgerSummary(npub)
     text = ""
-    for k, v in ledgerSummary.items():
+    for k in ("CREDITS APPLIED", "ZAPS", "REPLY MESSAGE", "ROUTING FEES", "SERVICE FEES"):
+        v = 0
+        if k in ledgerSummary["totals"]:
+            v = float(ledgerSummary["totals"][k]["credits"]) + float(ledgerSummary["totals"][k]["mcredits"]/1000)
         l = f"{k}S" if k in ("REPLY MESSAGE") else k
         text = f"{text}\n{l}: {v:.3f}"
     balance = ledger.getCreditBalance(npub)
@@ -1288,45 +1338,56 @@ def handleStatus(npub, content):
         message = f"{message}\n\n{helpMessage}"
     sendDirectMessage(npub, message)
 
+def handleProviders(npub, content):
+    # PROVIDERS          health of LN URL Providers contacted since startup, for the operator
+    providers = sorted(lnurl.getProviderHealth(), key=lambda p: (p["state"] == "CLOSED", -p["error_rate"]))
+    if len(providers) == 0:
+        sendDirectMessage(npub, "No LN URL Providers contacted since startup")
+        return
+    message = "LN URL Providers (state, requests, error rate, p50/p95 ms)"
+    for p in providers:
+        message = f"{message}\n{p['host']}: {p['state']}, {p['requests']}, {p['error_rate']:.0%}, {p['p50_ms']}/{p['p95_ms']}"
+    sendDirectMessage(npub, message)
+
 def handleStats(npub, content):
-    filename = ledger.getUserLedgerFilename(npub)
-    ledgerLines = files.loadJsonFile(filename)
-    if ledgerLines is None: ledgerLines = []
-    ledgerSummary = {
-        "CREDITS APPLIED": {"qty":0, "value":0},
-        "ZAPS": {"qty":0, "value":0},
-        "REPLY MESSAGE": {"qty":0, "value":0},
-        "ROUTING FEES": {"qty":0, "value":0},
-        "SERVICE FEES": {"qty":0, "value":0},
-    }
-    uniqueEvents = []
-    for ledgerEntry in ledgerLines:
-        if "description" not in ledgerEntry: continue
-        description = ledgerEntry["description"]
-        if description == "Carry over from ledger rotation":
-            diso = ledgerEntry["created_at_iso"]
-            continue
-        if diso is None: ledgerEntry["created_at_iso"]
-        if "for reply to" in description:
-            eventId = str(description.split("for reply to")[1]).strip()
-            if eventId not in uniqueEvents: uniqueEvents.append(eventId)
-        type = ledgerEntry["type"]
-        if type not in ledgerSummary.keys(): continue
-        credits = ledgerEntry["credits"]
-        mcredits = ledgerEntry["mcredits"]
-        vcredits = float(credits) + float((mcredits/1000))
-        ledgerSummary[type]["qty"] = ledgerSummary[type]["qty"] + 1
-        ledgerSummary[type]["value"] = ledgerSummary[type]["value"] + vcredits
+    # STATS              since the last ledger rotation
+    # STATS ALL          all time, from the ledger manifest
+    # STATS <days>       for the past number of days
+    since = None
+    includeArchived = False
+    words = content.split()
+    if len(words) > 1:
+        secondWord = str(words[1]).upper()
+        if secondWord == "ALL":
+            includeArchived = True
+        elif str(secondWord).isdigit():
+            includeArchived = True
+            t, _ = utils.getTimes()
+            since = t - (int(secondWord) * 86400)
+        else:
+            sendDirectMessage(npub, "Please specify STATS, STATS ALL, or STATS followed by a number of days (e.g. STATS 30)")
+            return
+    ledgerSummary = ledger.getLedgerSummary(npub, since=since, includeArchived=includeArchived)
+    diso = ledgerSummary["first_iso"]
     if diso is None:
         message = "Stats not yet available"
     else:
-        message = f"Stats since the last ledger rotation on {diso}"
-        for k, v in ledgerSummary.items():
+        if not includeArchived:
+            message = f"Stats since the last ledger rotation on {diso}"
+        elif since is None:
+            message = f"Stats for all time since {diso}"
+        else:
+            message = f"Stats for the past {words[1]} days since {diso}"
+        for k in ("CREDITS APPLIED", "ZAPS", "REPLY MESSAGE", "ROUTING FEES", "SERVICE FEES"):
+            n = 0
+            o = 0
+            if k in ledgerSummary["totals"]:
+                v = ledgerSummary["totals"][k]
+                n = v["qty"]
+                o = float(v["credits"]) + float((v["mcredits"]/1000))
             l = f"{k}S" if k in ("REPLY MESSAGE") else k
-            n = v["qty"]
-            o = v["value"]
             message = f"{message}\n{l}: {n} ({o:.3f} total sats)"
-        t = len(uniqueEvents)
+        t = len(ledgerSummary["events"])
         message = f"{message}\nEVENTS MONITORED: {t}"
     sendDirectMessage(npub, message)
 
@@ -1418,10 +1479,8 @@ def getEnabledBots():
     return enabledBots
 
 def getEventByHex(npub, eventHex):
-    global _monitoredEvent
     logger.debug(f"Getting event information for {eventHex}")
     filters = Filters([Filter(event_ids=[eventHex])])
-    events = []
     botPrivateKey = getBotPrivateKey()
     t, _ = utils.getTimes()
     subscription_id = f"my_eventbyid_{t}"
@@ -1440,13 +1499,7 @@ def getEventByHex(npub, eventHex):
     # Remove this subscription
     removeSubscription(botRelayManager, subscription_id)
     # Find the event
-    _monitoredEventTmp = []
-    for event in _monitoredEvent:
-        if event.id == eventHex:
-            events.append(event)
-        else:
-            _monitoredEventTmp.append(event)
-    _monitoredEvent = _monitoredEventTmp
+    events = router.takeFromBuffer(_monitoredEvent, eventHex)
     if len(events) > 0: return events[0]
     return None
 
@@ -1484,20 +1537,27 @@ def authenticateRelays(theRelayManager, pk):
     return True
 
 _directMessageSince = None
-_directMessages = []
-_monitoredEvents = []
-_monitoredPubkeys = []
-_monitoredProfiles = []
-_monitoredEvent = []
-_monitoredRelayListMetadata = []
+_directMessagesSubscribed = False
+_directMessageOverlap = 300         # seconds before the cursor that DMs are asked for again
+_profileFetchTimes = {}             # pubkey -> when its profile was last requested from relays
+# Events from relays are buffered by subscription, indexed by what consumers
+# look them up by, and dropped once more or older than the limits
+_bufferMaxEvents = 10000
+_bufferMaxAge = 3600
+_directMessages = router.makeBuffer(lambda e: [e.kind], 1000, _bufferMaxAge)
+_monitoredEvents = router.makeBuffer(lambda e: [t[1] for t in e.tags if len(t) >= 2 and t[0] == 'e'], _bufferMaxEvents, _bufferMaxAge)
+_monitoredPubkeys = router.makeBuffer(lambda e: [e.public_key], _bufferMaxEvents, _bufferMaxAge)
+_monitoredProfiles = router.makeBuffer(lambda e: [e.public_key], _bufferMaxEvents, 86400)
+_monitoredEvent = router.makeBuffer(lambda e: [e.id], 1000, _bufferMaxAge)
+_monitoredRelayListMetadata = router.makeBuffer(lambda e: [e.public_key], 1000, 86400)
+router.addRoute("my_dms", lambda e: router.addToBuffer(_directMessages, e))
+router.addRoute("my_events", lambda e: router.addToBuffer(_monitoredEvents, e))
+router.addRoute("my_pubkeys", lambda e: router.addToBuffer(_monitoredPubkeys, e))
+router.addRoute("my_profiles", lambda e: router.addToBuffer(_monitoredProfiles, e))
+router.addRoute("my_eventbyid", lambda e: router.addToBuffer(_monitoredEvent, e))
+router.addRoute("pubkey_rlm", lambda e: router.addToBuffer(_monitoredRelayListMetadata, e))
 # This proc must understand all subscriptions
 def siftMessagePool():
-    global _directMessages
-    global _monitoredEvents
-    global _monitoredPubkeys
-    global _monitoredProfiles
-    global _monitoredEvent
-    global _monitoredRelayListMetadata
     botPrivateKey = getBotPrivateKey()
     # AUTH
     authenticateRelays(botRelayManager, botPrivateKey)
@@ -1505,13 +1565,7 @@ def siftMessagePool():
     while botRelayManager.message_pool.has_events():
         event_msg = botRelayManager.message_pool.get_event()
         subid = event_msg.subscription_id
-        if subid.startswith("my_dms"): _directMessages.append(event_msg.event)
-        elif subid.startswith("my_events"): _monitoredEvents.append(event_msg.event)
-        elif subid.startswith("my_pubkeys"): _monitoredPubkeys.append(event_msg.event)
-        elif subid.startswith("my_profiles"): _monitoredProfiles.append(event_msg.event)
-        elif subid.startswith("my_eventbyid"): _monitoredEvent.append(event_msg.event)
-        elif subid.startswith("pubkey_rlm_"): _monitoredRelayListMetadata.append(event_msg.event)
-        else:
+        if not router.routeEvent(subid, event_msg.event):
             u = event_msg.url
             c = event_msg.event.content
             logger.debug(f"Unexpected event from relay {u} with subscription {subid}: {c}")
@@ -1527,54 +1581,71 @@ def siftMessagePool():
         botRelayManager.message_pool.get_eose_notice()
         botRelayManager.message_pool.eose_notices.task_done()
 
-def getDirectMessages():
+def getDirectMessageCursorFilename():
+    return f"{files.dataFolder}dmcursor.json"
+
+def loadDirectMessageCursor():
+    # the time of the newest DM handled, and the DMs handled within the
+    # window of time they may be received again
     global _directMessageSince
-    subscription_dm = "my_dms"
-    if _directMessageSince is None:
+    global handledMessages
+    handledMessages = dedup.makeDedupStore(_directMessageOverlap * 2, expectedKeys=2000)
+    cursor = files.loadJsonFile(getDirectMessageCursorFilename())
+    if cursor is None:
         _directMessageSince, _ = utils.getTimes()
-    newSubscriptionEachCall = True
-    filtersince=None
-    if newSubscriptionEachCall:
-        t, _ = utils.getTimes()
-        subscription_dm = f"{subscription_dm}_{t}"
-        filtersince=t-300
+        return
+    _directMessageSince = cursor["since"]
+    if "ring" in cursor["handled"]:
+        handledMessages = dedup.dedupStoreFromJson(cursor["handled"])
     else:
-        filtersince=_directMessageSince
-    added = False
-    botPrivateKey = getBotPrivateKey()
-    botPubkey = getBotPubkey()
-    filters = Filters([Filter(since=filtersince,pubkey_refs=[botPubkey],kinds=[EventKind.ENCRYPTED_DIRECT_MESSAGE])])
-    # Check relays we've configured, adding subscription if not yet present
+        for k, v in cursor["handled"].items(): dedup.addKey(handledMessages, k, v)
+
+def saveDirectMessageCursor(createdAt):
+    global _directMessageSince
+    if _directMessageSince is None: loadDirectMessageCursor()
+    # a DM dated in the future must not move the cursor past DMs yet to come
+    t, _ = utils.getTimes()
+    _directMessageSince = max(_directMessageSince, min(createdAt, t))
+    files.saveJsonFile(getDirectMessageCursorFilename(), {"since": _directMessageSince, "handled": dedup.dedupStoreToJson(handledMessages)})
+
+def wakeOnDirectMessages(messagePool):
+    # relays push DMs into the message pool from their own threads, so wake
+    # the main loop to handle them rather than waiting out its sleep
+    addMessage = messagePool.add_message
+    def addMessageAndWake(message, url):
+        addMessage(message, url)
+        if '"my_dms"' in message: lnd.wakeMainLoop()
+    messagePool.add_message = addMessageAndWake
+
+def subscribeDirectMessages():
+    # one subscription to DMs for the bot stays open on the relays, asking
+    # for those since the cursor so that any sent while disconnected arrive
+    global _directMessagesSubscribed
+    subscription_dm = "my_dms"
+    filters = Filters([Filter(since=_directMessageSince-_directMessageOverlap,pubkey_refs=[getBotPubkey()],kinds=[EventKind.ENCRYPTED_DIRECT_MESSAGE])])
     for relayConfig in botRelayManager.relays.values():
-        found = False
-        for subId in relayConfig.subscriptions.keys():
-            if subId == subscription_dm:
-                found = True
-                break
-        if found: continue
+        if subscription_dm in relayConfig.subscriptions: continue
         relayConfig.add_subscription(id=subscription_dm, filters=filters)
-        added = True
-    # If we added to any relay, publish it
-    if added:
-        request = [ClientMessageType.REQUEST, subscription_dm]
-        request.extend(filters.to_json_array())
-        message = json.dumps(request)
+    request = [ClientMessageType.REQUEST, subscription_dm]
+    request.extend(filters.to_json_array())
+    message = json.dumps(request)
+    botRelayManager.publish_message(message)
+    time.sleep(_relayPublishTime)
+    # Check if needed to authenticate and publish again if need be
+    if authenticateRelays(botRelayManager, getBotPrivateKey()):
         botRelayManager.publish_message(message)
         time.sleep(_relayPublishTime)
-        # Check if needed to authenticate and publish again if need be
-        if authenticateRelays(botRelayManager, botPrivateKey):
-            botRelayManager.publish_message(message)
-            time.sleep(_relayPublishTime)
-    # Sift through messages
+    _directMessagesSubscribed = True
+
+def getDirectMessages():
+    if _directMessageSince is None: loadDirectMessageCursor()
+    if not _directMessagesSubscribed: subscribeDirectMessages()
+    # Sift through messages pushed by relays
     siftMessagePool()
-    # Remove this subscription if making new each time
-    if newSubscriptionEachCall:
-        removeSubscription(botRelayManager, subscription_dm)
-    # Return outstanding messages array
-    return _directMessages
+    # Return outstanding messages, which are then cleared
+    return router.takeFromBuffer(_directMessages, EventKind.ENCRYPTED_DIRECT_MESSAGE)
 
 def getEventReplies(eventHex):
-    global _monitoredEvents
     subscription_events = "my_events"
     newSubscriptionEachCall = True
     filtersince=None
@@ -1646,9 +1717,7 @@ def getEventReplies(eventHex):
         removeSubscription(botRelayManager, subscription_events)
     # Get events for just this eventHex
     _replyEvents = []
-    _monitoredEventsTmp = []
-    for eventReply in _monitoredEvents:
-        removeFromMonitored = False
+    for eventReply in router.takeFromBuffer(_monitoredEvents, eventHex):
         addToReturnList = False
         for tagItem in eventReply.tags:
             if len(tagItem) < 2: continue # exclude tags without values
@@ -1659,12 +1728,8 @@ def getEventReplies(eventHex):
                     break
                 continue
             addToReturnList = True
-            removeFromMonitored = True
         if addToReturnList:
             _replyEvents.append(eventReply)
-        elif not removeFromMonitored:
-            _monitoredEventsTmp.append(eventReply)
-    _monitoredEvents = _monitoredEventsTmp
     return _replyEvents
 
 # gets replies visible on the target npubs inbox
@@ -1755,7 +1820,6 @@ def getPubkeyEventsUsingOutbox(pubkey):
     return _replyEvents
 
 def getPubkeyEventsUsingBotRelayManager(pubkeyHex):
-    global _monitoredPubkeys
     subscription_pubkeys = "my_pubkeys"
     newSubscriptionEachCall = True
     filtersince=None
@@ -1811,19 +1875,7 @@ def getPubkeyEventsUsingBotRelayManager(pubkeyHex):
     if newSubscriptionEachCall:
         removeSubscription(botRelayManager, subscription_pubkeys)
     # Get events for just this pubkeyHex
-    _replyEvents = []
-    _monitoredPubkeysTmp = []
-    for eventReply in _monitoredPubkeys:
-        removeFromMonitored = False
-        addToReturnList = False
-        if eventReply.public_key == pubkeyHex:
-            addToReturnList = True
-            removeFromMonitored = True
-        if addToReturnList:
-            _replyEvents.append(eventReply)
-        elif not removeFromMonitored:
-            _monitoredPubkeysTmp.append(eventReply)
-    _monitoredPubkeys = _monitoredPubkeysTmp
+    _replyEvents = router.takeFromBuffer(_monitoredPubkeys, pubkeyHex)
     return _replyEvents
 
 def getListFieldCount(list, fieldname, value=None):
@@ -1858,6 +1910,7 @@ def processEvents(npub, responseEvents, botConfig):
     zapMessage = botConfig["zapMessage"] if "zapMessage" in botConfig else "Thank you!"
     balance = ledger.getCreditBalance(npub)
     # load existing data
+    archive.ensureEventAvailable(npub, eventId)
     basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
     utils.makeFolderIfNotExists(basePath)
     fileResponses = f"{basePath}responses.json"
@@ -1892,6 +1945,7 @@ def processEvents(npub, responseEvents, botConfig):
     # iterate events to find those matching conditions
     candidateEventsToZap = {} # k = evt.id, v = public_key, amount (zapmessage comes later)
     eventsToReply = {}        # k = evt.id, v = public_key, message
+    prefetchRecipients([evt for evt in sortedEvents if evt.id not in responses])
     for evt in sortedEvents: #response in sortedEvents:
         #evt = Event(response)
         if not isValidSignature(evt):
@@ -2041,6 +2095,7 @@ def processEvents(npub, responseEvents, botConfig):
     # save participants so far
     files.saveJsonFile(fileParticipants, participants)
     # reduce eventsToZap to max amount per pubkey in this set
+    journaledResponses = len(responses)
     eventsToZap = {}
     for responseId1, zap1 in candidateEventsToZap.items():
         if responseId1 in eventsToZap.keys(): continue
@@ -2055,24 +2110,46 @@ def processEvents(npub, responseEvents, botConfig):
                         zapAmount = zap2["amount"]
                         zapRandomWinner = zap2["randomWinner"]
         eventsToZap[responseId1] = {"public_key": zapPubkey, "amount": zapAmount, "randomWinner": zapRandomWinner}
-    # process zaps
-    for k, v in eventsToZap.items():
+    # process zaps. Payments are sent concurrently, with the amount, fee limit
+    # and service fee reserved against balances until each is settled. Those
+    # still in progress once all are submitted are settled by settlePayments
+    zapsToProcess = list(eventsToZap.items())
+    # pay the lightning addresses most likely to succeed first
+    zapsToProcess.sort(key=lambda zap: lnd.getPaymentSuccessRate(getCachedLightningId(zap[1]["public_key"])), reverse=True)
+    reservedBalance = payments.getReserved(npub)
+    reservedEvent = payments.getReserved(npub, eventId)
+    while True:
+        # settle completed payments, journaling their outcome to be
+        # checkpointed into the state files for the event after the batch
+        for payment, paymentResult in payments.getCompletedPayments(npub, eventId):
+            reservedBalance -= payment["reserved"]
+            reservedEvent -= payment["reserved"]
+            paymentCost = journalZapPayment(npub, eventId, payment, paymentResult, paidnpubs, paidluds, responses[journaledResponses:], eventbalance)
+            journaledResponses = len(responses)
+            balance -= paymentCost
+            eventbalance -= paymentCost
+            botConfig["eventBalance"] = eventbalance
+        if len(zapsToProcess) == 0: break
+        k, v = zapsToProcess.pop(0)
         # k is eventid being replied to
         pubkey = v["public_key"]
+        if pubkey in [p["pubkey"] for p in payments.getQueuedPayments(npub, eventId)]:
+            logger.debug(f"Payment to pubkey {pubkey} for this event is still in progress")
+            continue
         amount = v["amount"]
-        amountNeeded = (amount + lnd.config["feeLimit"])
+        amountNeeded = (amount + lnd.getFeeLimit())
         randomWinnerSlot = v["randomWinner"]
         # ensure adequate funds overall
-        if balance < amountNeeded:
+        if balance - reservedBalance < amountNeeded:
             if k in eventsToReply.keys(): del eventsToReply[k]
             logger.debug("Account balance too low to zap user")
-            handleWarningLowBalance(npub, eventId, balance)
+            handleWarningLowBalance(npub, eventId, balance - reservedBalance)
             continue
         # ensure adequate funds for event
-        if eventbudget > 0 and eventbalance < amountNeeded:
+        if eventbudget > 0 and eventbalance - reservedEvent < amountNeeded:
             if k in eventsToReply.keys(): del eventsToReply[k]
             logger.debug("Event Budget too low to zap user")
-            handleWarningEventBudget(npub, eventId, eventbudget, eventbalance)
+            handleWarningEventBudget(npub, eventId, eventbudget, eventbalance - reservedEvent)
             continue
         if k not in responses: responses.append(k)
         # get lightning id
@@ -2087,13 +2164,16 @@ def processEvents(npub, responseEvents, botConfig):
                 replies.append({"id":k,"pubkey":pubkey,"message":replyMessage})
                 files.saveJsonFile(fileReplies, replies)
             continue
-        if lightningId in paidluds.keys():
+        if lightningId in paidluds.keys() or lightningId in [p["lightningId"] for p in payments.getQueuedPayments(npub, eventId)]:
             logger.debug(f"Lightning address {lightningId} was already paid for this event ({name} with pubkey: {pubkey})")
             continue
-        # get callback info and invoice
-        lnurlPayInfo, lnurlp = lnurl.getLNURLPayInfo(lightningId)
-        if not lnurl.isLNURLProviderAllowed(lightningId):
-            logger.warning(f"LN Provider of identity {lightningId} is on the denyProviders list and cannot be zapped at this time ({name} with pubkey: {pubkey})")
+        # defer to a later cycle when the provider is failing, rather than wait on it
+        if lnurl.isProviderTripped(lnurl.getIdentityHost(lightningId)):
+            logger.debug(f"Deferring zap to {lightningId} while its LN Provider is failing ({name} with pubkey: {pubkey})")
+            responses.remove(k)
+            continue
+        if not lnurl.isLNURLProviderAllowed(lightningId, botConfig):
+            logger.warning(f"LN Provider of identity {lightningId} is denied by the provider policy and cannot be zapped at this time ({name} with pubkey: {pubkey})")
             replyMessage = f"Unable to zap: Provider for {lightningId} is not allowed"
             if not isMessageInReplies(replies, k, pubkey, replyMessage):
                 newbalance = replyToEvent(npub, k, pk, pubkey, replyMessage, feesReplyMessage)
@@ -2101,7 +2181,9 @@ def processEvents(npub, responseEvents, botConfig):
                 replies.append({"id":k,"pubkey":pubkey,"message":replyMessage})
                 files.saveJsonFile(fileReplies, replies)
             continue
-        callback, bech32lnurl, userMessage = validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, name, amount, pubkey)
+        # get callback info and invoice
+        lnurlPayInfo, lnurlp = lnurl.getLNURLPayInfo(lightningId)
+        callback, bech32lnurl, userMessage = validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, name, amount, pubkey, botConfig)
         if callback is None or bech32lnurl is None or userMessage is not None:
             replyMessage = userMessage
             if not isMessageInReplies(replies, k, pubkey, replyMessage):
@@ -2110,6 +2192,10 @@ def processEvents(npub, responseEvents, botConfig):
                 replies.append({"id":k,"pubkey":pubkey,"message":replyMessage})
                 files.saveJsonFile(fileReplies, replies)
             continue
+        if lnurl.isProviderTripped(lnurl.getUrlHost(callback)):
+            logger.debug(f"Deferring zap to {lightningId} while its LN Provider callback is failing ({name} with pubkey: {pubkey})")
+            responses.remove(k)
+            continue
         logger.debug(f"Preparing zap request for {amount} sats to {lightningId} ({name})")
         kind9734 = makeZapRequest(npub, botConfig, amount, zapMessage, pubkey, k, bech32lnurl)
         invoice = lnurl.getInvoiceFromZapRequest(callback, amount, kind9734, bech32lnurl)
@@ -2137,28 +2223,34 @@ def processEvents(npub, responseEvents, botConfig):
                 replies.append({"id":k,"pubkey":pubkey,"message":replyMessage})
                 files.saveJsonFile(fileReplies, replies)
             continue
+        if not bolt11.isValidDescriptionHash(decodedInvoice, lnurl.getZapRequestJson(kind9734)):
+            logger.warning(f"LN Provider of identity {lightningId} returned an invoice whose description hash does not match the zap request. ({name} with pubkey: {pubkey})")
+            if lnurl.isDescriptionHashRequired():
+                replyMessage = f"Unable to zap: Provider for {lightningId} returned unacceptable invoice not matching the zap request."
+                if not isMessageInReplies(replies, k, pubkey, replyMessage):
+                    newbalance = replyToEvent(npub, k, pk, pubkey, replyMessage, feesReplyMessage)
+                    eventbalance -= balance - newbalance; balance = newbalance
+                    replies.append({"id":k,"pubkey":pubkey,"message":replyMessage})
+                    files.saveJsonFile(fileReplies, replies)
+                continue
+        if not lnd.isDestinationRoutable(decodedInvoice.get("destination"), amount):
+            # defer to a later cycle, as the node may be reachable again by then
+            logger.warning(f"Deferring zap to {lightningId} as no route is expected to its node within the fee limit ({name} with pubkey: {pubkey})")
+            responses.remove(k)
+            continue
         # ok to pay
         paymentTime, paymentTimeISO = utils.getTimes()
-        paymentStatus, paymentFees, paymentHash, paymentIndex = lnd.payInvoice(paymentRequest)
-        if paymentStatus != "FAILED":
-            paidnpubs[pubkey] = {"lightning_id":lightningId, "amount_sat": amount, "payment_time": paymentTime, "payment_time_iso": paymentTimeISO, "randomWinner": randomWinnerSlot}
-            paidluds[lightningId] = {"amount_sat": amount, "payment_time": paymentTime, "payment_time_iso": paymentTimeISO}
-            if verifyUrl is not None: paidnpubs[pubkey]["payment_verify_url"] = verifyUrl
-            balance = ledger.recordEntry(npub, "ZAPS", -1 * amount, 0, f"Zap {lightningId} for reply to {eventId}")
-            balance = ledger.recordEntry(npub, "ROUTING FEES", 0, -1 * paymentFees, f"Zap {lightningId} for reply to {eventId}")
-            balance = ledger.recordEntry(npub, "SERVICE FEES", 0, -1 * feesZapEvent, f"Service fee for zap {lightningId}")
-            eventbalance -= float(amount) + (float(paymentFees)/float(1000)) + (float(feesZapEvent)/float(1000))
-            paidnpubs[pubkey].update({'payment_status': paymentStatus, 'fee_msat': paymentFees, 'payment_hash': paymentHash, 'payment_index': paymentIndex})
-            if "activeServer" in lnd.config:
-                paymentServer = lnd.config["activeServer"]
-                paidnpubs[pubkey].update({'payment_server': paymentServer})
-        # Save responses, paidnpubs, and paidluds after each payment
-        files.saveJsonFile(fileResponses, responses)
-        files.saveJsonFile(filePaidNpubs, paidnpubs)
-        files.saveJsonFile(filePaidLuds, paidluds)
-        # Save event balance
-        botConfig["eventBalance"] = eventbalance
-        setNostrFieldForNpub(npub, "eventBalance", eventbalance)
+        paymentReserve = float(amountNeeded) + (float(feesZapEvent)/float(1000))
+        if payments.submitPayment(paymentRequest, {"npub": npub, "eventId": eventId, "pubkey": pubkey, "lightningId": lightningId, "amount": amount,
+            "randomWinner": randomWinnerSlot, "verifyUrl": verifyUrl, "payment_time": paymentTime, "payment_time_iso": paymentTimeISO,
+            "payment_hash": decodedInvoice["payment_hash"], "destination": decodedInvoice.get("destination"), "reserved": paymentReserve,
+            "fees_zap": feesZapEvent}):
+            reservedBalance += paymentReserve
+            reservedEvent += paymentReserve
+    if len(responses) > journaledResponses:
+        journal.appendRecord(npub, eventId, {"responses": responses[journaledResponses:]})
+    # Apply the journaled payments to responses, paidnpubs, paidluds, ledger and config
+    journal.checkpoint(npub, eventId, setEventBalance)
     # process reply messages
     for k, v in eventsToReply.items():
         amountNeeded = (float(feesReplyMessage)/float(1000))
@@ -2183,6 +2275,68 @@ def processEvents(npub, responseEvents, botConfig):
     # return the created_at value of the most recent event we processed
     return newest
 
+def journalZapPayment(npub, eventId, payment, paymentResult, paidnpubs, paidluds, responses, eventBalance):
+    # journals the outcome of a payment, returning its cost
+    paymentStatus, _, paymentHash, paymentIndex = paymentResult
+    if paidnpubs.get(payment["pubkey"], {}).get("payment_hash") == payment["payment_hash"]:
+        # journaled before a restart, but not yet removed from the queue
+        payments.completePayment(payment)
+        return 0
+    journalRecord, paymentCost = makeZapJournalRecord(eventId, payment, paymentResult, paidnpubs, paidluds, payment["fees_zap"])
+    lnd.recordPaymentOutcome(payment["destination"], paymentStatus, payment["lightningId"], payment.get("failure_reason"))
+    if paymentStatus in archive.unresolvedPaymentStatuses and paymentHash is not None:
+        reconcile.watchPayment(paymentHash, npub, eventId, payment["pubkey"], paymentIndex, payment["payment_server"])
+    journalRecord["responses"] = responses
+    if eventBalance is not None: journalRecord["eventBalance"] = eventBalance - paymentCost
+    journal.appendRecord(npub, eventId, journalRecord)
+    payments.completePayment(payment)
+    return paymentCost
+
+def settlePayments():
+    # settles payments that completed after their event was processed
+    for payment, paymentResult in payments.getCompletedPayments():
+        npub = payment["npub"]
+        eventId = payment["eventId"]
+        try:
+            archive.ensureEventAvailable(npub, eventId)
+            basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+            paidnpubs = files.loadJsonFile(f"{basePath}paidnpubs.json", {})
+            paidluds = files.loadJsonFile(f"{basePath}paidluds.json", {})
+            npubConfig = getNpubConfigFile(npub)
+            eventBalance = None
+            if npubConfig.get("eventId") == eventId and "eventBalance" in npubConfig:
+                eventBalance = float(npubConfig["eventBalance"])
+            journalZapPayment(npub, eventId, payment, paymentResult, paidnpubs, paidluds, [], eventBalance)
+            journal.checkpoint(npub, eventId, setEventBalance)
+        except Exception as e:
+            logger.warning(f"Error settling payment {payment['payment_hash']} for {npub}: {str(e)}")
+
+def makeZapJournalRecord(eventId, payment, paymentResult, paidnpubs, paidluds, feesZapEvent):
+    # returns the journal record for a completed payment, updating paidnpubs
+    # and paidluds, and the credits spent on it
+    paymentStatus, paymentFees, paymentHash, paymentIndex = paymentResult
+    journalRecord = {}
+    if paymentStatus == "FAILED": return journalRecord, 0
+    pubkey = payment["pubkey"]
+    lightningId = payment["lightningId"]
+    amount = payment["amount"]
+    paymentTime = payment["payment_time"]
+    paymentTimeISO = payment["payment_time_iso"]
+    paidnpubs[pubkey] = {"lightning_id":lightningId, "amount_sat": amount, "payment_time": paymentTime, "payment_time_iso": paymentTimeISO, "randomWinner": payment["randomWinner"]}
+    paidluds[lightningId] = {"amount_sat": amount, "payment_time": paymentTime, "payment_time_iso": paymentTimeISO}
+    if payment["verifyUrl"] is not None: paidnpubs[pubkey]["payment_verify_url"] = payment["verifyUrl"]
+    journalRecord["ledger"] = [
+        {"type": "ZAPS", "credits": -1 * amount, "mcredits": 0, "description": f"Zap {lightningId} for reply to {eventId}"},
+        {"type": "ROUTING FEES", "credits": 0, "mcredits": -1 * paymentFees, "description": f"Zap {lightningId} for reply to {eventId}"},
+        {"type": "SERVICE FEES", "credits": 0, "mcredits": -1 * feesZapEvent, "description": f"Service fee for zap {lightningId}"},
+    ]
+    paymentCost = float(amount) + (float(paymentFees)/float(1000)) + (float(feesZapEvent)/float(1000))
+    paidnpubs[pubkey].update({'payment_status': paymentStatus, 'fee_msat': paymentFees, 'payment_hash': paymentHash, 'payment_index': paymentIndex})
+    if payment["payment_server"] is not None:
+        paidnpubs[pubkey].update({'payment_server': payment["payment_server"]})
+    journalRecord.update({"pubkey": pubkey, "lightningId": lightningId, "paidnpub": paidnpubs[pubkey], "paidlud": paidluds[lightningId]})
+    return journalRecord, paymentCost
+
 def isMessageInReplies(replies, k, pubkey, replyMessage):
     for r in replies:
         if type(r) is str: continue
@@ -2197,6 +2351,8 @@ def isMessageInReplies(replies, k, pubkey, replyMessage):
     return False
 
 def replyToEvent(npub, eventHex, subbotPK, pubkey, replyMessage, feesReplyMessage):
+    # bring the ledger current with any journaled payments before reading balance
+    journal.checkpointAll(setEventBalance)
     balance = ledger.getCreditBalance(npub)
     isDebugMessage = str(replyMessage).startswith("Unable to zap")
     if not isDebugMessage or _replyDebugMessages:
@@ -2262,17 +2418,56 @@ def handleWarningLowBalance(npub, eventId, balance):
     setNostrFieldForNpub(npub, "balanceWarningSent", True)
     setNostrFieldForNpub(npub, "enabled", False)
 
-lightningIdCache = {}
+lightningIdCache = {}            # pubkey -> {lightningId, name, created_at}
+_lightningIdCacheChanged = False
 
-def loadLightningIdCache():
-    global lightningIdCache
-    filename = f"{files.dataFolder}lightningIdcache.json"
-    lightningIdCache = files.loadJsonFile(filename, {})
+def getLightningIdCacheFilename():
+    return f"{files.dataFolder}lightningIdcache.json"
+
+def getLightningIdCacheSeconds():
+    return config["lightningIdCacheSeconds"] if "lightningIdCacheSeconds" in config else 86400
 
-def saveLightningIdCache():
+def isLightningIdCacheEntryValid(v, t):
+    if type(v) is not dict: return False
+    if v.get("lightningId") is None: return False
+    if "created_at" not in v: return False
+    return v["created_at"] > t - getLightningIdCacheSeconds()
+
+def evictLightningIdCache():
+    global _lightningIdCacheChanged
+    t, _ = utils.getTimes()
+    expired = [k for k, v in lightningIdCache.items() if not isLightningIdCacheEntryValid(v, t)]
+    for k in expired: del lightningIdCache[k]
+    if len(expired) > 0: _lightningIdCacheChanged = True
+
+def loadLightningIdCache():
     global lightningIdCache
-    filename = f"{files.dataFolder}lightningIdcache.json"
-    files.saveJsonFile(filename, lightningIdCache)
+    lightningIdCache = files.loadJsonFile(getLightningIdCacheFilename(), {})
+    evictLightningIdCache()
+    # entries saved by earlier versions may hold an lnurl
+    for k, v in list(lightningIdCache.items()):
+        if str(v["lightningId"]).lower().startswith("lnurl"):
+            setLightningIdCacheEntry(k, v["lightningId"], v.get("name"), v["created_at"])
+
+def setLightningIdCacheEntry(public_key, lightningId, name, created_at=None):
+    global _lightningIdCacheChanged
+    if str(lightningId).lower().startswith("lnurl"):
+        lightningId = makeLightningIdFromLNURL(lightningId)
+    if lightningId is None:
+        if public_key in lightningIdCache: del lightningIdCache[public_key]
+        _lightningIdCacheChanged = True
+        return
+    if created_at is None: created_at, _ = utils.getTimes()
+    lightningIdCache[public_key] = {"lightningId": lightningId, "name": name, "created_at": created_at}
+    _lightningIdCacheChanged = True
+
+def flushLightningIdCache():
+    # saves the cache if changed, dropping expired entries
+    global _lightningIdCacheChanged
+    if not _lightningIdCacheChanged: return
+    evictLightningIdCache()
+    files.saveJsonFile(getLightningIdCacheFilename(), lightningIdCache)
+    _lightningIdCacheChanged = False
 
 def makeLightningIdFromLNURL(lnurl):
     lightningId = None
@@ -2292,24 +2487,21 @@ def makeLightningIdFromLNURL(lnurl):
         logger.warning(f"Could not decode lnurl ({lnurl}) to a lightning identity: {str(err)}")
     return lightningId
 
+def getCachedLightningId(public_key):
+    # the lightning address last seen for the pubkey, without asking relays
+    v = lightningIdCache.get(public_key)
+    if type(v) is not dict: return None
+    return v.get("lightningId")
+
 def getLightningIdForPubkey(public_key):
-    global lightningIdCache
     t, _ = utils.getTimes()
     lightningId = None
     name = None
-    # look in cache for id set within past day
-    for k, v in lightningIdCache.items():
-        if k != public_key: continue
-        if type(v) is not dict: continue
-        if "lightningId" not in v: continue
-        if "created_at" not in v: continue
-        if v["created_at"] > t - 86400:
-            lightningId = v["lightningId"]
-            if str(lightningId).lower().startswith("lnurl"):
-                lightningId = makeLightningIdFromLNURL(lightningId)
-            if lightningId is not None:
-                name = v["name"] if ("name" in v and v["name"] is not None) else "no name"
-                return lightningId, name
+    # look in cache for id set within the cache period
+    v = lightningIdCache.get(public_key)
+    if isLightningIdCacheEntryValid(v, t):
+        name = v["name"] if v.get("name") is not None else "no name"
+        return v["lightningId"], name
     # get profile from relays
     profile, created_at = getProfile(public_key)
     if profile is None: return lightningId, name
@@ -2319,18 +2511,12 @@ def getLightningIdForPubkey(public_key):
             lightningId = makeLightningIdFromLNURL(lnurl)
             if lightningId is not None:
                 name = profile["name"] if ("name" in profile and profile["name"] is not None) else "no name"
-                lightningIdCache[public_key] = {
-                    "lightningId": lightningId, "name":name, "created_at": t
-                    }
     if "lud16" in profile and profile["lud16"] is not None:
         lightningId = profile["lud16"]
         name = profile["name"] if ("name" in profile and profile["name"] is not None) else "no name"
         if str(lightningId).lower().startswith("lnurl"):
             lightningId = makeLightningIdFromLNURL(lightningId)
-        lightningIdCache[public_key] = {
-            "lightningId": lightningId, "name":name, "created_at": t
-            }
-    if lightningId is not None: saveLightningIdCache()
+    if lightningId is not None: setLightningIdCacheEntry(public_key, lightningId, name, t)
     return lightningId, name
 
 def isValidLightningId(lightningId):
@@ -2341,7 +2527,7 @@ def isValidLightningId(lightningId):
         return False, f"Lightning address {lightningId} is invalid - not in username@domain format"
     return True, None
 
-def validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, name, amount, pubkey):
+def validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, name, amount, pubkey, botConfig=None):
     callback = None
     bech32lnurl = None
     userMessage = None
@@ -2382,8 +2568,8 @@ def validateLNURLPayInfo(lnurlPayInfo, lnurlp, lightningId, name, amount, pubkey
         logger.debug(f"LN Provider of identity {lightningId} does not have a callback url. Skipping")
         userMessage = f"Unable to zap: Provider for {lightningId} does not have a callback url."
         return callback, bech32lnurl, userMessage
-    elif not lnurl.isLNURLCallbackAllowed(callback):
-        logger.debug(f"LN Callback of identity {lightningId} is on the denyProviders list and cannot be zapped at this time ({name} with pubkey: {pubkey})")
+    elif not lnurl.isLNURLCallbackAllowed(callback, botConfig):
+        logger.debug(f"LN Callback of identity {lightningId} is denied by the provider policy and cannot be zapped at this time ({name} with pubkey: {pubkey})")
         userMessage = f"Unable to zap: Callback for {lightningId} is not allowed"
         return callback, bech32lnurl, userMessage
     lnurlpBytes = bytes(lnurlp,'utf-8')
@@ -2437,8 +2623,29 @@ def isValidInvoiceAmount(decodedInvoice, amountToZap):
         return False
     return True
 
+def applyPaymentStatus(npub, eventId, paidnpubs, paidnpub, new_payment_status, fee_msat):
+    # records the final status of a payment, adjusting the ledger for routing fees
+    paidentry = paidnpubs[paidnpub]
+    original_fee_msat = paidentry["fee_msat"] if "fee_msat" in paidentry else 0
+    lightningId = paidentry["lightning_id"] if "lightning_id" in paidentry else ""
+    logger.debug(f"Payment status now {new_payment_status}, fees: {fee_msat} msat. Ledger will be udpated")
+    paidnpubs[paidnpub]["payment_status"] = new_payment_status
+    paidnpubs[paidnpub]["fee_msat"] = fee_msat
+    files.saveJsonFile(f"{files.userEventsFolder}{npub}/{eventId}/paidnpubs.json", paidnpubs)
+    if fee_msat > original_fee_msat:
+        # additional fee? should never happen
+        additionalFee = fee_msat - original_fee_msat
+        logger.debug(f"Additional fee is {additionalFee} msat based on actual fee {fee_msat} msat - original {original_fee_msat} msat")
+        ledger.recordEntry(npub, "ROUTING FEES", 0, -1 * additionalFee, f"Zap {lightningId} for reply to {eventId}")
+    elif fee_msat < original_fee_msat:
+        # credit
+        creditForFee = original_fee_msat - fee_msat
+        logger.debug(f"Credit {creditForFee} msat for fee overage. Originally charged {original_fee_msat} msat. Actual fee was {fee_msat} msat")
+        ledger.recordEntry(npub, "ROUTING FEES", 0, creditForFee, f"Credit for zap payment after routing fee finalized for {lightningId} for reply to {eventId}")
+
 def processOutstandingPayments(npub, botConfig):
     eventId = botConfig["eventId"]
+    archive.ensureEventAvailable(npub, eventId)
     basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
     utils.makeFolderIfNotExists(basePath)
     filePaidNpubs = f"{basePath}paidnpubs.json"
@@ -2447,29 +2654,15 @@ def processOutstandingPayments(npub, botConfig):
         if "payment_status" not in paidentry: continue
         if "payment_hash" not in paidentry: continue
         payment_status = paidentry["payment_status"]
-        original_fee_msat = 0
-        if payment_status in ("IN_FLIGHT","TIMEOUT","UNKNOWNPAYING","UNKNOWNTRACKING","NOTFOUND"):
-            if "fee_msat" in paidentry: original_fee_msat = paidentry["fee_msat"]
+        if payment_status in archive.unresolvedPaymentStatuses:
             payment_hash = paidentry["payment_hash"]
             lightningId = ""
             if "lightning_id" in paidentry: lightningId = paidentry["lightning_id"]
             logger.info(f"Tracking LND payment with payment_hash {payment_hash} for {lightningId} - {paidnpub}")
-            new_payment_status, fee_msat = lnd.trackPayment(payment_hash)
+            with lnd.usingLNDServer(lnd.getRecordedServerId(paidentry, "payment_server")):
+                new_payment_status, fee_msat = lnd.trackPayment(payment_hash)
             if new_payment_status is None: continue
             if new_payment_status == "TIMEOUT": continue
             if fee_msat is None: continue
             if new_payment_status == payment_status: continue
-            logger.debug(f"Payment status now {new_payment_status}, fees: {fee_msat} msat. Ledger will be udpated")
-            paidnpubs[paidnpub]["payment_status"] = new_payment_status
-            paidnpubs[paidnpub]["fee_msat"] = fee_msat
-            files.saveJsonFile(filePaidNpubs, paidnpubs)
-            if fee_msat > original_fee_msat:
-                # additional fee? should never happen
-                additionalFee = fee_msat - original_fee_msat
-                logger.debug(f"Additional fee is {additionalFee} msat based on actual fee {fee_msat} msat - original {original_fee_msat} msat")
-                balance = ledger.recordEntry(npub, "ROUTING FEES", 0, -1 * additionalFee, f"Zap {lightningId} for reply to {eventId}")
-            elif fee_msat < original_fee_msat:
-                # credit
-                creditForFee = original_fee_msat - fee_msat
-                logger.debug(f"Credit {creditForFee} msat for fee overage. Originally charged {original_fee_msat} msat. Actual fee was {fee_msat} msat")
-                balance = ledger.recordEntry(npub, "ROUTING FEES", 0, creditForFee, f"Credit for zap payment after routing fee finalized for {lightningId} for reply to {eventId}")
+            applyPaymentStatus(npub, eventId, paidnpubs, paidnpub, new_payment_status, fee_msat)
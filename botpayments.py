@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import json
+import os
+import threading
+import botfiles as files
+import botlnd as lnd
+
+logger = None
+
+# Payments are sent from a pool of threads for each LND node, so that a batch
+# of zaps takes about as long as the slowest payment rather than the sum of
+# them. Each payment goes to the node in the pool with the most outbound
+# liquidity available. The caller reserves funds for each payment when
+# submitting it. Payment threads only pay and record the outcome. Payments
+# are settled on the caller's thread as getCompletedPayments returns them,
+# keeping ledger and journal writes on the main thread.
+#
+# Each payment is kept in a queue, keyed by payment hash, whose changes of
+# state are appended to paymentqueue.jsonl so that payments in progress are
+# known after a restart. The main loop never waits on a payment. Payments that
+# could not reach any LND server are retried on a schedule, and those whose
+# outcome is not known are tracked by hash once settled.
+#
+# states
+#   PREPARED        queued, not yet sent to LND
+#   SENDING         sent to LND, awaiting the outcome
+#   IN_FLIGHT       LND accepted the payment but its outcome is not yet known
+#   SETTLED         LND reports the payment succeeded
+#   FAILED          LND reports the payment failed, or it could not be sent
+#
+# An entry is removed from the queue once its outcome has been journaled. The
+# file is rewritten with just the queued payments when loaded, when the queue
+# empties, and whenever its records outnumber them by more than
+# maxQueueRecords, so that it does not grow without bound while payments are
+# always in progress.
+
+_executors = {}         # payment thread pools by LND server id
+_executorsLock = threading.Lock()
+_pendingPayments = {}   # future -> payment
+_pendingLock = threading.Lock()
+_queue = {}             # payment_hash -> payment
+_queueLock = threading.Lock()
+_queueRecords = 0       # records in the queue file
+maxQueueRecords = 1000
+
+def getPaymentQueueFilename():
+    return f"{files.dataFolder}paymentqueue.jsonl"
+
+def getPaymentRetries():
+    return lnd.config["paymentRetries"] if "paymentRetries" in lnd.config else 3
+
+def getExecutor(serverId):
+    with _executorsLock:
+        if serverId not in _executors:
+            with lnd.usingLNDServer(serverId):
+                maxWorkers = lnd.getMaxConcurrentPayments()
+            _executors[serverId] = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix=f"payment-{serverId}")
+        return _executors[serverId]
+
+def appendQueueRecord(record):
+    global _queueRecords
+    _queueRecords += 1
+    with open(getPaymentQueueFilename(), "a") as f:
+        f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def writePaymentQueue():
+    # replaces the queue file with a record of each queued payment, first
+    # written to a temp file so the queue is never lost to a crash
+    global _queueRecords
+    filename = getPaymentQueueFilename()
+    tempfile = f"{filename}.tmp"
+    with open(tempfile, "w") as f:
+        for payment in _queue.values():
+            f.write(json.dumps(payment) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tempfile, filename)
+    _queueRecords = len(_queue)
+
+def setPaymentState(payment, state, **fields):
+    with _queueLock:
+        payment["state"] = state
+        payment.update(fields)
+        _queue[payment["payment_hash"]] = payment
+        appendQueueRecord(payment)
+
+def loadPaymentQueue():
+    # replays the queue left by a prior run. Payments never sent are dropped,
+    # to be zapped again when the event is next processed. The rest are
+    # resubmitted to be tracked by hash or settled with their recorded outcome
+    filename = getPaymentQueueFilename()
+    if not os.path.exists(filename): return
+    queued = {}
+    with open(filename) as f:
+        for line in f:
+            if len(line.strip()) == 0: continue
+            try:
+                record = json.loads(line)
+            except Exception as e:
+                # a partial line from an interrupted append
+                logger.warning(f"Ignoring incomplete payment queue record in {filename}")
+                continue
+            if record.get("state") is None:
+                queued.pop(record["payment_hash"], None)
+            else:
+                queued[record["payment_hash"]] = record
+    recovered = [p for p in queued.values() if p["state"] != "PREPARED"]
+    with _queueLock:
+        for payment in recovered: _queue[payment["payment_hash"]] = payment
+        writePaymentQueue()
+    for payment in recovered:
+        logger.info(f"Recovering {payment['state']} payment with payment_hash {payment['payment_hash']}")
+        lnd.reserveOutbound(payment["payment_server"], payment["reserved_sat"])
+        future = getExecutor(payment["payment_server"]).submit(recoverPayment, payment)
+        addPending(future, payment)
+
+def recoverPayment(payment):
+    # returns the outcome of a payment from a prior run
+    if payment["state"] in ("SETTLED","FAILED"): return tuple(payment["result"])
+    with lnd.usingLNDServer(payment["payment_server"]):
+        status, fee_msat = lnd.trackPayment(payment["payment_hash"])
+        if status == "NOTFOUND" and payment["state"] == "SENDING": return "NOTSENT", 0, payment["payment_hash"], None
+        if status in ("SUCCEEDED","FAILED") and fee_msat is not None: return status, fee_msat, payment["payment_hash"], None
+        return "UNKNOWNPAYING", (lnd.getFeeLimit() * 1000), payment["payment_hash"], None
+
+def sendPayment(paymentRequest, payment):
+    # pays on the server chosen for the payment, failing over to another
+    # server in the pool if it cannot be reached
+    triedServerIds = []
+    serverId = payment["payment_server"]
+    while True:
+        triedServerIds.append(serverId)
+        setPaymentState(payment, "SENDING", payment_server=serverId)
+        try:
+            with lnd.usingLNDServer(serverId):
+                return lnd.payInvoice(paymentRequest)
+        except Exception as e:
+            if lnd.isPaymentNotSent(e):
+                logger.warning(f"Unable to reach LND server {serverId} to send payment {payment['payment_hash']}: {str(e)}")
+                lnd.setNodeHealthy(serverId, False)
+                nextServerId = lnd.choosePaymentServer(payment["reserved_sat"], triedServerIds)
+                if nextServerId is not None and nextServerId not in triedServerIds:
+                    lnd.releaseOutbound(serverId, payment["reserved_sat"])
+                    lnd.reserveOutbound(nextServerId, payment["reserved_sat"])
+                    payment["payment_server"] = serverId = nextServerId
+                    continue
+                return "NOTSENT", 0, payment["payment_hash"], None
+            # whether LND received the payment is not known, so leave it to be
+            # tracked by payment hash like any other unresolved payment
+            logger.warning(f"Error sending payment {payment['payment_hash']}: {str(e)}")
+            with lnd.usingLNDServer(serverId):
+                return "UNKNOWNPAYING", (lnd.getFeeLimit() * 1000), payment["payment_hash"], None
+
+def addPending(future, payment):
+    with _pendingLock:
+        _pendingPayments[future] = payment
+    # wake the main loop to settle the payment
+    future.add_done_callback(lambda f: lnd.wakeMainLoop())
+
+def isQueued(paymentHash):
+    with _queueLock:
+        return paymentHash in _queue
+
+def getQueuedPayments(npub=None, eventId=None):
+    with _queueLock:
+        return [p for p in _queue.values() if (npub is None or p.get("npub") == npub) and (eventId is None or p.get("eventId") == eventId)]
+
+def getReserved(npub, eventId=None):
+    # funds reserved for payments of the npub, or its event, not yet settled
+    return sum(p.get("reserved", 0) for p in getQueuedPayments(npub, eventId))
+
+def submitPayment(paymentRequest, payment):
+    # payment is a dict of caller context, which must include payment_hash and
+    # amount. The server paying it is recorded as payment_server. Returns
+    # False if a payment with the same hash is already queued
+    if isQueued(payment["payment_hash"]): return False
+    reservedSat = payment["amount"] + lnd.getFeeLimit()
+    serverId = lnd.choosePaymentServer(reservedSat)
+    lnd.reserveOutbound(serverId, reservedSat)
+    payment.update({"payment_server": serverId, "reserved_sat": reservedSat, "payment_request": paymentRequest})
+    payment.setdefault("attempts", 0)
+    setPaymentState(payment, "PREPARED")
+    future = getExecutor(serverId).submit(sendPayment, paymentRequest, payment)
+    addPending(future, payment)
+    return True
+
+def retryPayment(payment):
+    serverId = lnd.choosePaymentServer(payment["reserved_sat"])
+    lnd.reserveOutbound(serverId, payment["reserved_sat"])
+    setPaymentState(payment, "PREPARED", payment_server=serverId, attempts=payment["attempts"] + 1)
+    future = getExecutor(serverId).submit(sendPayment, payment["payment_request"], payment)
+    addPending(future, payment)
+
+def getCompletedPayments(npub=None, eventId=None, block=False):
+    # returns a list of (payment, result) for payments that have completed,
+    # optionally only those of an npub and event. When blocking, waits for
+    # at least one. Payments that could not be sent are scheduled to retry
+    with _pendingLock:
+        pending = [f for f, p in _pendingPayments.items() if (npub is None or p.get("npub") == npub) and (eventId is None or p.get("eventId") == eventId)]
+    if len(pending) == 0: return []
+    if block:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+    else:
+        done = [f for f in pending if f.done()]
+    completed = []
+    for future in done:
+        with _pendingLock:
+            payment = _pendingPayments.pop(future)
+        paymentStatus, paymentFees, paymentHash, paymentIndex = future.result()
+        if paymentHash is None: paymentHash = payment["payment_hash"]
+        if paymentStatus == "NOTSENT":
+            lnd.releaseOutbound(payment["payment_server"], payment["reserved_sat"])
+            if payment["attempts"] < getPaymentRetries():
+                retryDelay = 5 * (2 ** payment["attempts"])
+                logger.info(f"Retrying payment {paymentHash} in {retryDelay} seconds")
+                setPaymentState(payment, "PREPARED")
+                timer = threading.Timer(retryDelay, retryPayment, args=(payment,))
+                timer.daemon = True
+                timer.start()
+                continue
+            paymentStatus = "FAILED"
+            payment["failure_reason"] = "NOTSENT"
+        else:
+            if paymentStatus == "FAILED": payment["failure_reason"] = lnd.popPaymentFailureReason(paymentHash) or payment.get("failure_reason")
+            spentSat = 0 if paymentStatus == "FAILED" else payment["amount"] + (paymentFees // 1000)
+            lnd.releaseOutbound(payment["payment_server"], payment["reserved_sat"], spentSat)
+        paymentResult = (paymentStatus, paymentFees, paymentHash, paymentIndex)
+        state = {"SUCCEEDED": "SETTLED", "FAILED": "FAILED"}.get(paymentStatus, "IN_FLIGHT")
+        setPaymentState(payment, state, result=paymentResult)
+        completed.append((payment, paymentResult))
+    return completed
+
+def completePayment(payment):
+    # removes a payment from the queue once its outcome is journaled
+    with _queueLock:
+        _queue.pop(payment["payment_hash"], None)
+        appendQueueRecord({"payment_hash": payment["payment_hash"], "state": None})
+        if len(_queue) == 0 or _queueRecords > len(_queue) + maxQueueRecords: writePaymentQueue()
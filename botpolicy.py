@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import threading
+
+logger = None
+
+# Provider policies decide whether a host may be paid from lists of deny and
+# allow rules. A rule is a domain, matching only that domain, or a domain
+# prefixed with *. matching any of its subdomains. A lone * matches every
+# host. Rules are compiled into a trie of domain labels in reverse order, so
+# a host is checked in a single walk of its labels however many rules there
+# are. The most specific rule matching a host decides, with allow winning
+# over deny for rules that are equally specific. Hosts matching no rule are
+# allowed. Decisions are remembered for each compiled policy.
+
+_policies = {}              # (deny rules, allow rules) -> {"trie", "decisions"}
+_policiesLock = threading.Lock()
+maxPolicies = 1000
+maxDecisions = 10000
+
+def makeNode():
+    return {"labels": {}, "exact": None, "wildcard": None}
+
+def addRule(trie, rule, decision):
+    rule = str(rule).strip().lower().rstrip(".")
+    if len(rule) == 0: return
+    isWildcard = rule == "*" or rule.startswith("*.")
+    domain = rule[2:] if rule.startswith("*.") else ("" if rule == "*" else rule)
+    node = trie
+    for label in reversed(domain.split(".") if len(domain) > 0 else []):
+        node = node["labels"].setdefault(label, makeNode())
+    field = "wildcard" if isWildcard else "exact"
+    # allow wins over deny for the same rule
+    if node[field] != "allow": node[field] = decision
+
+def compilePolicy(denyRules, allowRules):
+    trie = makeNode()
+    for rule in denyRules: addRule(trie, rule, "deny")
+    for rule in allowRules: addRule(trie, rule, "allow")
+    return trie
+
+def evaluateTrie(trie, host):
+    # returns the decision of the most specific rule matching the host, or
+    # None if no rule matches
+    labels = list(reversed(str(host).lower().rstrip(".").split(".")))
+    decision = None
+    node = trie
+    for label in labels:
+        # a wildcard covers the labels remaining below it
+        if node["wildcard"] is not None: decision = node["wildcard"]
+        node = node["labels"].get(label)
+        if node is None: return decision
+    if node["exact"] is not None: return node["exact"]
+    return decision
+
+def getPolicy(denyRules, allowRules):
+    key = (tuple(denyRules), tuple(allowRules))
+    with _policiesLock:
+        if key not in _policies:
+            if len(_policies) >= maxPolicies: _policies.clear()
+            _policies[key] = {"trie": compilePolicy(denyRules, allowRules), "decisions": {}}
+            if logger is not None: logger.debug(f"Compiled provider policy of {len(denyRules)} deny and {len(allowRules)} allow rules")
+        return _policies[key]
+
+def isHostAllowed(host, denyRules, allowRules):
+    if host is None: return False
+    if len(denyRules) == 0: return True
+    policy = getPolicy(denyRules, allowRules)
+    host = host.lower()
+    decisions = policy["decisions"]
+    if host not in decisions:
+        if len(decisions) >= maxDecisions: decisions.clear()
+        decisions[host] = evaluateTrie(policy["trie"], host) != "deny"
+    return decisions[host]
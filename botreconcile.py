@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import json
+import os
+import queue
+import threading
+import time
+import requests
+import botarchive as archive
+import botfiles as files
+import botlnd as lnd
+
+logger = None
+
+# Unresolved payments (in flight, timed out, or of unknown status) are
+# reconciled from a subscription to each LND server's stream of all payment
+# updates, rather than tracking each payment hash on its own. An index from
+# payment hash to the npub, event and pubkey paid is built at startup and
+# added to as payments are made. On each connect, payments that resolved
+# while disconnected are caught up with a listing from the lowest payment
+# index outstanding. A payment watched while its server's stream is connected
+# is tracked by hash once, as it may have resolved before it was watched.
+
+_unresolvedPayments = {}    # payment_hash -> {npub, eventId, pubkey, payment_index, payment_server}
+_unresolvedLock = threading.Lock()
+_paymentUpdates = queue.Queue()
+_trackingThreads = {}
+_trackingActive = {}
+
+finalPaymentStatuses = ("SUCCEEDED","FAILED")
+
+def watchPayment(paymentHash, npub, eventId, pubkey, paymentIndex=None, paymentServer=None):
+    with _unresolvedLock:
+        _unresolvedPayments[paymentHash] = {"npub": npub, "eventId": eventId, "pubkey": pubkey, "payment_index": paymentIndex, "payment_server": paymentServer}
+    # updates streamed before the payment was watched were not queued, and
+    # if the stream is not connected the catch up on connecting covers it.
+    # Tracking waits on a payment still in flight, so is done off the main loop
+    if _trackingActive.get(paymentServer, False): startTrackingPayment(paymentHash, paymentServer)
+
+def startTrackingPayment(paymentHash, serverId):
+    threading.Thread(target=trackWatchedPayment, args=(paymentHash, serverId), name=f"track-{paymentHash[:8]}", daemon=True).start()
+
+def trackWatchedPayment(paymentHash, serverId):
+    lnd.selectLNDServer(serverId)
+    status, fee_msat = lnd.trackPayment(paymentHash)
+    if status in finalPaymentStatuses and fee_msat is not None:
+        _paymentUpdates.put({"payment_hash": paymentHash, "status": status, "fee_msat": fee_msat})
+
+def isWatched(paymentHash):
+    with _unresolvedLock:
+        return paymentHash in _unresolvedPayments
+
+def loadUnresolvedPayments():
+    # archived events never have unresolved payments, so only folders are read
+    if not os.path.exists(files.userEventsFolder): return
+    for npub in os.listdir(files.userEventsFolder):
+        if not npub.startswith("npub"): continue
+        for eventId in files.getEventFolders(npub):
+            paidnpubs = files.loadJsonFile(f"{files.userEventsFolder}{npub}/{eventId}/paidnpubs.json", {})
+            for pubkey, paidentry in paidnpubs.items():
+                if paidentry.get("payment_status") not in archive.unresolvedPaymentStatuses: continue
+                if "payment_hash" not in paidentry or paidentry["payment_hash"] is None: continue
+                watchPayment(paidentry["payment_hash"], npub, eventId, pubkey, paidentry.get("payment_index"),
+                             lnd.getRecordedServerId(paidentry, "payment_server"))
+    logger.debug(f"Watching {len(_unresolvedPayments)} unresolved payments")
+
+def isTrackingActive():
+    # whether the streams of all servers payments may be made on are connected
+    return all(_trackingActive.get(serverId, False) for serverId in lnd.getFollowedServerIds())
+
+def catchUpPayments(serverId):
+    # queue the current state of watched payments on the server that may have
+    # resolved before the stream connected
+    with _unresolvedLock:
+        watched = {k: v for k, v in _unresolvedPayments.items() if v["payment_server"] == serverId}
+    if len(watched) == 0: return
+    paymentIndexes = [int(v["payment_index"]) for v in watched.values() if v["payment_index"] is not None]
+    if len(paymentIndexes) > 0:
+        indexOffset = min(paymentIndexes) - 1
+        maxPayments = 1000
+        while True:
+            result = lnd.listPayments(indexOffset, maxPayments)
+            if result is None or "payments" not in result: break
+            for payment in result["payments"]:
+                if payment.get("payment_hash") in watched: _paymentUpdates.put(payment)
+            if len(result["payments"]) < maxPayments: break
+            indexOffset = int(result["last_index_offset"])
+    # payments sent without LND reporting an index need tracking by hash,
+    # which waits on payments still in flight, so is not done on the stream
+    for paymentHash, v in watched.items():
+        if v["payment_index"] is not None: continue
+        startTrackingPayment(paymentHash, serverId)
+
+def trackPayments(serverId):
+    lnd.selectLNDServer(serverId)
+    retryDelay = 1
+    while True:
+        response = None
+        try:
+            url = lnd.getLNDUrl("/v2/router/payments?no_inflight_updates=true")
+            connectTimeout, _ = lnd.getLNDTimeouts()
+            # the stream is idle between payments, so allow a long read before reconnecting
+            timeout = (connectTimeout, lnd.getInvoicePollInterval())
+            response = lnd.getLNDSession().get(url=url,stream=True,timeout=timeout,headers=lnd.getLNDHeaders())
+            if response.status_code != 200:
+                raise Exception(f"status code {response.status_code}: {response.text}")
+            _trackingActive[serverId] = True
+            retryDelay = 1
+            catchUpPayments(serverId)
+            for raw_response in response.iter_lines():
+                if len(raw_response) == 0: continue
+                json_response = json.loads(raw_response)
+                if "error" in json_response: raise Exception(json_response["error"])
+                if "result" in json_response: json_response = json_response["result"]
+                if isWatched(json_response.get("payment_hash")): _paymentUpdates.put(json_response)
+            logger.debug(f"Payment tracking stream ended for {serverId}")
+        except requests.exceptions.ConnectionError as e:
+            # includes read timeouts of an idle stream
+            logger.debug(f"Payment tracking disconnected for {serverId}: {str(e)}")
+        except Exception as e:
+            logger.warning(f"Error in payment tracking for {serverId}: {str(e)}")
+        finally:
+            _trackingActive[serverId] = False
+            if response is not None: response.close()
+        time.sleep(retryDelay)
+        retryDelay = min(retryDelay * 2, 60)
+
+def startPaymentTracking():
+    for serverId in lnd.getFollowedServerIds():
+        if serverId in _trackingThreads: continue
+        thread = threading.Thread(target=trackPayments, args=(serverId,), name=f"payments-{serverId}", daemon=True)
+        _trackingThreads[serverId] = thread
+        thread.start()
+
+def applyPaymentUpdates(applyPaymentStatus):
+    # applies queued final statuses to the paidnpubs and ledger of the npub,
+    # through applyPaymentStatus(npub, eventId, paidnpubs, pubkey, status, fee_msat)
+    while not _paymentUpdates.empty():
+        update = _paymentUpdates.get()
+        status = update.get("status")
+        if status not in finalPaymentStatuses: continue
+        paymentHash = update.get("payment_hash")
+        with _unresolvedLock:
+            if paymentHash not in _unresolvedPayments: continue
+            watched = _unresolvedPayments.pop(paymentHash)
+        npub = watched["npub"]
+        eventId = watched["eventId"]
+        pubkey = watched["pubkey"]
+        fee_msat = int(update["fee_msat"]) if "fee_msat" in update else 0
+        try:
+            archive.ensureEventAvailable(npub, eventId)
+            paidnpubs = files.loadJsonFile(f"{files.userEventsFolder}{npub}/{eventId}/paidnpubs.json", {})
+            if pubkey not in paidnpubs: continue
+            if paidnpubs[pubkey].get("payment_status") not in archive.unresolvedPaymentStatuses: continue
+            logger.info(f"Reconciled LND payment with payment_hash {paymentHash} for {npub} event {eventId}")
+            applyPaymentStatus(npub, eventId, paidnpubs, pubkey, status, fee_msat)
+        except Exception as e:
+            logger.warning(f"Error reconciling payment {paymentHash} for {npub}: {str(e)}")
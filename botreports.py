@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import boto3
 import boto3.session
-import glob
 import hashlib
 import os
 import botledger as ledger
@@ -15,8 +14,8 @@ def getNpubsWithEvents():
     return os.listdir(files.userEventsFolder)
 
 def getEventsForNpub(npub):
-    path = f"{files.userEventsFolder}{npub}"
-    return os.listdir(path)
+    # archived events have their final report and are not regenerated
+    return files.getEventFolders(npub)
 
 def makeAllReports():
     # Get configs, only process reports for those with proper names
@@ -36,8 +35,7 @@ def makeAllReports():
         makeLedgerReport(npub)
         events = getEventsForNpub(npub)
         for eventId in events:
-            if os.path.isdir(os.path.join(f"{files.userEventsFolder}{npub}", eventId)):
-                makeEventReport(npub, eventId)
+            makeEventReport(npub, eventId)
         makeIndex(npub)
 
 def getReportFilename(npub, eventId):
@@ -47,6 +45,7 @@ def getReportFilename(npub, eventId):
     return destFile
 
 def makeEventReport(npub, eventId):
+    if files.isEventArchived(npub, eventId): return False
     sourceFolder = f"{files.userEventsFolder}{npub}/{eventId}/"
     utils.makeFolderIfNotExists(sourceFolder)
     sourcePaidNpubsFile = f"{sourceFolder}paidnpubs.json"
@@ -292,7 +291,7 @@ def buildLedgerReportLines(sourcedata):
         mcredits = dataEntry["mcredits"]
         balance = dataEntry["balance"]
         # Ignore entry if carry over
-        if description == "Carry over from ledger rotation": continue
+        if description == ledger.carryOverDescription: continue
         # line management
         writeLine = False
         if linedescription == "": linedescription = description
@@ -342,18 +341,31 @@ def buildLedgerReportFooter(npub):
     output = "</body></html>"
     return output
 
+def getLedgerSegmentReportFilename(npub, segmentFilename):
+    destFolder = f"{files.userReportsFolder}{npub}/segments/"
+    utils.makeFolderIfNotExists(destFolder)
+    destFile = f"{destFolder}{os.path.basename(segmentFilename)}.html"
+    return destFile
+
+def getLedgerSegmentReportLines(npub, segmentFilename):
+    # archived segments never change, so their lines are rendered only once
+    segmentReportFile = getLedgerSegmentReportFilename(npub, segmentFilename)
+    if os.path.exists(segmentReportFile):
+        with open(segmentReportFile) as f:
+            return f.read()
+    logger.debug(f"Rendering ledger segment {segmentFilename}")
+    sourcedata = files.loadJsonFile(segmentFilename, [])
+    output = buildLedgerReportLines(sourcedata)
+    with open(segmentReportFile, "w") as f:
+        f.write(output)
+    return output
+
 def makeLedgerReport(npub):
     destFile = getLedgerReportFilename(npub)
     logger.debug(f"Making ledger report at {destFile}")
     destData = buildLedgerReportHeader(npub)
-    archiveFilePattern = f"{files.userLedgerFolder}archived/{npub}*"
-    archiveFiles = []
-    for archiveFilename in glob.glob(archiveFilePattern):
-        archiveFiles.append(archiveFilename)
-    archiveFiles.sort()
-    for archiveFilename in archiveFiles:
-        sourcedata = files.loadJsonFile(archiveFilename)
-        destData += buildLedgerReportLines(sourcedata)
+    for segmentFilename in ledger.getLedgerSegmentFilenames(npub):
+        destData += getLedgerSegmentReportLines(npub, segmentFilename)
     sourcedata = files.loadJsonFile(ledger.getUserLedgerFilename(npub))
     destData += buildLedgerReportLines(sourcedata)
     destData += buildLedgerReportFooter(npub)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+import botutils as utils
+
+# Events received from relays are routed by the name of the subscription that
+# asked for them, which is its id less the numeric parts making it unique, to
+# the handler registered for that name. Handlers usually add the event to a
+# buffer, which indexes events by keys such as the events they refer to or
+# their author, so that each consumer takes just the events it wants without
+# looking through the rest. Buffers drop their oldest events beyond a number
+# of events or an age, so events no consumer takes do not accumulate.
+
+_routes = {}                # subscription name -> handler
+
+def getRouteName(subscriptionId):
+    parts = str(subscriptionId).split("_")
+    while len(parts) > 1 and parts[-1].isdigit(): parts.pop()
+    return "_".join(parts)
+
+def addRoute(name, handler):
+    _routes[name] = handler
+
+def routeEvent(subscriptionId, event):
+    # returns False if no handler is registered for the subscription
+    handler = _routes.get(getRouteName(subscriptionId))
+    if handler is None: return False
+    handler(event)
+    return True
+
+def makeBuffer(keysOf, maxEvents, maxAgeSeconds):
+    # keysOf returns the list of keys an event is indexed by
+    return {"keysOf": keysOf, "maxEvents": maxEvents, "maxAgeSeconds": maxAgeSeconds,
+            "events": OrderedDict(), "index": {}}
+
+def addToBuffer(buffer, event):
+    # events are kept once by id, however many relays send them
+    events = buffer["events"]
+    if event.id in events: return
+    t, _ = utils.getTimes()
+    keys = buffer["keysOf"](event)
+    events[event.id] = (t, event, keys)
+    for key in keys:
+        buffer["index"].setdefault(key, OrderedDict())[event.id] = None
+    evictBuffer(buffer)
+
+def removeFromBuffer(buffer, eventId):
+    _, event, keys = buffer["events"].pop(eventId)
+    index = buffer["index"]
+    for key in keys:
+        ids = index.get(key)
+        if ids is None: continue
+        ids.pop(eventId, None)
+        if len(ids) == 0: del index[key]
+    return event
+
+def evictBuffer(buffer):
+    # events are in the order received, so the oldest are first
+    t, _ = utils.getTimes()
+    events = buffer["events"]
+    while len(events) > 0:
+        eventId, (receivedAt, _, _) = next(iter(events.items()))
+        if len(events) <= buffer["maxEvents"] and receivedAt >= t - buffer["maxAgeSeconds"]: break
+        removeFromBuffer(buffer, eventId)
+
+def peekBuffer(buffer, key):
+    # the events indexed by the key, in the order received
+    evictBuffer(buffer)
+    events = buffer["events"]
+    return [events[eventId][1] for eventId in buffer["index"].get(key, ())]
+
+def takeFromBuffer(buffer, key):
+    # the events indexed by the key, which are removed from the buffer
+    evictBuffer(buffer)
+    return [removeFromBuffer(buffer, eventId) for eventId in list(buffer["index"].get(key, ()))]
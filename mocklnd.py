@@ -0,0 +1,420 @@
+#!~/.pyenv/boostzapper/bin/python3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import OrderedDict
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import requests
+import botbolt11 as bolt11
+import botfiles as files
+import botutils as utils
+
+# A stand-in for the LND REST endpoints used by the bot, for integration
+# testing and benchmarks without a real node. Invoices and payments follow the
+# same state transitions as LND, streaming endpoints stream, and latency and
+# failures can be introduced.
+#
+#   mocklnd.py [--port 10080] [--latency <ms>] [--errorRate <0-1>]
+#              [--failRate <0-1>] [--stuckRate <0-1>] [--inflightSeconds <s>]
+#              [--stuckSeconds <s>] [--feeRate <0-1>] [--settleAfter <s>]
+#              [--balance <sats>] [--record <file>] [--upstream <host:port>]
+#
+# latency          mean delay added to each request, in milliseconds
+# errorRate        portion of lookups answered with 503 Service Unavailable
+# failRate         portion of payments that fail to route
+# stuckRate        portion of payments that stay IN_FLIGHT for stuckSeconds
+# inflightSeconds  time payments are IN_FLIGHT before they succeed or fail
+# feeRate          routing fee as a portion of the amount, up to the fee limit
+# settleAfter      seconds after which created invoices are paid, as if by a user
+# balance          outbound liquidity reported, in sats
+# record           file to append each request and response to, as json lines
+# upstream         a real LND REST server to forward to, recording its responses
+#
+# Invoices can also be paid on demand with POST /mock/invoices/<hash hex>/settle
+#
+# The bot can be pointed at it with a server configuration of
+#   {"address": "127.0.0.1", "port": "10080", "macaroon": "00"}
+
+logger = None
+config = {
+    "port": 10080,
+    "latency": 0,
+    "errorRate": 0.0,
+    "failRate": 0.0,
+    "stuckRate": 0.0,
+    "inflightSeconds": 0.5,
+    "stuckSeconds": 60,
+    "feeRate": 0.001,
+    "settleAfter": None,
+    "balance": 10000000,
+    "record": None,
+    "upstream": None,
+}
+
+nodeKey = os.urandom(32)
+_state = {"invoices": OrderedDict(), "payments": OrderedDict(), "add_index": 0, "settle_index": 0, "payment_index": 0}
+_stateChanged = threading.Condition()
+_recordLock = threading.Lock()
+
+def getCertificateFiles():
+    # a self-signed certificate, like LND's, made once with openssl
+    folder = f"{files.dataFolder}mocklnd/"
+    utils.makeFolderIfNotExists(folder)
+    certFile = f"{folder}tls.cert"
+    keyFile = f"{folder}tls.key"
+    if not os.path.exists(certFile):
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                        "-keyout", keyFile, "-out", certFile, "-days", "3650", "-nodes", "-subj", "/CN=localhost"],
+                       check=True, capture_output=True)
+    return certFile, keyFile
+
+def hashFromBase64(value):
+    value = urllib.parse.unquote(value)
+    value = value + "=" * (-len(value) % 4)
+    return base64.urlsafe_b64decode(value.replace("+", "-").replace("/", "_")).hex()
+
+def toBase64(hexValue):
+    return base64.b64encode(bytes.fromhex(hexValue)).decode()
+
+def record(entry):
+    if config["record"] is None: return
+    entry["time"] = time.time()
+    with _recordLock:
+        with open(config["record"], "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+# Invoice state machine: OPEN -> SETTLED when paid, OPEN -> CANCELED on expiry
+
+def addInvoice(body):
+    preimage = base64.b64decode(body["r_preimage"]) if "r_preimage" in body else os.urandom(32)
+    paymentHash = hashlib.sha256(preimage).digest()
+    value = int(body.get("value", 0))
+    expiry = int(body.get("expiry", 86400))
+    memo = body.get("memo") or ""
+    descriptionHash = base64.b64decode(body["description_hash"]) if "description_hash" in body else None
+    paymentRequest = bolt11.encodeInvoice(nodeKey, paymentHash, value * 1000 if value > 0 else None,
+                                          description=memo, descriptionHash=descriptionHash, expiry=expiry, paymentSecret=os.urandom(32))
+    with _stateChanged:
+        _state["add_index"] += 1
+        invoice = {"memo": memo, "r_preimage": base64.b64encode(preimage).decode(), "r_hash": toBase64(paymentHash.hex()),
+                   "value": str(value), "value_msat": str(value * 1000), "creation_date": str(int(time.time())),
+                   "settle_date": "0", "payment_request": paymentRequest, "expiry": str(expiry), "add_index": str(_state["add_index"]),
+                   "settle_index": "0", "amt_paid_sat": "0", "amt_paid_msat": "0", "state": "OPEN"}
+        _state["invoices"][paymentHash.hex()] = invoice
+        _stateChanged.notify_all()
+    if config["settleAfter"] is not None:
+        threading.Timer(float(config["settleAfter"]), settleInvoice, args=(paymentHash.hex(),)).start()
+    return {"r_hash": invoice["r_hash"], "payment_request": paymentRequest, "add_index": invoice["add_index"],
+            "payment_addr": base64.b64encode(os.urandom(32)).decode()}
+
+def expireInvoices():
+    now = int(time.time())
+    with _stateChanged:
+        for invoice in _state["invoices"].values():
+            if invoice["state"] == "OPEN" and int(invoice["creation_date"]) + int(invoice["expiry"]) < now:
+                invoice["state"] = "CANCELED"
+
+def settleInvoice(paymentHashHex):
+    with _stateChanged:
+        invoice = _state["invoices"].get(paymentHashHex)
+        if invoice is None or invoice["state"] != "OPEN": return False
+        _state["settle_index"] += 1
+        invoice.update({"state": "SETTLED", "settle_date": str(int(time.time())), "settle_index": str(_state["settle_index"]),
+                        "amt_paid_sat": invoice["value"], "amt_paid_msat": invoice["value_msat"]})
+        _stateChanged.notify_all()
+    return True
+
+# Payment state machine: IN_FLIGHT -> SUCCEEDED or FAILED after inflightSeconds,
+# or stuckSeconds for the portion of payments that get stuck
+
+def sendPayment(body):
+    paymentRequest = body["payment_request"]
+    decoded = bolt11.decodeInvoice(paymentRequest)
+    if decoded is None: return None, "invalid payment request"
+    paymentHash = decoded["payment_hash"]
+    with _stateChanged:
+        existing = _state["payments"].get(paymentHash)
+        if existing is not None and existing["status"] != "FAILED": return None, "invoice is already paid"
+        amountMsat = int(decoded.get("num_msat", 0)) or int(body.get("amt_msat", 0)) or int(body.get("amt", 0)) * 1000
+        feeLimitMsat = int(body.get("fee_limit_sat", 0)) * 1000 or int(body.get("fee_limit_msat", 0))
+        _state["payment_index"] += 1
+        payment = {"payment_hash": paymentHash, "value": str(amountMsat // 1000), "value_sat": str(amountMsat // 1000),
+                   "value_msat": str(amountMsat), "payment_request": paymentRequest, "status": "IN_FLIGHT",
+                   "fee": "0", "fee_sat": "0", "fee_msat": "0", "creation_date": str(int(time.time())),
+                   "creation_time_ns": str(time.time_ns()), "payment_index": str(_state["payment_index"]),
+                   "failure_reason": "FAILURE_REASON_NONE", "htlcs": []}
+        _state["payments"][paymentHash] = payment
+        _stateChanged.notify_all()
+    roll = random.random()
+    if roll < config["failRate"]:
+        outcome = "FAILED"
+    else:
+        outcome = "SUCCEEDED"
+    delay = float(config["inflightSeconds"])
+    if random.random() < config["stuckRate"]: delay = float(config["stuckSeconds"])
+    feeMsat = min(int(amountMsat * config["feeRate"]), feeLimitMsat) if feeLimitMsat > 0 else int(amountMsat * config["feeRate"])
+    threading.Timer(delay, resolvePayment, args=(paymentHash, outcome, feeMsat)).start()
+    return payment, None
+
+def resolvePayment(paymentHash, outcome, feeMsat):
+    with _stateChanged:
+        payment = _state["payments"][paymentHash]
+        if outcome == "SUCCEEDED":
+            amountSat = int(payment["value_sat"])
+            if config["balance"] < amountSat + (feeMsat // 1000):
+                outcome = "FAILED"
+                payment["failure_reason"] = "FAILURE_REASON_INSUFFICIENT_BALANCE"
+            else:
+                config["balance"] -= amountSat + (feeMsat // 1000)
+                payment.update({"fee": str(feeMsat // 1000), "fee_sat": str(feeMsat // 1000), "fee_msat": str(feeMsat),
+                                "payment_preimage": os.urandom(32).hex()})
+        else:
+            payment["failure_reason"] = "FAILURE_REASON_NO_ROUTE"
+        payment["status"] = outcome
+        _stateChanged.notify_all()
+    # paying one of our own invoices settles it
+    if outcome == "SUCCEEDED": settleInvoice(paymentHash)
+
+def getPaymentSnapshot(paymentHash):
+    with _stateChanged:
+        payment = _state["payments"].get(paymentHash)
+        return dict(payment) if payment is not None else None
+
+class MockLNDHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def readBody(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0: return {}
+        return json.loads(self.rfile.read(length))
+
+    def sendJson(self, obj, status=200):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        record({"method": self.command, "path": self.path, "status": status, "response": obj})
+
+    def startStream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def sendStreamLine(self, obj):
+        data = (json.dumps({"result": obj}) + "\n").encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+        record({"method": self.command, "path": self.path, "status": 200, "response": {"result": obj}})
+
+    def endStream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def simulateLatency(self):
+        if config["latency"] > 0:
+            time.sleep(random.uniform(0.5, 1.5) * config["latency"] / 1000)
+
+    def do_GET(self):
+        self.handleRequest()
+
+    def do_POST(self):
+        self.handleRequest()
+
+    def handleRequest(self):
+        body = self.readBody() if self.command == "POST" else {}
+        record({"method": self.command, "path": self.path, "request": body})
+        self.simulateLatency()
+        if config["upstream"] is not None: return self.forwardRequest(body)
+        parsed = urllib.parse.urlparse(self.path)
+        path = parsed.path
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        isLookup = self.command == "GET" and not path.endswith("/subscribe") and path not in ("/v2/router/payments",) and not path.startswith("/v2/router/track/")
+        if isLookup and random.random() < config["errorRate"]:
+            return self.sendJson({"code": 14, "message": "service unavailable"}, 503)
+        try:
+            if path == "/v1/state": return self.sendJson({"state": "SERVER_ACTIVE"})
+            if path == "/v1/balance/channels":
+                return self.sendJson({"local_balance": {"sat": str(config["balance"]), "msat": str(config["balance"] * 1000)},
+                                      "remote_balance": {"sat": "0", "msat": "0"}})
+            if path == "/v1/invoices" and self.command == "POST": return self.sendJson(addInvoice(body))
+            if path == "/v2/invoices/lookup": return self.lookupInvoice(query)
+            if path.startswith("/v1/payreq/"): return self.decodePayReq(path[len("/v1/payreq/"):])
+            if path == "/v2/router/send" and self.command == "POST": return self.streamSend(body)
+            if path.startswith("/v2/router/track/"): return self.streamTrack(hashFromBase64(path[len("/v2/router/track/"):]), query)
+            if path == "/v1/invoices/subscribe": return self.streamInvoices(query)
+            if path == "/v2/router/payments": return self.streamPayments()
+            if path == "/v1/payments": return self.listPayments(query)
+            if path.startswith("/v1/graph/routes/"): return self.queryRoutes(path.split("/")[5], query)
+            if path.startswith("/mock/invoices/") and path.endswith("/settle"):
+                return self.sendJson({"settled": settleInvoice(path.split("/")[3])})
+            return self.sendJson({"code": 12, "message": "Not Implemented"}, 501)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def queryRoutes(self, amountSat, query):
+        # a route is found for the same portion of probes as payments succeed
+        if random.random() < config["failRate"]:
+            return self.sendJson({"code": 2, "message": "unable to find a path to destination"}, 500)
+        feeMsat = int(int(amountSat) * 1000 * config["feeRate"])
+        return self.sendJson({"routes": [{"total_amt": amountSat, "total_fees_msat": str(feeMsat), "hops": []}], "success_prob": 1 - config["failRate"]})
+
+    def lookupInvoice(self, query):
+        expireInvoices()
+        paymentHash = hashFromBase64(query.get("payment_hash", ""))
+        with _stateChanged:
+            invoice = _state["invoices"].get(paymentHash)
+            invoice = dict(invoice) if invoice is not None else None
+        if invoice is None: return self.sendJson({"code": 5, "message": "there are no existing invoices"}, 404)
+        return self.sendJson(invoice)
+
+    def decodePayReq(self, paymentRequest):
+        decoded = bolt11.decodeInvoice(urllib.parse.unquote(paymentRequest))
+        if decoded is None: return self.sendJson({"code": 2, "message": "invalid payment request"}, 500)
+        return self.sendJson(decoded)
+
+    def streamSend(self, body):
+        payment, error = sendPayment(body)
+        if payment is None: return self.sendJson({"error": {"code": 6, "message": error}}, 500)
+        self.startStream()
+        self.followPayment(payment["payment_hash"], False)
+        self.endStream()
+
+    def streamTrack(self, paymentHash, query):
+        if getPaymentSnapshot(paymentHash) is None:
+            self.startStream()
+            self.sendStreamLine({"code": 5, "message": "payment isn't initiated"})
+            return self.endStream()
+        self.startStream()
+        self.followPayment(paymentHash, str(query.get("no_inflight_updates", "")).lower() == "true")
+        self.endStream()
+
+    def followPayment(self, paymentHash, noInflightUpdates):
+        # streams the payment until it reaches a final state
+        lastStatus = None
+        while True:
+            payment = getPaymentSnapshot(paymentHash)
+            if payment["status"] != lastStatus:
+                lastStatus = payment["status"]
+                if lastStatus != "IN_FLIGHT" or not noInflightUpdates: self.sendStreamLine(payment)
+            if lastStatus in ("SUCCEEDED", "FAILED"): return
+            with _stateChanged:
+                _stateChanged.wait(1)
+
+    def streamInvoices(self, query):
+        addIndex = int(query.get("add_index", 0))
+        settleIndex = int(query.get("settle_index", 0))
+        self.startStream()
+        # backlog after the indexes given, then updates as they happen
+        sentAdds = addIndex if addIndex > 0 else _state["add_index"]
+        sentSettles = settleIndex if settleIndex > 0 else _state["settle_index"]
+        while True:
+            with _stateChanged:
+                invoices = [dict(i) for i in _state["invoices"].values()]
+            for invoice in invoices:
+                if int(invoice["add_index"]) > sentAdds:
+                    sentAdds = int(invoice["add_index"])
+                    openInvoice = dict(invoice, state="OPEN", settle_index="0")
+                    self.sendStreamLine(openInvoice)
+            for invoice in sorted(invoices, key=lambda i: int(i["settle_index"])):
+                if int(invoice["settle_index"]) > sentSettles:
+                    sentSettles = int(invoice["settle_index"])
+                    self.sendStreamLine(invoice)
+            with _stateChanged:
+                _stateChanged.wait(1)
+
+    def streamPayments(self):
+        self.startStream()
+        lastStatuses = {}
+        with _stateChanged:
+            for paymentHash, payment in _state["payments"].items(): lastStatuses[paymentHash] = payment["status"]
+        while True:
+            with _stateChanged:
+                payments = [dict(p) for p in _state["payments"].values()]
+            for payment in payments:
+                if lastStatuses.get(payment["payment_hash"]) == payment["status"]: continue
+                lastStatuses[payment["payment_hash"]] = payment["status"]
+                if payment["status"] != "IN_FLIGHT": self.sendStreamLine(payment)
+            with _stateChanged:
+                _stateChanged.wait(1)
+
+    def listPayments(self, query):
+        indexOffset = int(query.get("index_offset", 0))
+        maxPayments = int(query.get("max_payments", 100))
+        with _stateChanged:
+            payments = [dict(p) for p in _state["payments"].values() if int(p["payment_index"]) > indexOffset][:maxPayments]
+        first = payments[0]["payment_index"] if len(payments) > 0 else "0"
+        last = payments[-1]["payment_index"] if len(payments) > 0 else "0"
+        return self.sendJson({"payments": payments, "first_index_offset": first, "last_index_offset": last})
+
+    def forwardRequest(self, body):
+        # recording mode against a real node
+        url = f"https://{config['upstream']}{self.path}"
+        headers = {k: v for k, v in self.headers.items() if k.lower().startswith("grpc-metadata")}
+        try:
+            response = requests.request(self.command, url, data=json.dumps(body) if self.command == "POST" else None,
+                                        headers=headers, stream=True, verify=False, timeout=(5, 300))
+        except Exception as e:
+            return self.sendJson({"code": 14, "message": str(e)}, 502)
+        self.send_response(response.status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in response.iter_lines():
+                if len(line) == 0: continue
+                data = line + b"\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+                record({"method": self.command, "path": self.path, "status": response.status_code, "response": json.loads(line)})
+            self.endStream()
+        finally:
+            response.close()
+
+def startServer(port=None):
+    # serves in a background thread, returning the server
+    port = config["port"] if port is None else port
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockLNDHandler)
+    server.daemon_threads = True
+    certFile, keyFile = getCertificateFiles()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certFile, keyFile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, name="mocklnd", daemon=True).start()
+    logger.info(f"Mock LND listening on https://127.0.0.1:{port} with node {bolt11.getPubkey(nodeKey).hex()}")
+    return server
+
+if __name__ == '__main__':
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if "--debug" in sys.argv else logging.INFO)
+    stdoutLoggingHandler = logging.StreamHandler(stream=sys.stdout)
+    logger.addHandler(stdoutLoggingHandler)
+    files.logger = logger
+    bolt11.logger = logger
+
+    for k, v in config.items():
+        arg = utils.getCommandArg(k)
+        if arg is None: continue
+        config[k] = arg if type(v) is str or v is None else type(v)(arg)
+    if config["settleAfter"] is not None: config["settleAfter"] = float(config["settleAfter"])
+
+    startServer()
+    while True:
+        time.sleep(60)
+        expireInvoices()
@@ -0,0 +1,180 @@
+#!~/.pyenv/boostzapper/bin/python3
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+import botbolt11 as bolt11
+import botfiles as files
+import botutils as utils
+import mocklnd
+
+# A stand-in for LN URL Providers, serving the lnurlp pay info of any
+# lightning address at its host and invoices from the callback, for load
+# testing zaps and reproducing misbehaving providers without the internet.
+# Invoices are created on the mock LND in the same process, so paying them
+# through it settles them.
+#
+#   mocklnurl.py [--port 10081] [--latency <ms>] [--errorRate <0-1>]
+#                [--statusErrorRate <0-1>] [--stallRate <0-1>] [--stallSeconds <s>]
+#                [--wrongAmountRate <0-1>] [--wrongHashRate <0-1>]
+#                [--minSendable <msat>] [--maxSendable <msat>] [--allowsNostr true|false]
+#                [--lndPort <port>]
+#
+# latency          mean delay added to each request, in milliseconds
+# errorRate        portion of requests answered with 503 Service Unavailable
+# statusErrorRate  portion of invoice requests answered with an LNURL ERROR status
+# stallRate        portion of requests not answered for stallSeconds, as if hung
+# wrongAmountRate  portion of invoices made for a different amount than requested
+# wrongHashRate    portion of invoices whose description hash is not of the zap request
+# minSendable      least amount accepted, in millisats
+# maxSendable      most amount accepted, in millisats
+# allowsNostr      whether the pay info advertises zap support
+# lndPort          port to also start the mock LND on
+#
+# Lightning addresses are of the form <anyname>@127.0.0.1:<port>. The bot can
+# be pointed at it by adding "127.0.0.1:<port>" to the httpDomains list of
+# the lnurl server configuration.
+
+logger = None
+config = {
+    "port": 10081,
+    "latency": 0,
+    "errorRate": 0.0,
+    "statusErrorRate": 0.0,
+    "stallRate": 0.0,
+    "stallSeconds": 60,
+    "wrongAmountRate": 0.0,
+    "wrongHashRate": 0.0,
+    "minSendable": 1000,
+    "maxSendable": 100000000000,
+    "allowsNostr": True,
+    "lndPort": None,
+}
+
+nostrKey = os.urandom(32)
+_counts = {}
+_countsLock = threading.Lock()
+
+def getDomain():
+    return f"127.0.0.1:{config['port']}"
+
+def count(outcome):
+    with _countsLock:
+        _counts[outcome] = _counts.get(outcome, 0) + 1
+
+def getCounts():
+    # number of each outcome served, for benchmarks to compare against
+    with _countsLock:
+        return dict(_counts)
+
+def getMetadata(username):
+    return json.dumps([["text/plain", f"Zap {username}"], ["text/identifier", f"{username}@{getDomain()}"]])
+
+def getPayInfo(username):
+    return {"tag": "payRequest", "callback": f"http://{getDomain()}/lnurlp/{username}/callback",
+            "minSendable": config["minSendable"], "maxSendable": config["maxSendable"],
+            "metadata": getMetadata(username), "commentAllowed": 0,
+            "allowsNostr": config["allowsNostr"], "nostrPubkey": bolt11.getPubkey(nostrKey)[1:].hex()}
+
+def getInvoice(username, query):
+    # returns an invoice response for the callback, following LUD-06 and NIP-57
+    amountMsat = int(query.get("amount", 0))
+    if amountMsat < config["minSendable"] or amountMsat > config["maxSendable"]:
+        count("amountRejected")
+        return {"status": "ERROR", "reason": f"Amount must be between {config['minSendable']} and {config['maxSendable']} msats"}
+    if random.random() < config["statusErrorRate"]:
+        count("statusError")
+        return {"status": "ERROR", "reason": "Simulated provider error"}
+    # the description hash commits to the zap request if given, else the metadata
+    description = query["nostr"] if "nostr" in query else getMetadata(username)
+    if random.random() < config["wrongHashRate"]:
+        count("wrongHash")
+        description = description + " "
+    if random.random() < config["wrongAmountRate"]:
+        count("wrongAmount")
+        amountMsat = amountMsat + 1000
+    # the mock LND takes whole sats
+    invoice = mocklnd.addInvoice({"value": max(1, amountMsat // 1000), "memo": "",
+                                  "description_hash": base64.b64encode(hashlib.sha256(description.encode()).digest()).decode()})
+    count("invoice")
+    return {"pr": invoice["payment_request"], "routes": []}
+
+class MockLNURLHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def sendJson(self, obj, status=200):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def simulateLatency(self):
+        if config["latency"] > 0:
+            time.sleep(random.uniform(0.5, 1.5) * config["latency"] / 1000)
+
+    def do_GET(self):
+        self.simulateLatency()
+        if random.random() < config["stallRate"]:
+            count("stalled")
+            time.sleep(float(config["stallSeconds"]))
+        if random.random() < config["errorRate"]:
+            count("error")
+            return self.sendJson({"status": "ERROR", "reason": "service unavailable"}, 503)
+        parsed = urllib.parse.urlparse(self.path)
+        parts = parsed.path.strip("/").split("/")
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        try:
+            if len(parts) == 3 and parts[:2] == [".well-known", "lnurlp"]:
+                count("payInfo")
+                return self.sendJson(getPayInfo(parts[2]))
+            if len(parts) == 3 and parts[0] == "lnurlp" and parts[2] == "callback":
+                return self.sendJson(getInvoice(parts[1], query))
+            return self.sendJson({"status": "ERROR", "reason": "not found"}, 404)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def startServer(port=None):
+    # serves in a background thread, returning the server
+    if port is not None: config["port"] = port
+    server = ThreadingHTTPServer(("127.0.0.1", config["port"]), MockLNURLHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mocklnurl", daemon=True).start()
+    logger.info(f"Mock LN URL Provider listening on http://{getDomain()}")
+    return server
+
+if __name__ == '__main__':
+
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if "--debug" in sys.argv else logging.INFO)
+    stdoutLoggingHandler = logging.StreamHandler(stream=sys.stdout)
+    logger.addHandler(stdoutLoggingHandler)
+    files.logger = logger
+    bolt11.logger = logger
+    mocklnd.logger = logger
+
+    for k, v in config.items():
+        arg = utils.getCommandArg(k)
+        if arg is None: continue
+        if type(v) is bool:
+            config[k] = str(arg).lower() == "true"
+        else:
+            config[k] = arg if type(v) is str or v is None else type(v)(arg)
+    if config["lndPort"] is not None: mocklnd.startServer(int(config["lndPort"]))
+
+    startServer()
+    while True:
+        time.sleep(60)
+        mocklnd.expireInvoices()
@@ -0,0 +1,26 @@
+import logging
+import os
+import sys
+import tempfile
+import pytest
+
+# botfiles makes its data folders on import, relative to the current folder,
+# so tests run from a temporary folder to leave any data of the bot untouched
+os.chdir(tempfile.mkdtemp(prefix="boostzapper-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import botfiles as files
+
+@pytest.fixture
+def dataFolder(tmp_path, monkeypatch):
+    # points the data folders of botfiles at a folder of the test's own
+    dataFolder = f"{tmp_path}/data/"
+    for name, folder in (("dataFolder", ""), ("userConfigFolder", "userConfigs/"), ("userEventsFolder", "userEvents/"),
+                         ("userLedgerFolder", "userLedgers/"), ("userReportsFolder", "userReports/"), ("logFolder", "logs/")):
+        os.makedirs(f"{dataFolder}{folder}", exist_ok=True)
+        monkeypatch.setattr(files, name, f"{dataFolder}{folder}")
+    return dataFolder
+
+@pytest.fixture
+def logger():
+    return logging.getLogger("tests")
@@ -0,0 +1,65 @@
+import hashlib
+import logging
+import pytest
+import botbolt11 as bolt11
+
+bolt11.logger = logging.getLogger("tests")
+
+# examples from the BOLT #11 specification, signed by the node below
+specNode = "03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad"
+specPaymentHash = "0001020304050607080900010203040506070809000102030405060708090102"
+specPaymentSecret = "1111111111111111111111111111111111111111111111111111111111111111"
+donation = ("lnbc1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpl2pkx2ctnv5sxxmmwwd5kgetjypeh2ursdae8g6twvus8g6rfwvs8qun0dfjkxaq9qrsgq357wnc5r2ueh7ck6q93dj32dlqnls087fxdwk8qakdyafkq3yap9us6v52vjjsrvywa6rt52cm9r9zqt8r2t7mlcwspyetp5h2tztugp9lfyql")
+coffee = ("lnbc2500u1pvjluezsp5zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zyg3zygspp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpu9qrsgquk0rl77nj30yxdy8j9vdx85fkpmdla2087ne0xh8nhedh8w27kyke0lp53ut353s06fv3qfegext0eh0ymjpf39tuven09sam30g4vgpfna3rh")
+
+def test_decodes_spec_donation_without_amount():
+    decoded = bolt11.decodeInvoice(donation)
+    assert decoded["destination"] == specNode
+    assert decoded["payment_hash"] == specPaymentHash
+    assert decoded["payment_addr"] == specPaymentSecret
+    assert decoded["description"] == "Please consider supporting this project"
+    assert decoded["timestamp"] == "1496314658"
+    assert decoded["expiry"] == "3600"
+    assert "num_msat" not in decoded
+
+def test_decodes_spec_coffee_with_amount_and_expiry():
+    decoded = bolt11.decodeInvoice(coffee)
+    assert decoded["destination"] == specNode
+    assert decoded["description"] == "1 cup coffee"
+    assert decoded["num_msat"] == "250000000"
+    assert decoded["num_satoshis"] == "250000"
+    assert decoded["expiry"] == "60"
+
+def test_accepts_uppercase_and_lightning_prefix():
+    assert bolt11.decodeInvoice(f"lightning:{coffee.upper()}")["payment_hash"] == specPaymentHash
+
+def test_rejects_bad_checksum():
+    assert bolt11.decodeInvoice(coffee[:-1] + ("q" if coffee[-1] != "q" else "p")) is None
+
+def test_changed_field_recovers_a_different_payee():
+    # a valid checksum over altered data still fails to recover the signer
+    hrp, data = bolt11.bech32Decode(coffee)
+    data = list(data)
+    data[7 + 3] ^= 1
+    decoded = bolt11.decodeInvoice(bolt11.bech32Encode(hrp, data))
+    assert decoded is None or decoded["destination"] != specNode
+
+@pytest.mark.parametrize("hrp, amountMsat", [
+    ("lnbc", None), ("lnbc1", 100000000000), ("lnbc2500u", 250000000), ("lnbc20m", 2000000000),
+    ("lnbc10n", 1000), ("lnbc10p", 1), ("lnbcrt21u", 2100000)])
+def test_parses_amounts(hrp, amountMsat):
+    assert bolt11.parseAmountMsat(hrp) == amountMsat
+
+def test_rejects_pico_amount_not_whole_millisats():
+    with pytest.raises(ValueError): bolt11.parseAmountMsat("lnbc1p")
+
+def test_round_trips_description_hash():
+    privateKey = bytes(range(1, 33))
+    zapRequest = '{"kind":9734}'
+    invoice = bolt11.encodeInvoice(privateKey, bytes(32), amountMsat=21000,
+                                   descriptionHash=hashlib.sha256(zapRequest.encode()).digest(), paymentSecret=bytes(32))
+    decoded = bolt11.decodeInvoice(invoice)
+    assert decoded["destination"] == bolt11.getPubkey(privateKey).hex()
+    assert decoded["num_msat"] == "21000"
+    assert bolt11.isValidDescriptionHash(decoded, zapRequest)
+    assert not bolt11.isValidDescriptionHash(decoded, zapRequest + " ")
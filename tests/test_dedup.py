@@ -0,0 +1,48 @@
+import botdedup as dedup
+
+def makeStore(ringSize=2):
+    return dedup.makeDedupStore(100, expectedKeys=100, ringSize=ringSize)
+
+def test_keys_added_are_seen():
+    store = makeStore()
+    dedup.addKey(store, "a", 10)
+    assert dedup.hasKey(store, "a", 10)
+    assert not dedup.hasKey(store, "b", 10)
+
+def test_keys_newer_than_the_ring_floor_are_only_seen_if_in_the_ring():
+    store = makeStore(ringSize=2)
+    for i, t in enumerate((10, 20, 30)): dedup.addKey(store, f"k{i}", t)
+    # k0 was dropped from the ring, so keys up to its time rely on the blooms
+    assert store["ringFloor"] == 10
+    assert dedup.hasKey(store, "k0", 10)
+    assert not dedup.hasKey(store, "new", 25)
+
+def test_keys_are_forgotten_once_their_generation_is_dropped():
+    store = makeStore(ringSize=1)
+    for i, t in enumerate((0, 50, 150, 260, 370)): dedup.addKey(store, f"k{i}", t)
+    assert len(store["generations"]) == 2
+    # generations starting at 0 and 150 were dropped
+    assert store["expiredBefore"] == 260
+    assert not dedup.hasKey(store, "k0", 0)
+    assert dedup.isExpired(store, 0)
+    assert dedup.isExpired(store, 259)
+    assert not dedup.isExpired(store, 260)
+    assert dedup.hasKey(store, "k3", 260)
+
+def test_nothing_expires_before_a_generation_is_dropped():
+    store = makeStore()
+    dedup.addKey(store, "a", 1000)
+    assert not dedup.isExpired(store, 0)
+
+def test_store_round_trips_through_json():
+    store = makeStore(ringSize=1)
+    for i, t in enumerate((0, 50, 150, 260, 370)): dedup.addKey(store, f"k{i}", t)
+    restored = dedup.dedupStoreFromJson(dedup.dedupStoreToJson(store))
+    for i, t in enumerate((0, 50, 150, 260, 370)):
+        assert dedup.hasKey(restored, f"k{i}", t) == dedup.hasKey(store, f"k{i}", t)
+    assert restored["expiredBefore"] == store["expiredBefore"]
+
+def test_store_saved_before_expiry_was_recorded_loads():
+    obj = dedup.dedupStoreToJson(makeStore())
+    del obj["expiredBefore"]
+    assert not dedup.isExpired(dedup.dedupStoreFromJson(obj), 0)
@@ -0,0 +1,14 @@
+import pytest
+import botfiles as files
+
+bigInteger = 2 ** 64 + 1
+
+@pytest.mark.skipif(files.orjson is None, reason="orjson not installed")
+def test_decode_falls_back_to_json_when_orjson_rejects(monkeypatch):
+    def loads(data):
+        raise files.orjson.JSONDecodeError("Integer exceeds 64-bit range", "", 0)
+    monkeypatch.setattr(files.orjson, "loads", loads)
+    assert files.decodeJson(f'{{"value": {bigInteger}}}'.encode(), "orjson") == {"value": bigInteger}
+
+def test_decode_with_json_keeps_integers_beyond_64_bit():
+    assert files.decodeJson(f'{{"value": {bigInteger}}}'.encode(), "json") == {"value": bigInteger}
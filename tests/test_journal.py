@@ -0,0 +1,81 @@
+import os
+import pytest
+import botjournal as journal
+import botledger as ledger
+import botfiles as files
+
+npub = "npub1test"
+eventId = "event1"
+
+class Crash(Exception):
+    pass
+
+@pytest.fixture
+def setup(dataFolder, logger):
+    journal.logger = logger
+    files.logger = logger
+    os.makedirs(f"{files.userEventsFolder}{npub}/{eventId}/")
+    ledger.recordEntry(npub, "CREDITS APPLIED", 1000, 0, "Credits")
+
+def setEventBalance(npub, eventBalance):
+    pass
+
+def zapRecord(amount):
+    return {"ledger": [{"type": "ZAPS", "credits": -amount, "mcredits": 0, "description": f"Zap for reply to {eventId}"}]}
+
+def test_replay_after_crash_before_marker_does_not_charge_twice(setup, monkeypatch):
+    monkeypatch.setattr(ledger, "maxLedgerEntries", 3)
+    ledger.recordEntry(npub, "ZAPS", -1, 0, "Zap")
+    journal.appendRecord(npub, eventId, zapRecord(21))
+    recordEntries = ledger.recordEntries
+    def crashAfterLedger(*args, **kwargs):
+        recordEntries(*args, **kwargs)
+        raise Crash()
+    monkeypatch.setattr(ledger, "recordEntries", crashAfterLedger)
+    with pytest.raises(Crash): journal.checkpoint(npub, eventId, setEventBalance)
+    monkeypatch.setattr(ledger, "recordEntries", recordEntries)
+    journal.recoverJournals(setEventBalance)
+    assert ledger.getCreditBalance(npub) == 1000 - 1 - 21
+    assert not os.path.exists(journal.getJournalFilename(npub, eventId))
+
+def test_replay_after_crash_between_rotation_and_marker_does_not_charge_twice(setup, monkeypatch):
+    # the ledger is only rotated once the marker is written, so a crash in
+    # rotation leaves a journal that replays without charging again
+    monkeypatch.setattr(ledger, "maxLedgerEntries", 3)
+    ledger.recordEntry(npub, "ZAPS", -1, 0, "Zap")
+    journal.appendRecord(npub, eventId, zapRecord(21))
+    rotateLedger = ledger.rotateLedger
+    markerWritten = []
+    def crashAfterRotation(*args, **kwargs):
+        records, appliedLedger = journal.readRecords(journal.getJournalFilename(npub, eventId))
+        markerWritten.append(len(appliedLedger) > 0)
+        rotateLedger(*args, **kwargs)
+        raise Crash()
+    monkeypatch.setattr(ledger, "rotateLedger", crashAfterRotation)
+    with pytest.raises(Crash): journal.checkpoint(npub, eventId, setEventBalance)
+    assert markerWritten == [True]
+    monkeypatch.setattr(ledger, "rotateLedger", rotateLedger)
+    journal.recoverJournals(setEventBalance)
+    assert ledger.getCreditBalance(npub) == 1000 - 1 - 21
+    assert len(ledger.getLedgerSegmentFilenames(npub)) == 1
+
+def test_replaying_an_applied_journal_does_not_charge_twice(setup):
+    journal.appendRecord(npub, eventId, dict(zapRecord(21), responses=["reply1"], pubkey="pk1",
+                                             paidnpub={"amount_sat": 21}, eventBalance=79))
+    lines = open(journal.getJournalFilename(npub, eventId)).read()
+    balances = []
+    journal.checkpoint(npub, eventId, lambda npub, eventBalance: balances.append(eventBalance))
+    # as if the journal were left behind after its checkpoint
+    with open(journal.getJournalFilename(npub, eventId), "w") as f: f.write(lines)
+    journal.recoverJournals(lambda npub, eventBalance: balances.append(eventBalance))
+    basePath = f"{files.userEventsFolder}{npub}/{eventId}/"
+    assert ledger.getCreditBalance(npub) == 1000 - 21
+    assert files.loadJsonFile(f"{basePath}responses.json") == ["reply1"]
+    assert files.loadJsonFile(f"{basePath}paidnpubs.json") == {"pk1": {"amount_sat": 21}}
+    assert balances == [79, 79]
+
+def test_partial_record_is_ignored_on_replay(setup):
+    journal.appendRecord(npub, eventId, zapRecord(21))
+    with open(journal.getJournalFilename(npub, eventId), "a") as f: f.write('{"ledger": [')
+    journal.recoverJournals(setEventBalance)
+    assert ledger.getCreditBalance(npub) == 1000 - 21
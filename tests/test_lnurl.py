@@ -0,0 +1,104 @@
+import http.server
+import threading
+import pytest
+import botlnurl as lnurl
+
+# The circuit breaker is driven with a clock of the test's own
+
+@pytest.fixture
+def clock(logger, monkeypatch):
+    now = [1000]
+    monkeypatch.setattr(lnurl.utils, "getTimes", lambda: (now[0], None))
+    monkeypatch.setattr(lnurl, "logger", logger)
+    monkeypatch.setattr(lnurl, "config", {"circuitFailureThreshold": 3, "circuitOpenSeconds": 60, "useTor": False})
+    lnurl._providerHealth.clear()
+    yield now
+    lnurl._providerHealth.clear()
+
+def fail(host, times=1):
+    for _ in range(times):
+        assert lnurl.acquireProvider(host)
+        lnurl.recordProviderResult(host, False, 0.1)
+
+def state(host):
+    return lnurl._providerHealth[host]["state"]
+
+def test_breaker_opens_after_threshold(clock):
+    fail("a.com", 2)
+    assert state("a.com") == "CLOSED"
+    assert not lnurl.isProviderTripped("a.com")
+    fail("a.com")
+    assert state("a.com") == "OPEN"
+    assert lnurl.isProviderTripped("a.com")
+    assert not lnurl.acquireProvider("a.com")
+
+def test_success_resets_failure_count(clock):
+    fail("a.com", 2)
+    lnurl.recordProviderResult("a.com", True, 0.1)
+    fail("a.com", 2)
+    assert state("a.com") == "CLOSED"
+
+def test_open_breaker_allows_one_trial_after_wait(clock):
+    fail("a.com", 3)
+    clock[0] += 59
+    assert not lnurl.acquireProvider("a.com")
+    clock[0] += 1
+    assert lnurl.acquireProvider("a.com")
+    assert state("a.com") == "HALF_OPEN"
+    # only the one trial request is let through
+    assert not lnurl.acquireProvider("a.com")
+    assert lnurl.isProviderTripped("a.com")
+
+def test_successful_trial_closes_breaker(clock):
+    fail("a.com", 3)
+    clock[0] += 60
+    assert lnurl.acquireProvider("a.com")
+    lnurl.recordProviderResult("a.com", True, 0.1)
+    assert state("a.com") == "CLOSED"
+    assert lnurl.acquireProvider("a.com")
+
+def test_failed_trial_reopens_breaker(clock):
+    fail("a.com", 3)
+    clock[0] += 60
+    fail("a.com")
+    assert state("a.com") == "OPEN"
+    assert lnurl._providerHealth["a.com"]["opened"] == clock[0]
+    clock[0] += 59
+    assert not lnurl.acquireProvider("a.com")
+
+def test_providers_are_tracked_separately(clock):
+    fail("a.com", 3)
+    assert lnurl.acquireProvider("b.com")
+    assert not lnurl.isProviderTripped("b.com")
+
+# Only transport errors and server errors count against a provider
+
+class ProviderHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        status = int(self.path.strip("/"))
+        body = b"<html>not here</html>" if status != 200 else b'{"status":"ERROR","reason":"no such user"}'
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def provider():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ProviderHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+@pytest.mark.parametrize("status, tripped", [(200, False), (404, False), (503, True)])
+def test_replies_counted_by_status(clock, provider, status, tripped):
+    for _ in range(3):
+        lnurl.geturlresponse(useTor=False, url=f"{provider}/{status}")
+    assert lnurl.isProviderTripped("127.0.0.1") == tripped
+
+def test_unreachable_provider_trips(clock):
+    for _ in range(3):
+        j, resp = lnurl.geturlresponse(useTor=False, url="http://127.0.0.1:1/")
+        assert j == {} and resp is None
+    assert lnurl.isProviderTripped("127.0.0.1")
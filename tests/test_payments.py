@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+import pytest
+import botfiles as files
+
+# botlnd imports botnostr, which needs the nostr package the bot is run with
+lnd = pytest.importorskip("botlnd", exc_type=ImportError)
+import botpayments as payments
+import mocklnd
+
+# Payments are sent to the mock LND, started once for the module
+
+@pytest.fixture(scope="module")
+def mockServer():
+    mocklnd.logger = logging.getLogger("tests")
+    mocklnd.config.update({"latency": 0, "failRate": 0.0, "stuckRate": 0.0, "inflightSeconds": 0.05})
+    server = mocklnd.startServer(0)
+    yield server
+    server.shutdown()
+
+@pytest.fixture
+def paying(mockServer, dataFolder, logger, monkeypatch):
+    for module in (lnd, payments, files):
+        monkeypatch.setattr(module, "logger", logger)
+    monkeypatch.setattr(lnd, "config", {"address": "127.0.0.1", "port": str(mockServer.server_address[1]),
+                                        "macaroon": "00", "feeLimit": 2, "paymentTimeout": 5})
+    payments._queue.clear()
+    yield
+    payments._queue.clear()
+
+def readQueueFile():
+    filename = payments.getPaymentQueueFilename()
+    if not os.path.exists(filename): return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if len(line.strip()) > 0]
+
+def waitForCompleted():
+    completed = []
+    while len(completed) == 0:
+        completed = payments.getCompletedPayments(block=True)
+    return completed
+
+def test_payment_settles_and_leaves_the_queue(paying):
+    invoice = mocklnd.addInvoice({"value": 21})
+    paymentHash = lnd.decodeInvoice(invoice["payment_request"])["payment_hash"]
+    assert payments.submitPayment(invoice["payment_request"], {"payment_hash": paymentHash, "amount": 21})
+    # the same payment is never queued twice
+    assert not payments.submitPayment(invoice["payment_request"], {"payment_hash": paymentHash, "amount": 21})
+    [(payment, result)] = waitForCompleted()
+    assert result[0] == "SUCCEEDED"
+    assert payment["state"] == "SETTLED"
+    assert [r["state"] for r in readQueueFile()][-1] == "SETTLED"
+    payments.completePayment(payment)
+    assert not payments.isQueued(paymentHash)
+    assert readQueueFile() == []
+
+def test_queue_is_compacted_as_payments_complete(paying, monkeypatch):
+    monkeypatch.setattr(payments, "maxQueueRecords", 4)
+    kept = {"payment_hash": "kept", "amount": 1}
+    payments.setPaymentState(kept, "SENDING")
+    for i in range(10):
+        payment = {"payment_hash": f"done{i}", "amount": 1}
+        payments.setPaymentState(payment, "PREPARED")
+        payments.setPaymentState(payment, "SENDING")
+        payments.completePayment(payment)
+    assert len(readQueueFile()) <= 1 + 4 + 1
+    assert [r["payment_hash"] for r in readQueueFile() if r.get("state") is not None] == ["kept"]
+
+def test_recovery_settles_recorded_outcomes_and_drops_unsent(paying):
+    settled = {"payment_hash": "aa" * 32, "amount": 21, "payment_server": lnd.getDefaultServerId(),
+               "reserved_sat": 23, "state": "SETTLED", "result": ["SUCCEEDED", 1000, "aa" * 32, None]}
+    prepared = {"payment_hash": "bb" * 32, "amount": 21, "state": "PREPARED"}
+    with open(payments.getPaymentQueueFilename(), "w") as f:
+        for record in (settled, prepared):
+            f.write(json.dumps(record) + "\n")
+        f.write('{"payment_hash": "incomplete')
+    payments.loadPaymentQueue()
+    assert [r["payment_hash"] for r in readQueueFile()] == [settled["payment_hash"]]
+    [(payment, result)] = waitForCompleted()
+    assert payment["payment_hash"] == settled["payment_hash"]
+    assert tuple(result) == ("SUCCEEDED", 1000, "aa" * 32, None)
+    payments.completePayment(payment)
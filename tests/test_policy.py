@@ -0,0 +1,40 @@
+import pytest
+import botpolicy as policy
+
+@pytest.mark.parametrize("host, deny, allow, allowed", [
+    # hosts matching no rule are allowed
+    ("example.com", ["other.com"], [], True),
+    ("example.com", [], [], True),
+    # an exact rule matches only that domain
+    ("example.com", ["example.com"], [], False),
+    ("pay.example.com", ["example.com"], [], True),
+    # a wildcard matches subdomains at any depth, but not the domain itself
+    ("pay.example.com", ["*.example.com"], [], False),
+    ("a.b.example.com", ["*.example.com"], [], False),
+    ("example.com", ["*.example.com"], [], True),
+    ("badexample.com", ["*.example.com"], [], True),
+    # a lone * matches every host
+    ("example.com", ["*"], [], False),
+    ("example.com", ["*"], ["example.com"], True),
+    # the most specific rule decides
+    ("pay.example.com", ["*.example.com"], ["pay.example.com"], True),
+    ("pay.example.com", ["pay.example.com"], ["*.example.com"], False),
+    ("x.pay.example.com", ["*.example.com"], ["*.pay.example.com"], True),
+    ("x.pay.example.com", ["*.pay.example.com"], ["*.example.com"], False),
+    # an exact rule is more specific than a wildcard ending at the same label
+    ("example.com", ["example.com"], ["*"], False),
+    # allow wins over deny for rules equally specific
+    ("example.com", ["example.com"], ["example.com"], True),
+    ("pay.example.com", ["*.example.com"], ["*.example.com"], True),
+    # case and a trailing dot are ignored
+    ("Pay.Example.COM.", ["*.EXAMPLE.com"], [], False),
+])
+def test_policy_precedence(host, deny, allow, allowed):
+    assert policy.isHostAllowed(host, deny, allow) == allowed
+
+def test_no_host_is_not_allowed():
+    assert not policy.isHostAllowed(None, [], [])
+
+def test_decisions_follow_changed_rules():
+    assert not policy.isHostAllowed("example.com", ["example.com"], [])
+    assert policy.isHostAllowed("example.com", ["other.com"], [])